@@ -0,0 +1,82 @@
+# Compares peak RSS and wall time of the streaming plan reader used by
+# _summarize_plan against json.load on a synthetic plan.
+#
+#   python benchmarks/plan_memory.py --size-mb 300
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _resource(index, value_size):
+    values = {"id": f"i-{index:08x}", "tags": {"Name": f"resource-{index}", "Blob": "x" * value_size},
+              "ingress": [{"cidr_blocks": ["10.0.0.0/16"], "from_port": 443, "to_port": 443}]}
+    return {"address": f"aws_instance.r{index}", "type": "aws_instance", "name": f"r{index}", "values": values}
+
+
+def write_plan(path, size_mb, resource_changes=2000):
+    # prior_state and planned_values make up almost all of the file, as in real plans
+    target_bytes = size_mb * 1024 * 1024
+    with open(path, "w") as plan_file:
+        plan_file.write('{"format_version": "1.2", "prior_state": {"values": {"root_module": {"resources": [')
+        written = 0
+        index = 0
+        while written < target_bytes:
+            chunk = json.dumps(_resource(index, 16))
+            plan_file.write(("," if index else "") + chunk)
+            written += len(chunk)
+            index += 1
+        plan_file.write(']}}}, "resource_changes": [')
+        for index in range(resource_changes):
+            before = _resource(index, 64)["values"]
+            after = dict(before, tags={"Name": f"resource-{index}", "Blob": "y" * 64})
+            change = {"address": f"aws_instance.r{index}",
+                      "change": {"actions": ["update" if index % 3 else "no-op"], "before": before, "after": after}}
+            plan_file.write(("," if index else "") + json.dumps(change))
+        plan_file.write('], "resource_drift": [], "configuration": {"root_module": {}}}')
+
+
+def _measure(mode, path):
+    started = time.perf_counter()
+    if mode == "streaming":
+        from paraterra import _summarize_plan
+        _summarize_plan(path)
+    else:
+        with open(path) as plan_file:
+            json.load(plan_file)
+    elapsed = time.perf_counter() - started
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"mode": mode, "seconds": round(elapsed, 2), "peak_rss_mb": round(peak_rss_mb, 1)}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=300)
+    parser.add_argument("--measure", choices=["streaming", "json.load"])
+    parser.add_argument("--plan")
+    args = parser.parse_args()
+
+    if args.measure:
+        _measure(args.measure, args.plan)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # _summarize_plan parses account+region+uuid out of the file name
+        plan_dir = os.path.join(tmp_dir, "artifacts", "plans")
+        os.makedirs(plan_dir)
+        plan_path = os.path.join(plan_dir, "123456789012+us-east-1+0f0f0f0f+terraform-plan-out.json")
+        write_plan(plan_path, args.size_mb)
+        print(f"plan size: {os.path.getsize(plan_path) / 1024 / 1024:.0f} MB")
+        for mode in ("streaming", "json.load"):
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", mode,
+                            "--plan", os.path.relpath(plan_path, tmp_dir)], cwd=tmp_dir, check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Compares _diff_resource_change with the top-level-only comparison it replaced,
+# on a large resource, whose tags and rules are reported as a whole, and on a typical
+# one, whose changes are reported item by item.
+#
+#   python benchmarks/property_diff.py
+import copy
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from paraterra import _diff_resource_change
+
+
+def legacy_compare_before_and_after(resource_change, resource_properties_changed):
+    before = resource_change.get('change').get('before')
+    after = resource_change.get('change').get('after')
+
+    if before and after:
+        for before_prop_name, before_prop_value in before.items():
+            if before_prop_value != after.get(before_prop_name):
+                resource_properties_changed.add(before_prop_name)
+
+
+def _resource(tag_count, rule_count):
+    return {
+        "id": "sg-0123456789",
+        "name": "fleet",
+        "tags": {f"Tag{index}": f"value-{index}" for index in range(tag_count)},
+        "ingress": [{"cidr_blocks": [f"10.{index // 256}.{index % 256}.0/24"], "from_port": 443,
+                     "to_port": 443, "protocol": "tcp", "description": f"rule {index}"}
+                    for index in range(rule_count)],
+    }
+
+
+def _markers(value):
+    # The shape terraform gives before_sensitive and after_sensitive, and after_unknown once anything is
+    # unknown: every object and list mirrored, e.g. {"tags": {}, "ingress": [{"cidr_blocks": [false]}]}
+    if isinstance(value, dict):
+        return {key: _markers(item) for key, item in value.items() if isinstance(item, (dict, list))}
+    if isinstance(value, list):
+        return [_markers(item) if isinstance(item, (dict, list)) else False for item in value]
+    return False
+
+
+def _change(before, after, after_unknown=None):
+    # after_unknown is {} when everything is known
+    return {"change": {"actions": ["update"], "before": before, "after": after, "after_unknown": after_unknown or {},
+                       "before_sensitive": _markers(before), "after_sensitive": _markers(after)}}
+
+
+def cases():
+    before = _resource(tag_count=5000, rule_count=2000)
+
+    yield "no-op (equal, separate objects)", _change(before, copy.deepcopy(before))
+
+    after = copy.deepcopy(before)
+    after["tags"]["Tag4999"] = "changed"
+    yield "one tag of 5000 changed", _change(before, after)
+    yield "one tag changed, arn known after apply", _change(before, after, dict(_markers(after), arn=True))
+
+    after = copy.deepcopy(before)
+    after["ingress"][1999]["cidr_blocks"] = ["0.0.0.0/0"]
+    yield "last of 2000 ingress rules changed", _change(before, after)
+
+    after = copy.deepcopy(before)
+    after["tags"] = {key: f"{value}-changed" for key, value in before["tags"].items()}
+    after["ingress"] = [dict(rule, to_port=8443) for rule in before["ingress"]]
+    yield "every tag and rule changed", _change(before, after)
+
+    before = _resource(tag_count=50, rule_count=20)
+    after = copy.deepcopy(before)
+    after["tags"]["Tag49"] = "changed"
+    after["ingress"][19]["cidr_blocks"] = ["0.0.0.0/0"]
+    yield "one of 50 tags and one of 20 rules changed", _change(before, after)
+
+
+def main():
+    for name, resource_change in cases():
+        legacy = min(timeit.repeat(lambda: legacy_compare_before_and_after(resource_change, set()),
+                                   number=20, repeat=5)) / 20
+        diff = min(timeit.repeat(lambda: _diff_resource_change(resource_change), number=20, repeat=5)) / 20
+        print(f"{name:40} legacy {legacy * 1000:8.3f} ms   diff {diff * 1000:8.3f} ms   "
+              f"paths {len(_diff_resource_change(resource_change))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# Measures wall time, peak RSS and files opened by paraterra commands on a synthetic
+# fleet and synthetic plans, writes the results as JSON and optionally fails when a
+# result regresses past a threshold against an earlier run.
+#
+#   python benchmarks/suite.py --accounts 2000 --output results.json
+#   python benchmarks/suite.py --accounts 2000 --baseline results.json --threshold 0.25
+#
+# Each scenario runs in a fresh process, in the order below, against the same
+# generated tree, so index-rebuild pays for parsing every tfvars file and the other
+# commands measure a warm index.
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+
+SCENARIOS = {
+    "index-rebuild": ["index", "rebuild"],
+    "paths": ["paths", "--shortened", "--filters", "environment:dev"],
+    "accounts": ["accounts", "--filters", "environment in (dev,test) and not cost_center:cc-1"],
+    "table": ["table", "--to-csv", "--filters", "environment:prod,network:cidr:10.1*"],
+    "update-tfvars": ["update-tfvars", "--replace", "--filters", "environment:test",
+                      "--from-list", "setting_0=updated,network:subnets:0:cidr=10.255.0.0/24"],
+    "parse-plans": ["parse-plans", "--no-cache", "--artifacts-path", "plans"],
+}
+METRICS = ["seconds", "peak_rss_mb", "files_opened"]
+# Timer noise on scenarios that take milliseconds is not a regression
+MIN_SECONDS_REGRESSION = 0.05
+
+
+def _measure(scenario, jobs):
+    # Runs in the benchmark's working directory, in its own process
+    files_opened = 0
+
+    def count_opens(event, args):
+        nonlocal files_opened
+        if event == "open":
+            files_opened += 1
+
+    def generated_file_path(account, file_name):
+        generated_files_dir = os.path.join("generated_files", account)
+        os.makedirs(generated_files_dir, exist_ok=True)
+        return os.path.join(generated_files_dir, file_name)
+
+    import paraterra
+    # update-tfvars also writes a copy of every file next to paraterra.py, so keep it in the benchmark's tree
+    paraterra._create_generated_file_path = generated_file_path
+    args = SCENARIOS[scenario] + (["--jobs", str(jobs)] if scenario in ("parse-plans", "update-tfvars") else [])
+
+    sys.addaudithook(count_opens)
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            paraterra.cli.main(args, standalone_mode=False)
+        finally:
+            sys.stdout = stdout
+    elapsed = time.perf_counter() - started
+    print(json.dumps({"seconds": round(elapsed, 3),
+                      "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                      "files_opened": files_opened}))
+
+
+def run_suite(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        synthetic.write_fleet(work_dir, args.accounts, args.regions, args.uuids, args.tfvars_keys)
+        synthetic.write_plans(os.path.join(work_dir, "plans"), args.plans, args.resources, args.depth,
+                              args.drift_ratio, args.plan_size_mb)
+        env = {**os.environ, "PARATERRA_CACHE_DIR": os.path.join(work_dir, ".paraterra")}
+        for scenario in args.scenarios:
+            runs = []
+            # Scenarios that change the tree only run once
+            for _ in range(1 if scenario in ("index-rebuild", "update-tfvars") else args.repeat):
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", scenario,
+                                         "--jobs", str(args.jobs)],
+                                        cwd=work_dir, env=env, check=True, capture_output=True, text=True).stdout
+                runs.append(json.loads(output.splitlines()[-1]))
+            # The fastest run is the least disturbed by the rest of the machine
+            results[scenario] = min(runs, key=lambda run: run["seconds"])
+            print(f"{scenario:15} {results[scenario]['seconds']:8.3f} s {results[scenario]['peak_rss_mb']:8.1f} MB "
+                  f"{results[scenario]['files_opened']:8} files")
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Returns a line per metric that grew by more than threshold over the baseline
+    regressions = []
+    for scenario, metrics in results.items():
+        for metric in METRICS:
+            before = baseline["results"].get(scenario, {}).get(metric)
+            if metric == "seconds" and metrics[metric] - (before or 0) < MIN_SECONDS_REGRESSION:
+                continue
+            if before and metrics[metric] > before * (1 + threshold):
+                regressions.append(f"{scenario} {metric}: {before} -> {metrics[metric]} "
+                                   f"(+{(metrics[metric] / before - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--regions", type=int, default=1)
+    parser.add_argument("--uuids", type=int, default=1)
+    parser.add_argument("--tfvars-keys", type=int, default=20)
+    parser.add_argument("--plans", type=int, default=50)
+    parser.add_argument("--resources", type=int, default=500)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--drift-ratio", type=float, default=0.1)
+    parser.add_argument("--plan-size-mb", type=float, default=1)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--output", help="Path to write the results JSON to")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Fails if any metric grows by more than this fraction over --baseline")
+    parser.add_argument("--measure", choices=list(SCENARIOS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        _measure(args.measure, args.jobs)
+        return
+
+    parameters = {name: value for name, value in vars(args).items()
+                  if name not in ("output", "baseline", "threshold", "measure", "scenarios")}
+    results = run_suite(args)
+    report = {"created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+              "python": platform.python_version(),
+              "parameters": parameters,
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["parameters"] != parameters:
+            print(f"Warning: baseline parameters {baseline['parameters']} differ from {parameters}")
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
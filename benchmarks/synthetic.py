@@ -0,0 +1,120 @@
+# Generators for synthetic fleets and plans, used by benchmarks/suite.py.
+#
+#   python benchmarks/synthetic.py fleet --accounts 1000 --output /tmp/fleet
+#   python benchmarks/synthetic.py plans --plans 50 --resources 500 --output /tmp/plans
+import argparse
+import json
+import os
+import random
+
+ENVIRONMENTS = ["dev", "test", "uat", "prod"]
+REGIONS = ["us-east-1", "us-west-2", "eu-west-1", "eu-central-1", "ap-southeast-2"]
+
+
+def leaf_prefixes(accounts, regions, uuids):
+    # (account, region, uuid) for every leaf, deterministic for a given shape
+    return [(f"{100000000000 + account:012d}", REGIONS[region % len(REGIONS)], f"{account:06x}{region:02x}{uuid:02x}")
+            for account in range(accounts) for region in range(regions) for uuid in range(uuids)]
+
+
+def tfvars(account_index, tfvars_keys):
+    values = {"environment": ENVIRONMENTS[account_index % len(ENVIRONMENTS)],
+              "cost_center": f"cc-{account_index % 17}",
+              "network": {"cidr": f"10.{account_index % 256}.0.0/16",
+                          "subnets": [{"cidr": f"10.{account_index % 256}.{subnet}.0/24"} for subnet in range(3)]}}
+    values.update({f"setting_{key}": f"value-{key}-{account_index % 5}" for key in range(tfvars_keys)})
+    return values
+
+
+def write_fleet(root, accounts=100, regions=1, uuids=1, tfvars_keys=20):
+    # Writes {root}/accounts/{account}/{region}/{uuid}/terraform.tfvars.json
+    for account, region, uuid in leaf_prefixes(accounts, regions, uuids):
+        leaf_path = os.path.join(root, "accounts", account, region, uuid)
+        os.makedirs(leaf_path, exist_ok=True)
+        with open(os.path.join(leaf_path, "terraform.tfvars.json"), "w") as tfvars_file:
+            json.dump(tfvars(int(account) - 100000000000, tfvars_keys), tfvars_file, indent=4)
+
+
+def nested_values(index, depth, width=3):
+    if depth == 0:
+        return f"value-{index}"
+    return {f"level{depth}_{key}": nested_values(index, depth - 1, width) for key in range(width)}
+
+
+def resource_change(index, depth, action):
+    before = {"id": f"r-{index:08x}", "tags": {"Name": f"resource-{index}"}, "config": nested_values(index, depth)}
+    after = json.loads(json.dumps(before))
+    if action == "update":
+        after["tags"]["Name"] = f"resource-{index}-renamed"
+        if depth:
+            # The deepest value on the first branch, e.g. config.level3_0.level2_0.level1_0
+            container = after["config"]
+            for level in range(depth, 1, -1):
+                container = container[f"level{level}_0"]
+            container["level1_0"] = "changed"
+    return {"address": f"module.leaf.aws_resource.r{index}",
+            "change": {"actions": action.split("-"),
+                       "before": None if action == "create" else before,
+                       "after": None if action == "delete" else after,
+                       "after_unknown": {}, "before_sensitive": {}, "after_sensitive": {}}}
+
+
+def write_plan(path, resources=200, depth=3, drift_ratio=0.1, size_mb=0, seed=0):
+    # resource_changes are mostly no-ops with some updates, creates and deletes;
+    # prior_state is padded until the file reaches size_mb, as in real plans where
+    # state makes up most of the file
+    randomizer = random.Random(seed)
+    actions = ["no-op"] * 14 + ["update"] * 4 + ["create", "delete"]
+    with open(path, "w") as plan_file:
+        plan_file.write('{"format_version": "1.2", "prior_state": {"values": {"root_module": {"resources": [')
+        written = 0
+        index = 0
+        while written < size_mb * 1024 * 1024:
+            padding = json.dumps({"address": f"aws_resource.state{index}", "values": nested_values(index, depth)})
+            plan_file.write(("," if index else "") + padding)
+            written += len(padding) + 1
+            index += 1
+        plan_file.write(']}}}, "resource_changes": [')
+        for index in range(resources):
+            change = resource_change(index, depth, randomizer.choice(actions))
+            plan_file.write(("," if index else "") + json.dumps(change))
+        plan_file.write('], "resource_drift": [')
+        for index in range(int(resources * drift_ratio)):
+            plan_file.write(("," if index else "") + json.dumps(resource_change(index, depth, "update")))
+        plan_file.write('], "configuration": {"root_module": {}}}')
+
+
+def write_plans(root, plans=10, resources=200, depth=3, drift_ratio=0.1, size_mb=0):
+    # Writes {root}/{account}+{region}+{uuid}+terraform-plan-out.json for the first plans leaves
+    os.makedirs(root, exist_ok=True)
+    for seed, (account, region, uuid) in enumerate(leaf_prefixes(plans, 1, 1)):
+        write_plan(os.path.join(root, f"{account}+{region}+{uuid}+terraform-plan-out.json"),
+                   resources=resources, depth=depth, drift_ratio=drift_ratio, size_mb=size_mb, seed=seed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="kind", required=True)
+    fleet_parser = subparsers.add_parser("fleet")
+    fleet_parser.add_argument("--accounts", type=int, default=100)
+    fleet_parser.add_argument("--regions", type=int, default=1)
+    fleet_parser.add_argument("--uuids", type=int, default=1)
+    fleet_parser.add_argument("--tfvars-keys", type=int, default=20)
+    plans_parser = subparsers.add_parser("plans")
+    plans_parser.add_argument("--plans", type=int, default=10)
+    plans_parser.add_argument("--resources", type=int, default=200)
+    plans_parser.add_argument("--depth", type=int, default=3)
+    plans_parser.add_argument("--drift-ratio", type=float, default=0.1)
+    plans_parser.add_argument("--size-mb", type=float, default=0)
+    for subparser in (fleet_parser, plans_parser):
+        subparser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    if args.kind == "fleet":
+        write_fleet(args.output, args.accounts, args.regions, args.uuids, args.tfvars_keys)
+    else:
+        write_plans(args.output, args.plans, args.resources, args.depth, args.drift_ratio, args.size_mb)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,722 @@
+# tabulate, asyncio, shutil, concurrent.futures and the archive modules are imported by the functions that
+# use them: tabulate alone (through importlib.metadata) doubles startup time, and most
+# commands never print a table or start a subprocess. test_import_is_lazy guards this.
 import click
 from click_option_group import optgroup, RequiredMutuallyExclusiveOptionGroup
-import tabulate
 import os
 import json
 import sys
 import csv
-from typing import Dict, Set
+import re
+import fnmatch
+import copy
+import codecs
+import sqlite3
+import hashlib
+import string
+import time
+import heapq
+import shlex
+from contextlib import closing, contextmanager, nullcontext, redirect_stdout
+import threading
+from functools import partial, lru_cache
+from array import array
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Set
 
 class FiltersCommand(click.Command):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.params.insert(1, click.Option(('--filters',), help="Comma-delimited string of {tfvar_name}:{tfvar_value} to filter by (intersection)"))
+        self.params.insert(1, click.Option(('--filters',), help="Filter expression over tfvars, e.g. \
+                                           \"environment in (dev,test) and not region:eu-*\". Terms are \
+                                           {tfvar_name}:{tfvar_value} ('*' wildcards allowed), {tfvar_name}~{regex} \
+                                           and {tfvar_name} in (value,...), combined with and (or ','), or, not and \
+                                           parentheses. Nested tfvars are named by colon-delimited paths: \
+                                           '{outer_name}:{inner_name}:{tfvar_value}'"))
 
 # Custom type alias
 MapOfMaps = Dict[str,Dict[str,str]]
 MapOfSets = Dict[str,Set]
 
+ACCOUNTS_PATH = 'accounts'
+TFVARS_FILE_NAME = 'terraform.tfvars.json'
+INDEX_SCHEMA_VERSION = 1
+# Maps globs of changed files outside ACCOUNTS_PATH to the leaves they affect, for --changed-since
+CHANGES_CONFIG_FILE_NAME = 'paraterra-changes.json'
+
+class Leaf(NamedTuple):
+    account: str
+    region: str
+    uuid: str
+    path: str
+    tfvars: dict
+
+class RunOptions(NamedTuple):
+    terraform: str
+    tf_code_dir: str
+    output_dir: str
+    timeout: float
+    retries: int
+    backend_template: str = None
+    provider_mirror: str = None
+
+ACTIONS = ['no-op', 'create', 'read', 'update', 'delete-create', 'create-delete', 'delete']
+PLAN_TABLE_HEADERS = ['account', 'region', 'uuid'] + ACTIONS
+# Change profiles leave out no-op, which only counts how many resources a plan has
+PROFILE_ACTIONS = [action for action in ACTIONS if action != 'no-op']
+# One row per plan in the csv, json and ndjson outputs of parse-plans
+PLAN_ROW_HEADERS = (['account', 'region', 'uuid'] + [f"changes:{action}" for action in ACTIONS] +
+                    [f"drift:{action}" for action in ACTIONS] + ['properties_changed'])
+OUTPUT_FORMATS = ['text', 'csv', 'json', 'ndjson']
+# Resource actions in terraform apply -json hooks, and one row per leaf in the outputs of parse-applies
+APPLY_ACTIONS = ['create', 'read', 'update', 'replace', 'delete']
+APPLY_ROW_HEADERS = ['account', 'region', 'uuid', 'result'] + APPLY_ACTIONS + ['failed', 'seconds', 'errors']
+APPLY_FOLLOW_POLL_SECONDS = 1
+PLAN_SECTIONS = ('resource_changes', 'resource_drift')
+PLAN_READ_CHUNK_SIZE = 1 << 20
+# Plan artifacts are plan JSON files, optionally compressed, or tar and zip bundles of plan JSON files
+PLAN_BUNDLE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.zst', '.zip')
+# Version of the summary format written by summarize-plan and the plan summary cache.
+# Bump whenever the fields computed by _count_plan_changes change.
+PLAN_SUMMARY_VERSION = 4
+PLAN_SUMMARY_FILE_SUFFIX = '+terraform-plan-summary.json'
+# Maps and lists nested in a resource with more items than this, or whose changes would
+# name more paths than this, are reported by their own path when they differ instead of
+# item by item, and aren't searched for unknown values when they don't. Finding which of
+# thousands of tags changed costs more than comparing them, and a resource whose every
+# item changed would otherwise name every item.
+PROPERTY_DIFF_MAX_PATHS = 100
+PLAN_CACHE_MAX_BYTES = int(os.environ.get('PARATERRA_PLAN_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+LEAF_COSTS_FILE_NAME = 'leaf-costs.json'
+LEAF_COST_MEASURES = ['seconds', 'resources', 'uniform']
+GITHUB_MATRIX_MAX_JOBS = 256
+# Artifact directories written by run, named like the example pipeline's artifacts
+RUN_PLAN_JSON_DIR = 'terraform-plan-out-json'
+RUN_PLAN_OUT_DIR = 'terraform-plan-out'
+RUN_PLAN_TXT_DIR = 'terraform-plan-txt'
+RUN_APPLY_JSON_DIR = 'terraform-apply-json'
+RUN_RETRY_BACKOFF_SECONDS = 5
+WORKSPACE_FINGERPRINT_FILE = '.paraterra-fingerprint'
+WORKSPACE_BACKEND_FILE_NAME = 'paraterra_backend.tf'
+# Subdirectories of the template's .terraform that leaf workspaces link to instead of
+# installing again. Backend state in .terraform/terraform.tfstate stays per leaf.
+WORKSPACE_SHARED_DIRS = ('providers', 'modules')
+# Terraform errors worth retrying: state locks held by a previous run, and provider
+# API throttling or network failures
+TERRAFORM_TRANSIENT_ERRORS = re.compile(r'Error acquiring the state lock|Throttling|Rate exceeded|TooManyRequests|'
+                                        r'RequestError: send request failed|connection reset by peer|'
+                                        r'TLS handshake timeout|i/o timeout|Client\.Timeout exceeded')
+
+# Leaves matched by --filters, resolved once per command and passed to every helper
+Selection = List[Leaf]
+
+def output_option(function):
+    return click.option('--output', type=click.Choice(OUTPUT_FORMATS), default='text', show_default=True,
+                        help="Output format. csv, json and ndjson rows are written as they are produced")(function)
+
+def changed_since_options(function):
+    function = click.option('--changes-config', required=False, help=f"JSON object mapping globs of changed files \
+                            outside {ACCOUNTS_PATH}/ to a filter expression selecting the leaves they affect, or to \
+                            null for none. Other changed files affect every leaf. Defaults to \
+                            {CHANGES_CONFIG_FILE_NAME} if it exists")(function)
+    return click.option('--changed-since', required=False, metavar='REF', help="Only selects leaves affected by files \
+                        changed since a git ref or range (as git diff takes it), including uncommitted changes. \
+                        Combined with --filters")(function)
+
+class RowWriter:
+    # Writes dict rows to stdout in one of OUTPUT_FORMATS. csv, json and ndjson rows are
+    # written and flushed as they arrive, so consumers see them immediately and nothing
+    # is buffered; json is a streamed array. text rows are buffered for tabulate. With
+    # scalar, json and ndjson rows are just the value of the single column.
+    def __init__(self, output, headers, scalar=False):
+        self.output = output
+        self.headers = headers
+        self.scalar = scalar
+        self.file = sys.stdout
+        self.rows = []
+        self.count = 0
+        if output == 'csv':
+            self.csv_writer = csv.writer(self.file, lineterminator='\n')
+            self.csv_writer.writerow(headers)
+        elif output == 'json':
+            self.file.write('[')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.output == 'text':
+            print(_tabulate(self.rows, headers=self.headers, disable_numparse=True), file=self.file)
+        elif self.output == 'json':
+            self.file.write('\n]\n' if self.count else ']\n')
+        self.file.flush()
+
+    def write(self, row):
+        if self.output == 'text':
+            self.rows.append([row[header] for header in self.headers])
+            return
+        if self.output == 'csv':
+            self.csv_writer.writerow([_csv_value(row[header]) for header in self.headers])
+        else:
+            row_json = json.dumps(row[self.headers[0]] if self.scalar else row)
+            if self.output == 'json':
+                self.file.write((',\n' if self.count else '\n') + row_json)
+            else:
+                self.file.write(row_json + '\n')
+        self.count += 1
+        self.file.flush()
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+class _Profiler:
+    # Records phases as Chrome trace 'complete' events. perf_counter is monotonic across
+    # processes on Linux, so events from parse-plans worker processes line up.
+    def __init__(self, worker=False):
+        self.events = []
+        # In parse-plans worker processes, events are sent back with each plan summary
+        self.worker = worker
+
+    @contextmanager
+    def phase(self, name, **args):
+        # args is yielded so callers can add counts (bytes, files, ...) found inside the phase
+        started = time.perf_counter_ns()
+        cpu_started = time.thread_time_ns()
+        try:
+            yield args
+        finally:
+            self.record(name, started, cpu_started, args)
+
+    def record(self, name, started, cpu_started, args):
+        # list.append is atomic, so threads (update-tfvars) can record concurrently
+        self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                            'ts': started // 1000, 'dur': (time.perf_counter_ns() - started) // 1000,
+                            'args': {'cpu_us': (time.thread_time_ns() - cpu_started) // 1000, **args}})
+
+    def summary_table(self):
+        phases = {}
+        for event in self.events:
+            totals = phases.setdefault(event['name'], {'calls': 0, 'wall': 0, 'counts': {}})
+            totals['calls'] += 1
+            totals['wall'] += event['dur']
+            for key, value in event['args'].items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals['counts'][key] = totals['counts'].get(key, 0) + value
+        return [[name, totals['calls'], f"{totals['wall'] / 1e6:.3f}", f"{totals['counts'].pop('cpu_us') / 1e6:.3f}",
+                 ', '.join(f"{key}={value:g}" for key, value in totals['counts'].items())]
+                for name, totals in sorted(phases.items(), key=lambda phase: -phase[1]['wall'])]
+
+# Set by --profile or --trace-out. Instrumented code calls _phase, which is a no-op
+# context manager while profiling is off.
+_PROFILER = None
+
+def _phase(name, **args):
+    if _PROFILER is None:
+        # A new event dict each time, since callers fill it in, from any thread or process
+        return nullcontext({})
+    return _PROFILER.phase(name, **args)
+
+def _enable_profiler(worker=False):
+    global _PROFILER
+    _PROFILER = _Profiler(worker)
+
+def _finish_profile(profile, trace_out, started, cpu_started, command):
+    global _PROFILER
+    profiler, _PROFILER = _PROFILER, None
+    profiler.record(f"paraterra {command}", started, cpu_started, {})
+    # Summaries go to stderr so command output on stdout stays parseable
+    if profile:
+        print(_tabulate(profiler.summary_table(), headers=['phase', 'calls', 'wall s', 'cpu s', 'totals'],
+                                disable_numparse=True), file=sys.stderr)
+        plans = sorted((event for event in profiler.events if event['name'] == 'summarize plan'),
+                       key=lambda event: -event['dur'])[:5]
+        if plans:
+            print("\nSlowest plans", file=sys.stderr)
+            print(_tabulate([[event['args']['plan'], f"{event['dur'] / 1e6:.3f}", event['args'].get('bytes', '')]
+                                     for event in plans], headers=['plan', 'wall s', 'bytes'],
+                                    disable_numparse=True), file=sys.stderr)
+    if trace_out:
+        with open(trace_out, 'w') as trace_file:
+            json.dump({'traceEvents': profiler.events, 'displayTimeUnit': 'ms'}, trace_file)
+
+def _tabulate(*args, **kwargs):
+    import tabulate
+    return tabulate.tabulate(*args, **kwargs)
+
 @click.group()
-def cli():
-    pass
+@click.option('--profile', is_flag=True, help="Prints wall and CPU time, bytes read and files per phase to stderr")
+@click.option('--trace-out', required=False, help="Writes phase timings as a Chrome trace (chrome://tracing, Perfetto)")
+@click.pass_context
+def cli(ctx, profile, trace_out):
+    if profile or trace_out:
+        _enable_profiler()
+        ctx.call_on_close(partial(_finish_profile, profile, trace_out, time.perf_counter_ns(), time.thread_time_ns(),
+                                  ctx.invoked_subcommand))
+
+class FieldPath:
+    # A ':'-delimited tfvars field path such as 'network:subnets:0:cidr', parsed once by
+    # _compile_field_path and then applied to any number of tfvars dicts. Numeric
+    # segments index into lists and are plain keys in dicts.
+    def __init__(self, expression):
+        self.expression = expression
+        self.parents = tuple(_parse_field_segment(segment) for segment in expression.split(':')[:-1])
+        self.last = _parse_field_segment(expression.split(':')[-1])
+
+    def _step(self, container, segment):
+        key, index = segment
+        if isinstance(container, list):
+            if index is None:
+                raise KeyError(f"{self.expression}: '{key}' is not a list index")
+            return container[index]
+        return container[key]
+
+    def _parent(self, tfvars_dict, create=False):
+        container = tfvars_dict
+        for segment in self.parents:
+            if create and isinstance(container, dict) and segment[0] not in container:
+                container[segment[0]] = {}
+            container = self._step(container, segment)
+        return container
+
+    def get(self, tfvars_dict):
+        return self._step(self._parent(tfvars_dict), self.last)
+
+    def exists(self, tfvars_dict):
+        try:
+            self.get(tfvars_dict)
+            return True
+        except (KeyError, IndexError, TypeError):
+            return False
+
+    def set(self, tfvars_dict, value):
+        # Missing intermediate dicts are created
+        container = self._parent(tfvars_dict, create=True)
+        key, index = self.last
+        if isinstance(container, list):
+            container[index if index is not None else key] = value
+        else:
+            container[key] = value
+
+    def delete(self, tfvars_dict):
+        container = self._parent(tfvars_dict)
+        key, index = self.last
+        container.pop(index if isinstance(container, list) and index is not None else key)
+
+def _parse_field_segment(segment):
+    return segment, int(segment) if segment.isdigit() else None
 
-def _split_filters(filters):
-    return {split_filter[0]:split_filter[1]
-            for each_filter in filters.split(',')
-            for split_filter in each_filter.split(':')}
+@lru_cache(maxsize=None)
+def _compile_field_path(expression) -> FieldPath:
+    return FieldPath(expression)
 
-def _compile_paths(filters,exclude_accounts,shortened):
-    accounts_path = 'accounts'
-    tfvars_paths = []
-    filters_dict = _split_filters(filters) if filters else {}
+_FILTER_TOKEN = re.compile(r'\s*(?:(?P<punct>[(),])|"(?P<double>[^"]*)"|\'(?P<single>[^\']*)\'|(?P<word>[^\s(),"\']+))')
 
-    for entry in os.scandir(accounts_path):
-        if exclude_accounts and entry.path.split("/")[-1] in exclude_accounts:
+class FilterQuery:
+    # A compiled --filters expression. Terms are
+    #   {field}:{value}         equality; '*' and '?' in an unquoted value are wildcards
+    #   {field}~{regex}         regex search, e.g. name~'^prod-(a|b)'
+    #   {field} in (a,b,...)    set membership
+    # combined with 'and' (or ','), 'or', 'not' and parentheses. Fields are tfvars field
+    # paths and values may contain ':' too, so the first ':' that follows a field some leaf
+    # has separates the value (see _split_term). Leaves without a field never match a term
+    # on it. fields lists the field of each term, as split by the last evaluate.
+    def __init__(self, expression):
+        self.expression = expression
+        self.fields = []
+        self._terms = []
+        self._tokens = []
+        position = 0
+        while position < len(expression) and (match := _FILTER_TOKEN.match(expression, position)):
+            kind = match.lastgroup
+            self._tokens.append(('quoted' if kind in ('double', 'single') else kind, match.group(kind)))
+            position = match.end()
+        if expression[position:].strip():
+            self._error(f"unterminated quote at {expression[position:].strip()!r}")
+        self._position = 0
+        self.root = self._parse_or()
+        if self._position < len(self._tokens):
+            self._error(f"unexpected {self._tokens[self._position][1]!r}")
+
+    def _error(self, message):
+        raise click.BadParameter(f"{message} in {self.expression!r}", param_hint="'--filters'")
+
+    def _peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            self._error("unexpected end of filters")
+        self._position += 1
+        return token
+
+    def _accept(self, kind, text):
+        token_kind, token_text = self._peek()
+        if token_kind == kind and (token_text.lower() if kind == 'word' else token_text) == text:
+            self._position += 1
+            return True
+        return False
+
+    def _expect(self, kind, text):
+        if not self._accept(kind, text):
+            self._error(f"expected {text!r}")
+
+    def _parse_or(self):
+        children = [self._parse_and()]
+        while self._accept('word', 'or'):
+            children.append(self._parse_and())
+        return children[0] if len(children) == 1 else ('or', children)
+
+    def _parse_and(self):
+        children = [self._parse_not()]
+        while self._accept('word', 'and') or self._accept('punct', ','):
+            children.append(self._parse_not())
+        return children[0] if len(children) == 1 else ('and', children)
+
+    def _parse_not(self):
+        if self._accept('word', 'not'):
+            return ('not', self._parse_not())
+        if self._accept('punct', '('):
+            node = self._parse_or()
+            self._expect('punct', ')')
+            return node
+        return self._parse_term()
+
+    def _parse_term(self):
+        kind, text = self._next()
+        if kind != 'word':
+            self._error(f"expected a filter term, found {text!r}")
+        if '~' in text:
+            field, pattern = text.split('~', 1)
+            if not pattern and self._peek()[0] == 'quoted':
+                pattern = self._next()[1]
+            try:
+                term = ('term', field, 'regex', re.compile(pattern))
+            except re.error as error:
+                self._error(f"invalid regex {pattern!r} ({error})")
+        elif text.endswith(':') and self._peek()[0] == 'quoted':
+            field = text[:-1]
+            term = ('term', field, 'eq', self._next()[1])
+        elif ':' in text:
+            # Every ':' could separate the value, so the split waits for the index
+            term = ('split', tuple((text[:colon], text[colon + 1:])
+                                   for colon, character in enumerate(text) if character == ':'))
+            field = term[1][-1][0]
+        else:
+            field = text
+            self._expect('word', 'in')
+            self._expect('punct', '(')
+            values = set()
+            while True:
+                value_kind, value = self._next()
+                if value_kind not in ('word', 'quoted'):
+                    self._error(f"expected a value, found {value!r}")
+                values.add(value)
+                if self._accept('punct', ')'):
+                    break
+                self._expect('punct', ',')
+            term = ('term', field, 'in', frozenset(values))
+        if field not in self.fields:
+            self.fields.append(field)
+        self._terms.append(term)
+        return term
+
+    def evaluate(self, inverted_index, all_paths):
+        self.fields = list(dict.fromkeys(_split_term(term, inverted_index)[1] for term in self._terms))
+        return _evaluate_filter(self.root, inverted_index, all_paths)
+
+def _split_term(term, inverted_index):
+    # A field:value term is split at the first ':' that follows a field some leaf has, so
+    # role_arn:arn:aws:iam::111111111111:role/x compares role_arn. If no leaf has any of
+    # the candidate fields, the last ':' splits it and the term matches nothing.
+    if term[0] != 'split':
+        return term
+    field, value = next(((field, value) for field, value in term[1] if inverted_index.values(field)), term[1][-1])
+    return ('term', field, 'glob' if any(wildcard in value for wildcard in '*?[') else 'eq', value)
+
+def _evaluate_filter(node, inverted_index, all_paths):
+    # Every node evaluates to a set of leaf paths; sets are never mutated in place
+    # because term results are shared with the inverted index
+    if node[0] == 'and':
+        paths = None
+        for child in node[1]:
+            child_paths = _evaluate_filter(child, inverted_index, all_paths)
+            paths = child_paths if paths is None else paths & child_paths
+            if not paths:
+                break
+        return paths
+    if node[0] == 'or':
+        return set().union(*(_evaluate_filter(child, inverted_index, all_paths) for child in node[1]))
+    if node[0] == 'not':
+        return all_paths - _evaluate_filter(node[1], inverted_index, all_paths)
+
+    _, field, match, operand = _split_term(node, inverted_index)
+    values_to_paths = inverted_index.values(field)
+    if match == 'eq':
+        return values_to_paths.get(operand, set())
+    if match == 'in':
+        return set().union(*(values_to_paths.get(value, ()) for value in operand))
+    if match == 'glob':
+        return set().union(*(paths for value, paths in values_to_paths.items()
+                             if fnmatch.fnmatchcase(value, operand)))
+    return set().union(*(paths for value, paths in values_to_paths.items() if operand.search(value)))
+
+@lru_cache(maxsize=None)
+def _compile_filters(filters) -> FilterQuery:
+    return FilterQuery(filters)
+
+class _InvertedIndex:
+    # tfvars field -> value -> set of leaf paths, loaded from the index's flattened
+    # tfvars table for only the fields a query uses. Values are matched as text:
+    # strings as-is, anything else as JSON (3, true, null).
+    def __init__(self, index):
+        self.index = index
+        self.fields = {}
+
+    def values(self, field):
+        if field not in self.fields:
+            values_to_paths = {}
+            for value, path in self.index.execute("SELECT value, path FROM tfvars WHERE key = ?", (field,)):
+                if value.startswith('"'):
+                    value = json.loads(value)
+                values_to_paths.setdefault(value, set()).add(path)
+            self.fields[field] = values_to_paths
+        return self.fields[field]
+
+def _cache_dir():
+    cache_dir = os.environ.get('PARATERRA_CACHE_DIR', '.paraterra')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def _index_path():
+    return os.path.join(_cache_dir(), 'index.sqlite')
+
+def _open_index():
+    index = sqlite3.connect(_index_path())
+    if index.execute("PRAGMA user_version").fetchone()[0] != INDEX_SCHEMA_VERSION:
+        index.executescript("""
+            DROP TABLE IF EXISTS leaves;
+            DROP TABLE IF EXISTS tfvars;
+            CREATE TABLE leaves (path TEXT PRIMARY KEY, account TEXT, region TEXT, uuid TEXT,
+                                 mtime_ns INTEGER, size INTEGER, sha256 TEXT, tfvars TEXT);
+            CREATE TABLE tfvars (path TEXT, key TEXT, value TEXT);
+            CREATE INDEX tfvars_key_value ON tfvars (key, value);
+            CREATE INDEX tfvars_path ON tfvars (path);
+        """)
+        index.execute(f"PRAGMA user_version = {INDEX_SCHEMA_VERSION}")
+        index.commit()
+    return index
+
+def _flatten_tfvars(value, prefix=''):
+    # Nested keys are joined with ':' (the same syntax update-tfvars uses), list items by index
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        yield prefix, json.dumps(value)
+        return
+    for key, nested_value in items:
+        yield from _flatten_tfvars(nested_value, f"{prefix}:{key}" if prefix else str(key))
+
+def _scan_leaves():
+    for account_entry in os.scandir(ACCOUNTS_PATH):
+        for region_entry in os.scandir(account_entry.path):
+            for uuid_entry in os.scandir(region_entry.path):
+                yield uuid_entry.path, account_entry.name, region_entry.name, uuid_entry.name
+
+def _index_changes(index):
+    indexed = {path: (mtime_ns, size, sha256) for path, mtime_ns, size, sha256
+               in index.execute("SELECT path, mtime_ns, size, sha256 FROM leaves")}
+    leaf_count = 0
+    changed_leaves = []
+    for leaf in _scan_leaves():
+        leaf_count += 1
+        stat = os.stat(os.path.join(leaf[0], TFVARS_FILE_NAME))
+        indexed_stat = indexed.pop(leaf[0], None)
+        if not indexed_stat or indexed_stat[:2] != (stat.st_mtime_ns, stat.st_size):
+            changed_leaves.append((leaf, stat, indexed_stat))
+    return leaf_count, changed_leaves, list(indexed)
+
+def _refresh_index(index):
+    with _phase('scan tfvars') as event:
+        leaf_count, changed_leaves, removed_paths = _index_changes(index)
+        event['files'] = leaf_count
+    with _phase('load tfvars') as event:
+        parsed_count = _load_changed_tfvars(index, changed_leaves, removed_paths)
+        event['files'] = len(changed_leaves)
+        event['parsed'] = parsed_count
+        event['bytes'] = sum(stat.st_size for _, stat, _ in changed_leaves)
+    return {'leaves': leaf_count, 'parsed': parsed_count, 'removed': len(removed_paths)}
+
+def _load_changed_tfvars(index, changed_leaves, removed_paths):
+    parsed_count = 0
+    for (path, account, region, uuid), stat, indexed_stat in changed_leaves:
+        with open(os.path.join(path, TFVARS_FILE_NAME), 'rb') as tfvars_file:
+            content = tfvars_file.read()
+        sha256 = hashlib.sha256(content).hexdigest()
+        if indexed_stat and indexed_stat[2] == sha256:
+            index.execute("UPDATE leaves SET mtime_ns = ?, size = ? WHERE path = ?",
+                          (stat.st_mtime_ns, stat.st_size, path))
             continue
-        for path_with_region in os.scandir(entry.path):
-            for path_with_region_and_uuid in os.scandir(path_with_region):
-                tfvars_path = f'{path_with_region_and_uuid.path}'
-                with open(f"{tfvars_path}/terraform.tfvars.json") as tfvars_file:
-                    tfvars_dict = json.load(tfvars_file)
-                    all_match = True
-                    for key, value in filters_dict.items():
-                        if tfvars_dict[key] != value:
-                            all_match = False
-                    if not all_match: 
-                        continue
-                    if shortened:
-                        shortened_path = f"{'/'.join(tfvars_path.split('/')[4:])}"
-                        tfvars_paths.append(shortened_path)
-                    else:
-                        tfvars_paths.append(tfvars_path)
-    return tfvars_paths
-
-def _get_accounts(filters):
-    tfvars_paths = _compile_paths(filters=filters,
-                                  exclude_accounts=None,
-                                  shortened=True)
-    return [path.split('/')[1] for path in tfvars_paths]
-
-def _filter_and_map_accounts_to_full_paths(filters):
-    tfvars_paths = _compile_paths(filters=filters,
-                                  exclude_accounts=None,
-                                  shortened=False)
-    accounts_to_full_paths = {}
-    for path in tfvars_paths:
-        account = path.split('/')[5]
-        accounts_to_full_paths[account] = f"{path}/terraform.tfvars.json"
-    return accounts_to_full_paths
+        tfvars_dict = json.loads(content)
+        index.execute("INSERT OR REPLACE INTO leaves VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                      (path, account, region, uuid, stat.st_mtime_ns, stat.st_size,
+                       sha256, json.dumps(tfvars_dict)))
+        index.execute("DELETE FROM tfvars WHERE path = ?", (path,))
+        index.executemany("INSERT INTO tfvars VALUES (?, ?, ?)",
+                          ((path, key, value) for key, value in _flatten_tfvars(tfvars_dict)))
+        parsed_count += 1
+    for path in removed_paths:
+        index.execute("DELETE FROM leaves WHERE path = ?", (path,))
+        index.execute("DELETE FROM tfvars WHERE path = ?", (path,))
+    index.commit()
+    return parsed_count
+
+class _BatchState:
+    # What the commands of one paraterra batch share: the index is refreshed and read
+    # once, filter terms, decoded tfvars and plan summaries are reused across commands
+    def __init__(self):
+        self.index = None
+        self.rows = None
+        self.inverted_index = None
+        self.leaves = {}
+        # (path, mtime_ns, size, use_cache) -> plan summary
+        self.plan_summaries = {}
+
+    def invalidate_leaves(self):
+        # After tfvars files change, the next command refreshes the index again
+        self.rows = None
+        self.inverted_index = None
+        self.leaves = {}
+
+    def close(self):
+        if self.index:
+            self.index.close()
+
+_BATCH = None
+
+@contextmanager
+def _indexed_leaf_rows():
+    # Yields (path, account, region, uuid, tfvars JSON) of every tfvars file in path order
+    # and an _InvertedIndex over them, from a refreshed index
+    if _BATCH is None:
+        with closing(_open_index()) as index:
+            _refresh_index(index)
+            with _phase('read index') as event:
+                rows = index.execute("SELECT path, account, region, uuid, tfvars FROM leaves ORDER BY path").fetchall()
+                event['rows'] = len(rows)
+            yield rows, _InvertedIndex(index)
+        return
+    if _BATCH.rows is None:
+        _BATCH.index = _BATCH.index or _open_index()
+        _refresh_index(_BATCH.index)
+        with _phase('read index') as event:
+            _BATCH.rows = _BATCH.index.execute(
+                "SELECT path, account, region, uuid, tfvars FROM leaves ORDER BY path").fetchall()
+            event['rows'] = len(_BATCH.rows)
+        _BATCH.inverted_index = _InvertedIndex(_BATCH.index)
+    yield _BATCH.rows, _BATCH.inverted_index
+
+def _leaf_from_row(path, account, region, uuid, tfvars):
+    # Leaves are never modified (update-tfvars edits a deep copy), so a batch shares them
+    if _BATCH is None:
+        return Leaf(account=account, region=region, uuid=uuid, path=path, tfvars=json.loads(tfvars))
+    if path not in _BATCH.leaves:
+        _BATCH.leaves[path] = Leaf(account=account, region=region, uuid=uuid, path=path, tfvars=json.loads(tfvars))
+    return _BATCH.leaves[path]
+
+def _resolve_selection(filters, exclude_accounts=None, changed_since=None, changes_config=None) -> Selection:
+    filter_query = _compile_filters(filters) if filters else None
+    changed_files = _git_changed_files(changed_since) if changed_since else None
+    with _indexed_leaf_rows() as (rows, inverted_index):
+        with _phase('query index') as event:
+            if changed_files is not None:
+                affected_paths = _affected_leaf_paths(changed_files, _read_changes_config(changes_config),
+                                                      inverted_index, [row[0] for row in rows])
+                print(f"{len(changed_files)} files changed since {changed_since}, "
+                      f"{len(affected_paths)} of {len(rows)} leaves affected", file=sys.stderr)
+                rows = [row for row in rows if row[0] in affected_paths]
+            if filter_query:
+                matched_paths = filter_query.evaluate(inverted_index, {row[0] for row in rows})
+                rows = [row for row in rows if row[0] in matched_paths]
+            event['leaves'] = len(rows)
+    return [_leaf_from_row(*row) for row in rows if not exclude_accounts or row[1] not in exclude_accounts]
+
+def _git_changed_files(ref):
+    # Paths, relative to the current directory, of files changed between ref and the
+    # working tree (or within a range); renamed files count under both names
+    import subprocess
+    git_diff = subprocess.run(['git', 'diff', '--name-status', '-z', ref, '--'], capture_output=True, text=True)
+    toplevel = subprocess.run(['git', 'rev-parse', '--show-toplevel'], capture_output=True, text=True)
+    if git_diff.returncode or toplevel.returncode:
+        raise click.ClickException(f"git diff {ref} failed: {(git_diff.stderr or toplevel.stderr).strip()}")
+    changed_files = []
+    fields = iter(git_diff.stdout.split('\0')[:-1])
+    for status in fields:
+        # Renames and copies are followed by the source and destination paths
+        for path in [next(fields), next(fields)] if status[0] in 'RC' else [next(fields)]:
+            changed_files.append(os.path.relpath(os.path.join(toplevel.stdout.strip(), path)).replace(os.sep, '/'))
+    return changed_files
+
+def _read_changes_config(changes_config):
+    if not changes_config:
+        if not os.path.exists(CHANGES_CONFIG_FILE_NAME):
+            return {}
+        changes_config = CHANGES_CONFIG_FILE_NAME
+    with open(changes_config) as config_file:
+        globs_to_filters = json.load(config_file)
+    if not isinstance(globs_to_filters, dict) or \
+            not all(filters is None or isinstance(filters, str) for filters in globs_to_filters.values()):
+        raise click.ClickException(f"{changes_config} must map globs to filter expressions or null")
+    return globs_to_filters
+
+def _affected_leaf_paths(changed_files, globs_to_filters, inverted_index, leaf_paths) -> Set[str]:
+    # Files under a leaf affect that leaf, files higher up in ACCOUNTS_PATH every leaf below
+    # them, and files elsewhere the leaves their first matching glob selects (all if none)
+    accounts_prefix = os.path.basename(ACCOUNTS_PATH) + '/'
+    affected_prefixes = set()
+    affected_paths = set()
+    for changed_file in changed_files:
+        if changed_file.startswith(accounts_prefix):
+            # Only the account, region and uuid directories identify leaves
+            directories = changed_file.split('/')[1:-1][:3]
+            affected_prefixes.add(os.path.join(ACCOUNTS_PATH, *directories))
+            continue
+        pattern = next((pattern for pattern in globs_to_filters if fnmatch.fnmatchcase(changed_file, pattern)), None)
+        if pattern is None:
+            print(f"{changed_file} affects every leaf", file=sys.stderr)
+            return set(leaf_paths)
+        if globs_to_filters[pattern] is not None:
+            try:
+                filter_query = _compile_filters(globs_to_filters[pattern])
+            except click.BadParameter as error:
+                raise click.ClickException(f"filters for {pattern}: {error.message}")
+            affected_paths |= filter_query.evaluate(inverted_index, set(leaf_paths))
+    for leaf_path in leaf_paths:
+        if leaf_path in affected_prefixes or \
+                any(leaf_path.startswith(prefix + os.sep) for prefix in affected_prefixes):
+            affected_paths.add(leaf_path)
+    return affected_paths
+
+def _shortened_path(account, region, uuid):
+    return '/'.join([os.path.basename(ACCOUNTS_PATH), account, region, uuid])
+
+def _compile_paths(selection, shortened):
+    with _phase('compile paths', leaves=len(selection)):
+        if shortened:
+            return [_shortened_path(leaf.account, leaf.region, leaf.uuid) for leaf in selection]
+        return [leaf.path for leaf in selection]
+
+def _get_accounts(selection):
+    return [leaf.account for leaf in selection]
+
+def _map_accounts_to_leaves(selection):
+    return {leaf.account: leaf for leaf in selection}
 
 def _create_generated_file_path(account, file_name):
     generated_files_dir_path = os.path.join(os.path.dirname(__file__), 'generated_files', account)
@@ -89,36 +740,117 @@ def _read_file(source_path,
             for i, field_name in enumerate(source_field_names):
                 accounts_to_fields_to_update[row['account']][field_name] = {}
                 accounts_to_fields_to_update[row['account']][field_name]['value'] = row[field_name]
-                if target_field_names:
-                    accounts_to_fields_to_update[row['account']][field_name]['target_field_name'] = target_field_names[i]
+                target_field_name = target_field_names[i] if target_field_names else field_name
+                accounts_to_fields_to_update[row['account']][field_name]['field_path'] = \
+                    _compile_field_path(target_field_name)
     return accounts_to_fields_to_update
 
-def _create_from_input(from_list, delete_fields, filters) -> MapOfMaps:
-    accounts = _get_accounts(filters)
+def _create_from_input(from_list, delete_fields, selection) -> MapOfMaps:
+    accounts = _get_accounts(selection)
     accounts_to_fields_to_update = {}
     for account in accounts:
+        accounts_to_fields_to_update[account] = {}
         if from_list:
             for item in from_list:
-                field_name, value = item.split("=")
-                accounts_to_fields_to_update[account] = {field_name:{'value':value}}
+                field_name, value = item.split("=", 1)
+                accounts_to_fields_to_update[account][field_name] = {'value':value,
+                                                                     'field_path':_compile_field_path(field_name)}
         elif delete_fields:
             for field_name in delete_fields:
-                accounts_to_fields_to_update[account] = {field_name:{'delete':True}}
+                accounts_to_fields_to_update[account][field_name] = {'delete':True,
+                                                                     'field_path':_compile_field_path(field_name)}
     return accounts_to_fields_to_update
 
 @cli.command(cls=FiltersCommand, help="Prints list of paths to tfvars files")
 @click.option("--exclude-accounts", required=False, default=None, help="Comma-delimited list of accounts to exclude")
 @click.option("--shortened", is_flag=True, required=False, help="Returns shortened paths")
-def paths(filters, exclude_accounts, shortened):
+@changed_since_options
+@output_option
+def paths(filters, exclude_accounts, shortened, changed_since, changes_config, output):
     exclude_accounts = exclude_accounts.split(",") if exclude_accounts else None
-    tfvars_paths = _compile_paths(filters=filters,
-                                  exclude_accounts=exclude_accounts,
-                                  shortened=shortened)
-    print(tfvars_paths)
+    selection = _resolve_selection(filters, exclude_accounts=exclude_accounts,
+                                   changed_since=changed_since, changes_config=changes_config)
+    tfvars_paths = _compile_paths(selection=selection, shortened=shortened)
+    _print_list(tfvars_paths, 'path', output)
 
 @cli.command(cls=FiltersCommand,help='Prints list of account ids')
-def accounts(filters):
-    print(_get_accounts(filters))
+@output_option
+def accounts(filters, output):
+    _print_list(_get_accounts(_resolve_selection(filters)), 'account', output)
+
+def _print_list(values, header, output):
+    # text keeps the Python list format that existing pipelines parse
+    if output == 'text':
+        print(values)
+        return
+    with RowWriter(output, [header], scalar=True) as writer:
+        for value in values:
+            writer.write({header: value})
+
+@cli.command(cls=FiltersCommand, help="Prints a GitHub Actions matrix of shortened tfvars paths packed into \
+             shards of roughly equal cost, one matrix job per shard")
+@click.option("--exclude-accounts", required=False, default=None, help="Comma-delimited list of accounts to exclude")
+@click.option("--shards", type=click.IntRange(1, GITHUB_MATRIX_MAX_JOBS), required=True,
+              help=f"Number of shards (matrix jobs), at most {GITHUB_MATRIX_MAX_JOBS}")
+@click.option("--cost-by", type=click.Choice(LEAF_COST_MEASURES), default='seconds', show_default=True,
+              help="Leaf cost recorded by parse-plans to balance shards by: plan duration, number of resources in \
+              the plan, or uniform. Leaves without a recorded cost are given the mean cost")
+@click.option("--costs-path", required=False, help=f"Leaf costs file written by parse-plans. Defaults to \
+              {LEAF_COSTS_FILE_NAME} in the cache directory")
+@changed_since_options
+def matrix(filters, exclude_accounts, shards, cost_by, costs_path, changed_since, changes_config):
+    exclude_accounts = exclude_accounts.split(",") if exclude_accounts else None
+    selection = _resolve_selection(filters, exclude_accounts=exclude_accounts,
+                                   changed_since=changed_since, changes_config=changes_config)
+    leaf_costs = _read_leaf_costs(costs_path or _leaf_costs_path())
+    shard_entries = _shard_selection(selection, leaf_costs, shards, cost_by)
+    # The matrix goes to stdout for $GITHUB_OUTPUT, the shard table to stderr for the log
+    print(_tabulate([[entry['shard'], len(entry['tfvars_paths'].split()), entry['cost']]
+                             for entry in shard_entries],
+                            headers=['shard', 'leaves', f'cost ({cost_by})'], disable_numparse=True), file=sys.stderr)
+    print(json.dumps(shard_entries))
+
+def _shard_selection(selection, leaf_costs, shards, cost_by):
+    tfvars_paths = _compile_paths(selection=selection, shortened=True)
+    if cost_by == 'uniform':
+        costs = dict.fromkeys(tfvars_paths, 1)
+    else:
+        known_costs = [leaf_costs[path][cost_by] for path in tfvars_paths if cost_by in leaf_costs.get(path, {})]
+        default_cost = sum(known_costs) / len(known_costs) if known_costs else 1
+        # Every leaf costs at least 1, since even an empty plan pays for init and refresh
+        costs = {path: max(leaf_costs.get(path, {}).get(cost_by, default_cost), 1) for path in tfvars_paths}
+
+    # Longest processing time first: each leaf, most expensive first, goes to the shard
+    # with the least cost so far, which keeps the longest shard within 4/3 of optimal
+    shard_heap = [(0, shard, []) for shard in range(min(shards, len(tfvars_paths)))]
+    for path in sorted(tfvars_paths, key=lambda path: (-costs[path], path)):
+        cost, shard, shard_paths = heapq.heappop(shard_heap)
+        shard_paths.append(path)
+        heapq.heappush(shard_heap, (cost + costs[path], shard, shard_paths))
+
+    return [{'shard': shard + 1, 'cost': round(cost, 2), 'tfvars_paths': ' '.join(sorted(shard_paths))}
+            for cost, shard, shard_paths in sorted(shard_heap, key=lambda entry: entry[1])]
+
+def _leaf_costs_path():
+    return os.path.join(_cache_dir(), LEAF_COSTS_FILE_NAME)
+
+def _read_leaf_costs(costs_path):
+    if not os.path.exists(costs_path):
+        return {}
+    with open(costs_path) as costs_file:
+        return json.load(costs_file)
+
+def _record_leaf_costs(plan_summaries, costs_path):
+    # Costs of leaves missing from this run are kept, so partial runs refine the model
+    leaf_costs = _read_leaf_costs(costs_path)
+    for plan_summary in plan_summaries:
+        leaf_cost = {'resources': sum(plan_summary['resource_change_counts'].values())}
+        if plan_summary.get('plan_seconds') is not None:
+            leaf_cost['seconds'] = plan_summary['plan_seconds']
+        # Merged, so a plan summarized without --plan-seconds keeps the duration recorded before
+        leaf_costs.setdefault(_shortened_path(plan_summary['account'], plan_summary['region'],
+                                              plan_summary['uuid']), {}).update(leaf_cost)
+    _write_json_atomically(costs_path, leaf_costs, indent=2)
 
 @cli.command(cls=FiltersCommand, help="Updates tfvars files with \
              passed fields")
@@ -129,7 +861,7 @@ def accounts(filters):
 @optgroup.option('--from-list', help="Comma delimited list of field names and values \
                  to apply. Field names can be arbitrarily nested via delimiting names \
                  with colons: '{field_name1}={field_name1},{outer_field_name}:\
-                 {inner_field_name}={field_value2}'")
+                 {inner_field_name}={field_value2}'. Numeric names index into lists")
 @optgroup.option('--delete-fields', help="Deletes passed field names, of form comma \
               delimited list of arbitrarily nested field names, delimited by colon: \
               '{outer_field}:{inner_field},{other_field}'")
@@ -140,6 +872,7 @@ def accounts(filters):
               --source-field-names) of field names in target to update, if different from \
               --source-field-names")
 @click.option('--replace', is_flag=True, help="Updates actual tfvars files in place")
+@click.option('--jobs', type=int, default=8, help="Number of tfvars files updated concurrently")
 def update_tfvars(filters,
                   from_csv,
                   from_json,
@@ -148,11 +881,12 @@ def update_tfvars(filters,
                   source_path,
                   source_field_names,
                   target_field_names,
-                  replace):
+                  replace,
+                  jobs):
     source_field_names = source_field_names.split(',') if source_field_names else None
     target_field_names = target_field_names.split(',') if target_field_names else None
     from_list = from_list.split(',') if from_list else None
-    delete_fields = delete_fields.split(":") if delete_fields else None
+    delete_fields = delete_fields.split(",") if delete_fields else None
 
     if source_field_names and target_field_names:
         if len(source_field_names) != len(target_field_names):
@@ -165,7 +899,7 @@ def update_tfvars(filters,
               --from-csv or --from-json")
         sys.exit(1)
 
-    accounts_to_full_paths = _filter_and_map_accounts_to_full_paths(filters)
+    selection = _resolve_selection(filters)
 
     if from_csv or from_json:
         accounts_to_fields_to_update = _read_file(source_path=source_path,
@@ -176,224 +910,1068 @@ def update_tfvars(filters,
     elif from_list or delete_fields:
         accounts_to_fields_to_update = _create_from_input(from_list=from_list, 
                                                           delete_fields=delete_fields, 
-                                                          filters=filters)
+                                                          selection=selection)
     else:
         print("Error: must use one of --from-csv, --from-json, --from-list, or --delete-fields")
         sys.exit(1)
     
-    _update_tfvars(accounts_to_full_paths=accounts_to_full_paths,
-                   accounts_to_fields_to_update=accounts_to_fields_to_update,
-                   replace=replace)   
-
-def _update_tfvars(accounts_to_full_paths, accounts_to_fields_to_update, replace):
-    for account, path in accounts_to_full_paths.items():
-        with open(path) as tfvars_file:
-            for field_name, field_details in accounts_to_fields_to_update[account].items():
-                tfvars_dict = json.load(tfvars_file)
-                if field_details.get('target_field_name'):
-                    target_field_name = field_details.get('target_field_name')
-                    if len(target_field_name.split(":")) > 1:
-                        _update_nested_field(field_name_list=target_field_name.split(":"),
-                                             field_details=field_details,
-                                             tfvars_dict=tfvars_dict)
-                    else:
-                        _update_or_delete(field_name=field_details['target_field_name'],
-                                          dict_location=tfvars_dict,
-                                          field_details=field_details)    
-                else:
-                    if len(field_name.split(":")) > 1:
-                        _update_nested_field(field_name_list=field_name.split(":"),
-                                             field_details=field_details,
-                                             tfvars_dict=tfvars_dict)
-                    else:
-                        _update_or_delete(field_name=field_name,
-                                          dict_location=tfvars_dict,
-                                          field_details=field_details)
-        generated_file_path = _create_generated_file_path(account, "terraform.tfvars.json")
-        with open(generated_file_path, "w", encoding='utf-8') as generated_updated_tfvars_file:
-            json.dump(tfvars_dict, generated_updated_tfvars_file, indent=4)    
+    updated = _update_tfvars(accounts_to_leaves=_map_accounts_to_leaves(selection),
+                             accounts_to_fields_to_update=accounts_to_fields_to_update,
+                             replace=replace,
+                             jobs=jobs)
+    if not updated:
+        sys.exit(1)
+
+def _update_tfvars(accounts_to_leaves, accounts_to_fields_to_update, replace, jobs=8):
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(
+            lambda account: _update_account_tfvars(account=account,
+                                                   leaf=accounts_to_leaves[account],
+                                                   fields_to_update=accounts_to_fields_to_update.get(account),
+                                                   replace=replace),
+            accounts_to_leaves))
+
+    print(_tabulate(results, headers=["account", "result", "fields"], disable_numparse=True))
+    if _BATCH and replace:
+        _BATCH.invalidate_leaves()
+    return all(result[1] != 'failed' for result in results)
+
+def _update_account_tfvars(account, leaf, fields_to_update, replace):
+    if not fields_to_update:
+        return [account, 'no updates', '']
+    fields = ','.join(fields_to_update)
+    tfvars_dict = copy.deepcopy(leaf.tfvars)
+    try:
+        _apply_field_updates(tfvars_dict, fields_to_update)
+    except (KeyError, IndexError, TypeError) as error:
+        return [account, 'failed', f"{fields}: {error!r}"]
+    if tfvars_dict == leaf.tfvars:
+        return [account, 'unchanged', fields]
+
+    with _phase('write tfvars', account=account, files=2 if replace else 1):
+        _write_json_atomically(_create_generated_file_path(account, TFVARS_FILE_NAME), tfvars_dict, indent=4)
         if replace:
-            with open(path, "w") as real_updated_tfvars_file:
-                json.dump(tfvars_dict, real_updated_tfvars_file, indent=4) 
-
-def _update_nested_field(field_name_list, field_details, tfvars_dict):
-    nested_location = tfvars_dict
-    final_item = field_name_list[-1]
-    for target_field_name_next in field_name_list:
-        if target_field_name_next == final_item:
-            _update_or_delete(field_name=target_field_name_next,
-                              field_details=field_details,
-                              dict_location=nested_location)
+            _write_json_atomically(os.path.join(leaf.path, TFVARS_FILE_NAME), tfvars_dict, indent=4)
+    return [account, 'replaced' if replace else 'generated', fields]
+
+def _apply_field_updates(tfvars_dict, fields_to_update):
+    for field_details in fields_to_update.values():
+        if field_details.get('delete'):
+            field_details['field_path'].delete(tfvars_dict)
         else:
-            nested_location = nested_location[target_field_name_next]
+            field_details['field_path'].set(tfvars_dict, field_details['value'])
 
-def _update_or_delete(field_name, field_details, dict_location):
-    if field_details.get('delete'):
-        dict_location.pop(field_name)
-    else:
-        dict_location[field_name] = field_details['value']
+def _write_json_atomically(path, content, indent=None):
+    # Readers see either the old or the new file, never a partially written one
+    temp_path = os.path.join(os.path.dirname(path),
+                             f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(temp_path, "w", encoding='utf-8') as temp_file:
+            json.dump(content, temp_file, indent=indent)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 @cli.command(help="")
 @click.option('--no-deletes', is_flag=True, required=False, help="Fails pipeline if changes include deletes")
 @click.option('--no-creates', is_flag=True, required=False, help="Fails pipeline if changes include creates")
 @click.option('--no-drift', is_flag=True, required=False, help="Fails pipeline if changes include drift")
-@click.option('--allowed-props', required=False, help="Comma delimited list of properties that are allowed to have changes (in any resource)")
-@click.option('--artifacts-path', required=True, help="Artifacts path for parsing")
-def parse_plans(no_deletes,no_creates,no_drift,allowed_props,artifacts_path):
+@click.option('--allowed-props', required=False, help="Comma delimited list of properties that are allowed to have changes \
+              (in any resource). Nested properties are paths like 'tags.CostCenter' or 'ingress[2].cidr_blocks'; \
+              a property allows everything nested under it and '*' matches anything")
+@click.option('--artifacts-path', required=False, help="Artifacts path for parsing")
+@click.option('--summaries-path', required=False, help=f"Path to plan summaries written by summarize-plan, \
+              read from files ending in {PLAN_SUMMARY_FILE_SUFFIX}. Plans in --artifacts-path are only parsed if they have no summary")
+@click.option('--jobs', type=int, default=1, help="Number of processes used to parse plan files in parallel")
+@click.option('--no-cache', is_flag=True, help="Parses every plan file instead of reusing cached plan summaries")
+@click.option('--stats', is_flag=True, help="Prints fleet-wide totals and percentiles per action")
+@click.option('--outliers', is_flag=True, help="Groups plans by identical change profile and lists plans \
+              outside the largest group")
+@click.option('--costs-path', required=False, help=f"Path of the leaf costs file that matrix balances shards \
+              with, updated with each plan's duration and resource count. Defaults to {LEAF_COSTS_FILE_NAME} \
+              in PARATERRA_CACHE_DIR when it is set; otherwise costs are only recorded with this option")
+@click.option('--html-out', required=False, help="Writes a self-contained HTML report of every plan, with \
+              fleet-wide stats, change profiles, search and filters, and each plan's changed properties")
+@output_option
+def parse_plans(no_deletes,no_creates,no_drift,allowed_props,artifacts_path,summaries_path,jobs,no_cache,stats,outliers,
+                costs_path,html_out,output):
+    if not artifacts_path and not summaries_path:
+        print("Error: at least one of --artifacts-path or --summaries-path is required")
+        sys.exit(1)
+
     valid = _parse_plans(no_deletes=no_deletes,
                  no_creates=no_creates,
                  no_drift=no_drift,
                  allowed_props=allowed_props,
-                 artifacts_path=artifacts_path)
+                 artifacts_path=artifacts_path,
+                 summaries_path=summaries_path,
+                 jobs=jobs,
+                 use_cache=not no_cache,
+                 stats=stats,
+                 outliers=outliers,
+                 costs_path=costs_path or (_leaf_costs_path() if 'PARATERRA_CACHE_DIR' in os.environ else None),
+                 html_out=html_out,
+                 output=output)
     
     if not valid:
         sys.exit(1)
 
-def _parse_plans(no_deletes,no_creates,no_drift,allowed_props,artifacts_path):
+def _parse_plans(no_deletes,no_creates,no_drift,allowed_props,artifacts_path,summaries_path=None,jobs=1,use_cache=False,
+                 stats=False,outliers=False,costs_path=None,html_out=None,output='text'):
     allowed_props = allowed_props.split(",") if allowed_props else None
     
-    all_resource_change_counts, all_resource_drift_counts, all_resource_properties_changed = \
-        _produce_counts(artifacts_path)
+    if output == 'text':
+        plan_summaries = _collect_plan_summaries(artifacts_path=artifacts_path,
+                                                 summaries_path=summaries_path,
+                                                 jobs=jobs,
+                                                 use_cache=use_cache)
+        with _phase('render tables', plans=len(plan_summaries)):
+            _print_plan_tables(plan_summaries)
+    else:
+        # Rows are written in the order plans are read or parsed; summaries are kept
+        # (they are small) for the fleet-wide checks below
+        plan_summaries = []
+        with RowWriter(output, PLAN_ROW_HEADERS) as writer:
+            for plan_summary in _iter_plan_summaries(artifacts_path=artifacts_path,
+                                                     summaries_path=summaries_path,
+                                                     jobs=jobs,
+                                                     use_cache=use_cache):
+                writer.write(_plan_row(plan_summary))
+                plan_summaries.append(plan_summary)
+        plan_summaries.sort(key=_plan_prefix)
+    if costs_path:
+        _record_leaf_costs(plan_summaries, costs_path)
+
+    # Everything else is for humans, so goes to stderr when stdout is machine-readable
+    with redirect_stdout(sys.stderr) if output != 'text' else nullcontext():
+        plan_counts = PlanCounts(plan_summaries)
+        if html_out:
+            _write_html_report(html_out, plan_summaries, plan_counts)
+        with _phase('render tables', plans=len(plan_summaries)):
+            if stats:
+                _print_plan_stats(plan_counts)
+            if outliers:
+                _print_plan_outliers(plan_counts)
     
-    return _validate_changes(no_creates=no_creates,
-                      no_deletes=no_deletes,
-                      no_drift=no_drift,
-                      allowed_props=allowed_props,
-                      all_resource_change_counts=all_resource_change_counts,
-                      all_resource_drift_counts=all_resource_drift_counts,
-                      all_resource_properties_changed=all_resource_properties_changed)
+        with _phase('validate', plans=len(plan_summaries)):
+            return _validate_changes(no_creates=no_creates,
+                              no_deletes=no_deletes,
+                              no_drift=no_drift,
+                              allowed_props=allowed_props,
+                              plan_counts=plan_counts)
+
+def _plan_row(plan_summary):
+    return {'account': plan_summary['account'],
+            'region': plan_summary['region'],
+            'uuid': plan_summary['uuid'],
+            **{f"changes:{action}": count for action, count in plan_summary['resource_change_counts'].items()},
+            **{f"drift:{action}": count for action, count in plan_summary['resource_drift_counts'].items()},
+            'properties_changed': sorted(plan_summary['property_paths_changed'])}
     
-def _produce_counts(artifacts_path) -> (MapOfMaps, MapOfMaps, MapOfSets):
-    resource_change_table = []
-    resource_drift_table = []
+def _produce_counts(artifacts_path, summaries_path=None, jobs=1, use_cache=False) -> (MapOfMaps, MapOfMaps, MapOfSets):
+    plan_summaries = _collect_plan_summaries(artifacts_path=artifacts_path,
+                                             summaries_path=summaries_path,
+                                             jobs=jobs,
+                                             use_cache=use_cache)
+    _print_plan_tables(plan_summaries)
+    return _map_plan_counts(plan_summaries)
+
+def _plan_id(plan_summary):
+    return f"{plan_summary['account']}:{plan_summary['region']}:{plan_summary['uuid'][:6]}..."
+
+def _map_plan_counts(plan_summaries) -> (MapOfMaps, MapOfMaps, MapOfSets):
     all_resource_change_counts = {}
     all_resource_drift_counts = {}
     all_resource_properties_changed = {}
+    for plan_summary in plan_summaries:
+        id = _plan_id(plan_summary)
+        all_resource_change_counts[id] = plan_summary['resource_change_counts']
+        all_resource_drift_counts[id] = plan_summary['resource_drift_counts']
+        all_resource_properties_changed[id] = plan_summary['resource_properties_changed']
+    return (all_resource_change_counts, all_resource_drift_counts, all_resource_properties_changed)
+
+def _print_plan_tables(plan_summaries):
+    resource_change_table = []
+    resource_drift_table = []
+
+    for plan_summary in plan_summaries:
+        account = plan_summary['account']
+        region = plan_summary['region']
+        uuid = f"{plan_summary['uuid'][:6]}..."
+
+        resource_change_row = [account,region,uuid]
+        resource_change_row.extend(list(plan_summary['resource_change_counts'].values()))
+        resource_change_table.append(resource_change_row)
 
-    for plan_json in os.scandir(artifacts_path):
-        resource_change_row = []
-        resource_drift_row = []
-        file_name = plan_json.path.split("/")[2]
-        file_name_parts = file_name.split("+")
-        account = file_name_parts[0]
-        region = file_name_parts[1]
-        uuid = file_name_parts[2]
-        uuid = f"{uuid[:6]}..."
-        
-        resource_change_counts = {
-            'no-op': 0,
-            'create': 0,
-            'read': 0,
-            'update': 0,
-            'delete-create': 0,
-            'create-delete': 0,
-            'delete': 0 
-        }
-
-        resource_properties_changed = set()
-
-        resource_drift_counts = {
-            'no-op': 0,
-            'create': 0,
-            'read': 0,
-            'update': 0,
-            'delete-create': 0,
-            'create-delete': 0,
-            'delete': 0 
-        }
-        with open(f"{plan_json.path}") as plan_file:
-            plan_json = json.load(plan_file)
-            if (resource_changes := plan_json.get("resource_changes")):
-                for resource_change in resource_changes:
-                    actions = resource_change.get("change").get("actions")
-                    action = "-".join(actions)
-                    resource_change_counts[action] += 1
-                    _compare_before_and_after(resource_change, resource_properties_changed)
-            if (resource_drifts := plan_json.get("resource_drift")):
-                for resource_drift in resource_drifts:
-                    actions = resource_drift.get("change").get("actions")
-                    action = "-".join(actions)
-                    resource_drift_counts[action] += 1
-            resource_change_row = [account,region,uuid]
-            resource_change_row.extend(list(resource_change_counts.values()))
-            resource_change_table.append(resource_change_row)
-        
-            resource_drift_row = [account,region,uuid]
-            resource_drift_row.extend(list(resource_drift_counts.values()))
-            resource_drift_table.append(resource_drift_row)
-
-            id = f"{account}:{region}:{uuid}"
-            all_resource_change_counts[id] = resource_change_counts
-            all_resource_drift_counts[id] = resource_drift_counts
-            all_resource_properties_changed[id] = resource_properties_changed
+        resource_drift_row = [account,region,uuid]
+        resource_drift_row.extend(list(plan_summary['resource_drift_counts'].values()))
+        resource_drift_table.append(resource_drift_row)
 
     print("Resource Changes")
-    print(tabulate.tabulate(resource_change_table, headers=["account","region","uuid","no-op","create","read","update","delete-create","create-delete","delete"], disable_numparse=True))
+    print(_tabulate(resource_change_table, headers=PLAN_TABLE_HEADERS, disable_numparse=True))
     print("\n")
     print("Resource Drift")
-    print(tabulate.tabulate(resource_drift_table, headers=["account","region","uuid","no-op","create","read","update","delete-create","create-delete","delete"], disable_numparse=True))
-    
-    return (all_resource_change_counts, all_resource_drift_counts, all_resource_properties_changed)
+    print(_tabulate(resource_drift_table, headers=PLAN_TABLE_HEADERS, disable_numparse=True))
+
+class PlanCounts:
+    # Counts for every plan stored column-wise: one array per action, indexed by plan
+    # number, so fleet-wide checks and statistics scan a few compact columns instead of
+    # a dict per plan
+    def __init__(self, plan_summaries):
+        self.ids = [_plan_id(plan_summary) for plan_summary in plan_summaries]
+        self.changes = {action: array('q', (plan_summary['resource_change_counts'][action]
+                                            for plan_summary in plan_summaries))
+                        for action in ACTIONS}
+        self.drift = {action: array('q', (plan_summary['resource_drift_counts'][action]
+                                          for plan_summary in plan_summaries))
+                      for action in ACTIONS}
+        self.property_paths = [plan_summary['property_paths_changed'] for plan_summary in plan_summaries]
+
+    def nonzero(self, columns):
+        return [index for index, row in enumerate(zip(*columns)) if any(row)]
+
+    def signatures(self):
+        # (changes, drift, properties) per plan. List indexes in property paths are replaced
+        # with [*], so adding a rule to ingress in one leaf and not another only changes counts
+        return [(changes, drift, tuple(sorted({_PROPERTY_PATH_INDEX.sub('[*]', property_path)
+                                               for property_path in property_paths})))
+                for changes, drift, property_paths
+                in zip(zip(*(self.changes[action] for action in PROFILE_ACTIONS)),
+                       zip(*(self.drift[action] for action in PROFILE_ACTIONS)),
+                       self.property_paths)]
+
+def _percentile(sorted_values, percent):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0
+    return sorted_values[max(0, -(-len(sorted_values) * percent // 100) - 1)]
+
+def _plan_stats(columns):
+    # [stat, value per action] rows over one of PlanCounts' changes or drift columns
+    table = []
+    for stat, compute in (("total", sum),
+                          ("plans with any", lambda column: sum(1 for value in column if value)),
+                          ("p50", lambda column: _percentile(sorted(column), 50)),
+                          ("p90", lambda column: _percentile(sorted(column), 90)),
+                          ("max", lambda column: max(column, default=0))):
+        table.append([stat] + [compute(columns[action]) for action in ACTIONS])
+    return table
+
+def _print_plan_stats(plan_counts):
+    for title, columns in (("Resource Change Stats", plan_counts.changes), ("Resource Drift Stats", plan_counts.drift)):
+        print("\n")
+        print(title)
+        print(_tabulate(_plan_stats(columns), headers=["stat"] + ACTIONS, disable_numparse=True))
+
+def _change_profiles(plan_counts):
+    # (signature, plan indexes) of every distinct change profile, largest first
+    plans_by_signature = {}
+    for index, signature in enumerate(plan_counts.signatures()):
+        plans_by_signature.setdefault(signature, []).append(index)
+    return sorted(plans_by_signature.items(), key=lambda group: (-len(group[1]), group[1][0]))
+
+def _print_plan_outliers(plan_counts):
+    profile_table = []
+    outlier_table = []
+    for profile, ((changes, drift, property_paths), indexes) in enumerate(_change_profiles(plan_counts), start=1):
+        profile_table.append([profile, len(indexes)] +
+                             [f"{change}/{drifted}" for change, drifted in zip(changes, drift)] +
+                             [",".join(property_paths)])
+        if profile > 1:
+            outlier_table.extend([plan_counts.ids[index], profile] for index in indexes)
+
+    print("\n")
+    print("Change Profiles (changes/drift)")
+    print(_tabulate(profile_table, headers=["profile", "plans"] + PROFILE_ACTIONS + ["properties changed"],
+                            disable_numparse=True))
+    print("\n")
+    if outlier_table:
+        print("Outliers (plans outside profile 1)")
+        print(_tabulate(outlier_table, headers=["plan", "profile"], disable_numparse=True))
+    else:
+        print("No outliers, all plans share one change profile!")
+
+# Page written by parse-plans --html-out. It has no external resources, so it works
+# offline and as a downloaded artifact. Only $data is substituted, so the script
+# must not use '$' itself.
+HTML_REPORT_TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>paraterra plan report</title>
+<style>
+body { font: 13px system-ui, sans-serif; margin: 16px; color: #1f2328; }
+h1 { font-size: 18px; margin: 0 0 8px; }
+h2 { font-size: 14px; margin: 16px 0 4px; }
+table.summary { border-collapse: collapse; margin-bottom: 8px; }
+table.summary td, table.summary th { border: 1px solid #d0d7de; padding: 2px 8px; text-align: right; }
+table.summary td:first-child, table.summary th:first-child { text-align: left; }
+#controls { display: flex; gap: 12px; align-items: center; margin: 12px 0 8px; flex-wrap: wrap; }
+#controls input[type=search] { width: 320px; padding: 3px; }
+.grid { display: grid; grid-template-columns: 110px 110px 300px 60px repeat(7, 1fr); }
+.grid > div { padding: 0 6px; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; line-height: 24px; }
+#header { font-weight: 600; border-bottom: 1px solid #d0d7de; }
+#viewport { height: 60vh; overflow-y: auto; position: relative; border: 1px solid #d0d7de; }
+#rows { position: absolute; left: 0; right: 0; top: 0; }
+.row { height: 24px; cursor: pointer; border-bottom: 1px solid #f0f2f4; }
+.row:hover, .row.selected { background: #ddf4ff; }
+.changed { font-weight: 600; }
+.outlier { color: #9a6700; }
+#detail { margin-top: 12px; }
+#detail ul { margin: 4px 0; padding-left: 20px; }
+code { font-size: 12px; }
+</style>
+</head>
+<body>
+<h1>paraterra plan report</h1>
+<div id="summary"></div>
+<div id="controls">
+  <input id="search" type="search" placeholder="Search account, region, uuid, resource or property">
+  <select id="region"><option value="">all regions</option></select>
+  <select id="action"><option value="">any action</option></select>
+  <label><input id="changed" type="checkbox"> with changes or drift</label>
+  <label><input id="outliers" type="checkbox"> outliers only</label>
+  <span id="matches"></span>
+</div>
+<div id="header" class="grid"></div>
+<div id="viewport"><div id="spacer"></div><div id="rows"></div></div>
+<div id="detail"></div>
+<script type="application/json" id="data">$data</script>
+<script>
+"use strict";
+var data = JSON.parse(document.getElementById("data").textContent);
+var actions = data.actions, plans = data.plans, dictionaries = data.dictionaries;
+var planCount = plans.uuid.length, rowHeight = 24, matched = [], selected = -1, searchText = [];
+
+function escapeHtml(value) {
+  return String(value).replace(/[&<>"]/g, function (c) {
+    return {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"}[c];
+  });
+}
+function el(id) { return document.getElementById(id); }
+function counts(plan, action) { return [plans.changes[action][plan], plans.drift[action][plan]]; }
+function anyChanges(plan) {
+  for (var action = 0; action < actions.length; action++) {
+    var c = counts(plan, action);
+    if ((c[0] && actions[action] !== "no-op") || c[1]) return true;
+  }
+  return false;
+}
+function planText(plan) {
+  // Built on first search, so opening the report stays fast
+  if (searchText[plan] === undefined) {
+    var parts = [dictionaries.account[plans.account[plan]], dictionaries.region[plans.region[plan]], plans.uuid[plan]];
+    dictionaries.resources[plans.resources[plan]].forEach(function (resource) {
+      parts.push(dictionaries.address[resource[0]]);
+      for (var i = 1; i < resource.length; i++) parts.push(dictionaries.property[resource[i]]);
+    });
+    searchText[plan] = parts.join("\\n").toLowerCase();
+  }
+  return searchText[plan];
+}
+function table(headers, rows) {
+  return "<table class=summary><tr>" + headers.map(function (h) { return "<th>" + escapeHtml(h) + "</th>"; }).join("") +
+    "</tr>" + rows.map(function (row) {
+      return "<tr>" + row.map(function (v) { return "<td>" + escapeHtml(v) + "</td>"; }).join("") + "</tr>";
+    }).join("") + "</table>";
+}
+function renderSummary() {
+  var withChanges = 0;
+  for (var plan = 0; plan < planCount; plan++) if (anyChanges(plan)) withChanges++;
+  var html = "<p>" + planCount + " plans, " + withChanges + " with changes or drift, " + data.profiles.length +
+    " change profiles</p>";
+  html += "<h2>Resource changes</h2>" + table(["stat"].concat(actions), data.stats.changes);
+  html += "<h2>Resource drift</h2>" + table(["stat"].concat(actions), data.stats.drift);
+  html += "<h2>Change profiles (changes/drift)</h2>" + table(["profile", "plans"].concat(data.profile_actions, ["properties changed"]),
+    data.profiles.map(function (profile, index) {
+      return [index + 1, profile[0]].concat(data.profile_actions.map(function (_, a) { return profile[1][a] + "/" + profile[2][a]; }),
+        [profile[3].map(function (p) { return dictionaries.property[p]; }).join(", ")]);
+    }));
+  el("summary").innerHTML = html;
+}
+function applyFilters() {
+  var search = el("search").value.trim().toLowerCase(), region = el("region").value, action = el("action").value;
+  var changedOnly = el("changed").checked, outliersOnly = el("outliers").checked;
+  matched = [];
+  for (var plan = 0; plan < planCount; plan++) {
+    if (region !== "" && plans.region[plan] !== Number(region)) continue;
+    if (action !== "") { var c = counts(plan, Number(action)); if (!c[0] && !c[1]) continue; }
+    if (changedOnly && !anyChanges(plan)) continue;
+    if (outliersOnly && plans.profile[plan] === 1) continue;
+    if (search && planText(plan).indexOf(search) < 0) continue;
+    matched.push(plan);
+  }
+  el("matches").textContent = matched.length + " of " + planCount + " plans";
+  el("spacer").style.height = matched.length * rowHeight + "px";
+  el("viewport").scrollTop = 0;
+  renderRows();
+}
+function renderRows() {
+  // Only the rows in view (and a few either side) are in the DOM
+  var viewport = el("viewport");
+  var first = Math.max(0, Math.floor(viewport.scrollTop / rowHeight) - 10);
+  var last = Math.min(matched.length, first + Math.ceil(viewport.clientHeight / rowHeight) + 20);
+  var html = [];
+  for (var i = first; i < last; i++) {
+    var plan = matched[i], profile = plans.profile[plan];
+    var cells = [dictionaries.account[plans.account[plan]], dictionaries.region[plans.region[plan]], plans.uuid[plan]];
+    html.push("<div class='grid row" + (plan === selected ? " selected" : "") + "' data-plan=" + plan + ">" +
+      cells.map(function (v) { return "<div>" + escapeHtml(v) + "</div>"; }).join("") +
+      "<div class='" + (profile > 1 ? "outlier" : "") + "'>" + profile + "</div>" +
+      actions.map(function (_, a) {
+        var c = counts(plan, a);
+        return "<div class='" + ((c[0] && actions[a] !== "no-op") || c[1] ? "changed" : "") + "'>" + c[0] + "/" + c[1] + "</div>";
+      }).join("") + "</div>");
+  }
+  el("rows").style.transform = "translateY(" + first * rowHeight + "px)";
+  el("rows").innerHTML = html.join("");
+}
+function renderDetail(plan) {
+  selected = plan;
+  var html = "<h2>" + escapeHtml(dictionaries.account[plans.account[plan]] + " " + dictionaries.region[plans.region[plan]] +
+    " " + plans.uuid[plan]) + " (profile " + plans.profile[plan] + ")</h2>";
+  html += table([""].concat(actions), [["changes"].concat(actions.map(function (_, a) { return counts(plan, a)[0]; })),
+                                          ["drift"].concat(actions.map(function (_, a) { return counts(plan, a)[1]; }))]);
+  var resources = dictionaries.resources[plans.resources[plan]];
+  html += resources.length ? "<ul>" + resources.map(function (resource) {
+    return "<li><code>" + escapeHtml(dictionaries.address[resource[0]]) + "</code>: " +
+      resource.slice(1).map(function (p) { return "<code>" + escapeHtml(dictionaries.property[p]) + "</code>"; }).join(", ") + "</li>";
+  }).join("") + "</ul>" : "<p>No changed properties</p>";
+  el("detail").innerHTML = html;
+  renderRows();
+}
+
+el("header").innerHTML = ["account", "region", "uuid", "profile"].concat(actions).map(function (h) {
+  return "<div>" + escapeHtml(h) + "</div>";
+}).join("");
+dictionaries.region.forEach(function (region, index) {
+  el("region").insertAdjacentHTML("beforeend", "<option value=" + index + ">" + escapeHtml(region) + "</option>");
+});
+actions.forEach(function (action, index) {
+  el("action").insertAdjacentHTML("beforeend", "<option value=" + index + ">" + escapeHtml(action) + "</option>");
+});
+["search", "region", "action", "changed", "outliers"].forEach(function (id) { el(id).addEventListener("input", applyFilters); });
+el("viewport").addEventListener("scroll", renderRows);
+el("rows").addEventListener("click", function (event) {
+  var row = event.target.closest(".row");
+  if (row) renderDetail(Number(row.dataset.plan));
+});
+renderSummary();
+applyFilters();
+</script>
+</body>
+</html>
+"""
+
+def _html_report_data(plan_summaries, plan_counts):
+    # Column-wise like PlanCounts, with account, region, resource address and property
+    # path strings stored once in dictionaries and referenced by index. Each plan's list
+    # of changed resources is a dictionary entry too, since plans of the same config
+    # mostly change the same resources, so thousands of plans embed compactly.
+    dictionaries = {name: {} for name in ('account', 'region', 'address', 'property', 'resources')}
 
-def _compare_before_and_after(resource_change, resource_properties_changed):
-    before = resource_change.get('change').get('before')
-    after = resource_change.get('change').get('after')
+    def encode(name, value):
+        return dictionaries[name].setdefault(value, len(dictionaries[name]))
+
+    plan_profiles = [0] * len(plan_summaries)
+    profiles = []
+    for profile, ((changes, drift, property_paths), indexes) in enumerate(_change_profiles(plan_counts), start=1):
+        for index in indexes:
+            plan_profiles[index] = profile
+        profiles.append([len(indexes), list(changes), list(drift),
+                         [encode('property', property_path) for property_path in property_paths]])
+    plans = {'account': [encode('account', plan_summary['account']) for plan_summary in plan_summaries],
+             'region': [encode('region', plan_summary['region']) for plan_summary in plan_summaries],
+             'uuid': [plan_summary['uuid'] for plan_summary in plan_summaries],
+             'changes': [list(plan_counts.changes[action]) for action in ACTIONS],
+             'drift': [list(plan_counts.drift[action]) for action in ACTIONS],
+             'profile': plan_profiles,
+             # [address, property, property, ...] for each resource with changed properties
+             'resources': [encode('resources', tuple(
+                 (encode('address', address),) + tuple(encode('property', property_path)
+                                                       for property_path in property_paths)
+                 for address, property_paths in sorted(plan_summary['properties_changed_by_address'].items())))
+                           for plan_summary in plan_summaries]}
+    return {'actions': ACTIONS,
+            'profile_actions': PROFILE_ACTIONS,
+            'dictionaries': {name: list(values) for name, values in dictionaries.items()},
+            'plans': plans,
+            'stats': {'changes': _plan_stats(plan_counts.changes), 'drift': _plan_stats(plan_counts.drift)},
+            'profiles': profiles}
+
+def _write_html_report(html_out, plan_summaries, plan_counts):
+    with _phase('write report', plans=len(plan_summaries)) as event:
+        # </ is escaped so that no string in the data can close the script element
+        data = json.dumps(_html_report_data(plan_summaries, plan_counts), separators=(',', ':')).replace('</', '<\\/')
+        html = string.Template(HTML_REPORT_TEMPLATE).substitute(data=data)
+        with open(html_out, 'w') as html_file:
+            html_file.write(html)
+        event['bytes'] = len(html)
+
+def _collect_plan_summaries(artifacts_path, summaries_path=None, jobs=1, use_cache=False):
+    return sorted(_iter_plan_summaries(artifacts_path=artifacts_path,
+                                       summaries_path=summaries_path,
+                                       jobs=jobs,
+                                       use_cache=use_cache), key=_plan_prefix)
+
+def _iter_plan_summaries(artifacts_path, summaries_path=None, jobs=1, use_cache=False):
+    # Yields each plan summary as soon as it is read or parsed: summaries first, then
+    # plans without a summary in file name order
+    summarized_prefixes = set()
+    if summaries_path:
+        # The summaries path may be the artifacts directory itself, holding plans as well
+        for summary_file in os.scandir(summaries_path):
+            if not summary_file.name.endswith(PLAN_SUMMARY_FILE_SUFFIX):
+                continue
+            with _phase('read summary', files=1):
+                plan_summary = _shared_plan_summary(summary_file.path, False, _read_plan_summary)
+            if plan_summary and _plan_prefix(plan_summary) not in summarized_prefixes:
+                summarized_prefixes.add(_plan_prefix(plan_summary))
+                yield plan_summary
+
+    artifact_paths = []
+    if artifacts_path:
+        with _phase('scan artifacts') as event:
+            # Which plans a bundle holds is only known once it's read
+            artifact_paths = sorted(entry.path for entry in os.scandir(artifacts_path) if entry.is_file() and
+                                    not entry.name.endswith(PLAN_SUMMARY_FILE_SUFFIX) and
+                                    (_is_plan_bundle(entry.path) or
+                                     _plan_prefix(_parse_plan_file_name(entry.path)) not in summarized_prefixes))
+            event['files'] = len(artifact_paths)
+    # Artifacts an earlier command of a batch summarized aren't parsed again
+    unparsed_paths = [artifact_path for artifact_path in artifact_paths
+                      if not _BATCH or _plan_summary_key(artifact_path, use_cache) not in _BATCH.plan_summaries]
+    summarize_artifact = partial(_summarize_artifact, use_cache=use_cache)
+    if jobs > 1 and unparsed_paths:
+        from concurrent.futures import ProcessPoolExecutor
+        # executor.map yields in submission order, so results match the serial path
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 initializer=partial(_enable_profiler, worker=True) if _PROFILER else None) as executor:
+            parsed_summaries = _merge_plan_summaries(artifact_paths, use_cache,
+                                                     executor.map(summarize_artifact, unparsed_paths))
+            yield from (plan_summary for plan_summary in parsed_summaries
+                        if _plan_prefix(plan_summary) not in summarized_prefixes)
+    else:
+        parsed_summaries = _merge_plan_summaries(artifact_paths, use_cache, map(summarize_artifact, unparsed_paths))
+        yield from (plan_summary for plan_summary in parsed_summaries
+                    if _plan_prefix(plan_summary) not in summarized_prefixes)
+    if use_cache:
+        _evict_plan_summaries()
+
+def _merge_plan_summaries(artifact_paths, use_cache, parsed_artifacts):
+    # Yields summaries in artifact_paths order, taking artifacts a batch has already
+    # summarized from it and the rest from parsed_artifacts
+    for artifact_path in artifact_paths:
+        key = _plan_summary_key(artifact_path, use_cache)
+        if _BATCH and key in _BATCH.plan_summaries:
+            plan_summaries = _BATCH.plan_summaries[key]
+        else:
+            plan_summaries, profile_events = next(parsed_artifacts)
+            if _PROFILER:
+                _PROFILER.events.extend(profile_events)
+            if _BATCH:
+                _BATCH.plan_summaries[key] = plan_summaries
+        yield from map(dict, plan_summaries)
+
+def _plan_summary_key(path, use_cache):
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size, use_cache
+
+def _shared_plan_summary(path, use_cache, summarize):
+    if _BATCH is None:
+        return summarize(path)
+    key = _plan_summary_key(path, use_cache)
+    if key not in _BATCH.plan_summaries:
+        _BATCH.plan_summaries[key] = summarize(path)
+    plan_summary = _BATCH.plan_summaries[key]
+    return plan_summary and dict(plan_summary)
+
+def _parse_plan_file_name(plan_path):
+    file_name_parts = os.path.basename(plan_path).split("+")
+    return {'account': file_name_parts[0], 'region': file_name_parts[1], 'uuid': file_name_parts[2]}
+
+def _plan_prefix(plan_summary):
+    return f"{plan_summary['account']}+{plan_summary['region']}+{plan_summary['uuid']}"
+
+def _summarize_artifact(artifact_path, use_cache=False):
+    # Runs in worker processes, so only the small per-plan summaries are sent back, with
+    # the worker's profile events
+    if _is_plan_bundle(artifact_path):
+        plan_summaries = _summarize_bundle(artifact_path, use_cache)
+    else:
+        plan_summaries = [_summarize_plan(artifact_path, use_cache=use_cache)]
+    profile_events = []
+    if _PROFILER and _PROFILER.worker:
+        profile_events, _PROFILER.events = _PROFILER.events, []
+    return plan_summaries, profile_events
+
+def _summarize_plan(plan_path, use_cache=False):
+    plan_name = _parse_plan_file_name(plan_path)
+    with _phase('summarize plan', plan=_plan_prefix(plan_name), bytes=os.path.getsize(plan_path)):
+        if use_cache:
+            plan_counts = _count_plan_changes_cached(plan_path)
+        else:
+            plan_counts = _count_plan_changes(plan_path)
+    return {**plan_name, **plan_counts}
+
+def _summarize_bundle(bundle_path, use_cache=False):
+    # The whole bundle is cached as one entry, since its plans are only read as a stream
+    with _phase('summarize bundle', bundle=os.path.basename(bundle_path), bytes=os.path.getsize(bundle_path)):
+        cache_path = _plan_cache_path(bundle_path) if use_cache else None
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as cache_file:
+                plans_json = json.load(cache_file)['plans']
+            os.utime(cache_path)
+        else:
+            plans_json = {}
+            for member_name, member_file in _iter_bundle_plans(bundle_path):
+                with _phase('summarize plan', plan=_plan_prefix(_parse_plan_file_name(member_name))):
+                    plans_json[member_name] = _plan_counts_to_json(
+                        _count_plan_file_changes(codecs.getreader('utf-8')(member_file)))
+            if cache_path:
+                _write_json_atomically(cache_path, {'plans': plans_json})
+    return [{**_parse_plan_file_name(member_name), **_plan_counts_from_json(plans_json[member_name])}
+            for member_name in sorted(plans_json, key=os.path.basename)]
+
+def _is_plan_bundle(artifact_path):
+    return artifact_path.endswith(PLAN_BUNDLE_SUFFIXES)
+
+@contextmanager
+def _open_artifact(plan_path):
+    # Plans and logs compressed with gzip or zstandard are decompressed as they are read. The
+    # zstandard and tar streams can't seek, so they're decoded with a codecs reader
+    # rather than TextIOWrapper.
+    if plan_path.endswith('.gz'):
+        import gzip
+        with gzip.open(plan_path, 'rt') as plan_file:
+            yield plan_file
+    elif plan_path.endswith('.zst'):
+        with open(plan_path, 'rb') as compressed_file, _zstd_reader(compressed_file) as plan_file:
+            yield codecs.getreader('utf-8')(plan_file)
+    else:
+        with open(plan_path) as plan_file:
+            yield plan_file
+
+def _zstd_reader(compressed_file):
+    # zstandard is an optional dependency: pip install paraterra[zstd]
+    try:
+        import zstandard
+    except ImportError:
+        raise click.ClickException(f"Reading {getattr(compressed_file, 'name', 'zstandard')} needs the zstandard "
+                                   f"package: pip install paraterra[zstd]")
+    return zstandard.ZstdDecompressor().stream_reader(compressed_file)
+
+def _iter_bundle_plans(bundle_path):
+    # Yields (member name, binary file) for every file in a tar or zip bundle, in archive
+    # order, without extracting it. Compressed tars are decompressed as they are read.
+    if bundle_path.endswith('.zip'):
+        import zipfile
+        with zipfile.ZipFile(bundle_path) as bundle:
+            for member in bundle.infolist():
+                if not member.is_dir():
+                    with bundle.open(member) as member_file:
+                        yield member.filename, member_file
+        return
+    import tarfile
+    with open(bundle_path, 'rb') as bundle_file, \
+            (_zstd_reader(bundle_file) if bundle_path.endswith('.zst') else nullcontext(bundle_file)) as stream, \
+            tarfile.open(fileobj=stream, mode='r|*') as bundle:
+        for member in bundle:
+            if member.isfile():
+                yield member.name, bundle.extractfile(member)
+
+def _count_plan_changes(plan_path):
+    with _open_artifact(plan_path) as plan_file:
+        return _count_plan_file_changes(plan_file)
+
+def _count_plan_file_changes(plan_file):
+    resource_change_counts = dict.fromkeys(ACTIONS, 0)
+    resource_drift_counts = dict.fromkeys(ACTIONS, 0)
+    properties_changed_by_address = {}
+
+    # Diffing is interleaved with decoding, so its time is summed rather than traced per resource
+    profiling = _PROFILER is not None
+    diff_ns = 0
+    with _phase('decode plan') as event:
+        for section, resource_change in _iter_plan_sections(plan_file, PLAN_SECTIONS):
+            actions = resource_change.get("change").get("actions")
+            action = "-".join(actions)
+            if section == 'resource_changes':
+                resource_change_counts[action] += 1
+                diff_started = time.perf_counter_ns() if profiling else 0
+                property_paths = _diff_resource_change(resource_change)
+                if profiling:
+                    diff_ns += time.perf_counter_ns() - diff_started
+                if property_paths:
+                    properties_changed_by_address[resource_change.get("address")] = sorted(property_paths)
+            else:
+                resource_drift_counts[action] += 1
+        event['resources'] = sum(resource_change_counts.values()) + sum(resource_drift_counts.values())
+        event['diff_ms'] = diff_ns / 1e6
+
+    return _plan_counts_from_json({
+        'resource_change_counts': resource_change_counts,
+        'resource_drift_counts': resource_drift_counts,
+        'properties_changed_by_address': properties_changed_by_address
+    })
+
+def _plan_counts_to_json(plan_counts):
+    # The property sets are derived from properties_changed_by_address, so aren't stored
+    return {key: plan_counts[key] for key in
+            ('resource_change_counts', 'resource_drift_counts', 'properties_changed_by_address')}
+
+def _plan_counts_from_json(plan_counts_json):
+    property_paths_changed = set()
+    for property_paths in plan_counts_json['properties_changed_by_address'].values():
+        property_paths_changed.update(property_paths)
+    return {**plan_counts_json,
+            'property_paths_changed': property_paths_changed,
+            'resource_properties_changed': {_top_level_property(property_path)
+                                            for property_path in property_paths_changed}}
+
+def _read_plan_summary(summary_path):
+    with open(summary_path) as summary_file:
+        summary_json = json.load(summary_file)
+    if summary_json.get('version') != PLAN_SUMMARY_VERSION:
+        click.echo(f"Warning: ignoring {summary_path}, summary version {summary_json.get('version')} "
+                   f"does not match {PLAN_SUMMARY_VERSION}", err=True)
+        return None
+    return {'account': summary_json['account'],
+            'region': summary_json['region'],
+            'uuid': summary_json['uuid'],
+            'plan_seconds': summary_json.get('plan_seconds'),
+            **_plan_counts_from_json(summary_json)}
+
+def _plan_summaries_dir():
+    plan_summaries_dir = os.path.join(_cache_dir(), 'plan-summaries')
+    os.makedirs(plan_summaries_dir, exist_ok=True)
+    return plan_summaries_dir
+
+def _plan_cache_path(artifact_path):
+    # Cached by content rather than path, since artifacts are re-downloaded with fresh mtimes.
+    # Compressed artifacts are hashed as stored, which is also fewer bytes to hash.
+    sha256 = hashlib.sha256()
+    with _phase('hash plan'), open(artifact_path, 'rb') as artifact_file:
+        while (chunk := artifact_file.read(PLAN_READ_CHUNK_SIZE)):
+            sha256.update(chunk)
+    return os.path.join(_plan_summaries_dir(), f"{sha256.hexdigest()}-v{PLAN_SUMMARY_VERSION}.json")
+
+def _count_plan_changes_cached(plan_path):
+    cache_path = _plan_cache_path(plan_path)
+    if os.path.exists(cache_path):
+        with open(cache_path) as cache_file:
+            plan_counts = _plan_counts_from_json(json.load(cache_file))
+        # mtime doubles as last-used time for eviction
+        os.utime(cache_path)
+        return plan_counts
+
+    plan_counts = _count_plan_changes(plan_path)
+    _write_json_atomically(cache_path, _plan_counts_to_json(plan_counts))
+    return plan_counts
+
+def _evict_plan_summaries():
+    cache_entries = sorted(os.scandir(_plan_summaries_dir()), key=lambda entry: entry.stat().st_mtime)
+    cache_size = sum(entry.stat().st_size for entry in cache_entries)
+    for entry in cache_entries:
+        if cache_size <= PLAN_CACHE_MAX_BYTES:
+            break
+        cache_size -= entry.stat().st_size
+        os.remove(entry.path)
+
+# Group 1 is the closing quote, missing when the buffer ends mid-string
+_JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*(")?', re.DOTALL)
+_JSON_SCALAR_END = re.compile(r'[\s,\]}]')
+_JSON_NON_WHITESPACE = re.compile(r'\S')
+_JSON_DECODER = json.JSONDecoder()
+
+class _PlanStream:
+    # Pull parser over a JSON file that reads it in PLAN_READ_CHUNK_SIZE chunks. Values
+    # are either decoded (read_value) or skipped (skip_value), and the buffer only keeps
+    # text from the value currently being decoded onwards, so memory stays bounded by
+    # the chunk size and twice the largest value decoded rather than the file size.
+    def __init__(self, plan_file):
+        self.plan_file = plan_file
+        self.buffer = ''
+        self.position = 0
+        self.mark = None
+
+    def _read_more(self):
+        keep_from = self.position if self.mark is None else self.mark
+        # Text from keep_from on is scanned again after the read, so reading at least as
+        # much again keeps a value spanning many chunks linear rather than quadratic
+        chunk = self.plan_file.read(max(PLAN_READ_CHUNK_SIZE, len(self.buffer) - keep_from))
+        if not chunk:
+            raise ValueError(f"Unexpected end of JSON in {getattr(self.plan_file, 'name', 'plan file')}")
+        self.buffer = self.buffer[keep_from:] + chunk
+        self.position -= keep_from
+        if self.mark is not None:
+            self.mark = 0
+
+    def peek(self):
+        while (match := _JSON_NON_WHITESPACE.search(self.buffer, self.position)) is None:
+            self.position = len(self.buffer)
+            self._read_more()
+        self.position = match.start()
+        return self.buffer[self.position]
+
+    def take(self, expected):
+        char = self.peek()
+        if char not in expected:
+            raise ValueError(f"Expected one of {expected!r} in plan JSON, found {char!r}")
+        self.position += 1
+        return char
+
+    def _skip_string(self):
+        if self.peek() != '"':
+            raise ValueError(f"Expected a string in plan JSON, found {self.buffer[self.position]!r}")
+        while (match := _JSON_STRING.match(self.buffer, self.position)).group(1) is None:
+            self._read_more()
+        self.position = match.end()
+
+    def _skip_scalar(self):
+        while (match := _JSON_SCALAR_END.search(self.buffer, self.position)) is None:
+            self._read_more()
+        self.position = match.start()
+
+    def skip_value(self):
+        char = self.peek()
+        if char == '"':
+            self._skip_string()
+        elif char in '{[':
+            # Containers that fit in the buffer are decoded and dropped by the C decoder,
+            # which is much faster than scanning them here; larger ones are walked
+            try:
+                self.position = _JSON_DECODER.raw_decode(self.buffer, self.position)[1]
+            except json.JSONDecodeError:
+                self._skip_container()
+        else:
+            self._skip_scalar()
+
+    def _skip_container(self):
+        closing = '}' if self.take('{[') == '{' else ']'
+        if self.peek() == closing:
+            self.position += 1
+            return
+        while True:
+            if closing == '}':
+                self._skip_string()
+                self.take(':')
+            self.skip_value()
+            if self.take(',' + closing) == closing:
+                return
+
+    def read_value(self):
+        char = self.peek()
+        self.mark = self.position
+        if char in '{[':
+            while True:
+                try:
+                    value, self.position = _JSON_DECODER.raw_decode(self.buffer, self.mark)
+                    break
+                except json.JSONDecodeError:
+                    self.position = len(self.buffer)
+                    self._read_more()
+        else:
+            self.skip_value()
+            value = json.loads(self.buffer[self.mark:self.position])
+        self.mark = None
+        return value
+
+def _iter_plan_sections(plan_file, sections):
+    # Yields (section, item) for each item of the top-level arrays named in sections
+    stream = _PlanStream(plan_file)
+    stream.take('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.read_value()
+        stream.take(':')
+        if key in sections and stream.peek() == '[':
+            stream.take('[')
+            if stream.peek() == ']':
+                stream.take(']')
+            else:
+                while True:
+                    yield key, stream.read_value()
+                    if stream.take(',]') == ']':
+                        break
+        else:
+            stream.skip_value()
+        if stream.take(',}') == '}':
+            return
+
+_PROPERTY_PATH_SEPARATOR = re.compile(r'[.\[]')
+_PROPERTY_PATH_INDEX = re.compile(r'\[\d+\]')
+
+def _diff_resource_change(resource_change):
+    # Returns paths of changed properties, e.g. {'tags.CostCenter', 'ingress[2].cidr_blocks'}
+    change = resource_change.get('change')
+    before = change.get('before')
+    after = change.get('after')
+    property_paths = set()
 
     if before and after:
-        for before_prop_name, before_prop_value in before.items():
-            if before_prop_value != after.get(before_prop_name):
-                resource_properties_changed.add(before_prop_name)
+        _diff_property(before=before,
+                       after=after,
+                       unknown=change.get('after_unknown'),
+                       before_sensitive=change.get('before_sensitive'),
+                       after_sensitive=change.get('after_sensitive'),
+                       path='',
+                       property_paths=property_paths)
+    return property_paths
+
+def _diff_property(before, after, unknown, before_sensitive, after_sensitive, path, property_paths):
+    # Only called for the whole resource and for values that differ or hold something unknown: each
+    # value is checked with is and then the C-level != by its parent first, so equal subtrees are
+    # skipped whole. The sensitive markers mirror the whole value, e.g. {"tags": {}, "ingress":
+    # [{"cidr_blocks": [false]}]}, so they are only followed along differing paths. after_unknown
+    # is {} unless something is unknown.
+    if unknown is True:
+        # "known after apply"
+        property_paths.add(path)
+        return
+    if before_sensitive is True or after_sensitive is True:
+        # Reported as a whole, without naming anything nested inside a sensitive value
+        property_paths.add(path)
+        return
+
+    if isinstance(before, dict) and isinstance(after, dict):
+        if path and max(len(before), len(after)) > PROPERTY_DIFF_MAX_PATHS:
+            property_paths.add(path)
+            return
+        # A property that is null on one side and absent on the other hasn't changed
+        keys = [key for key, value in before.items()
+                if value is not (after_value := after.get(key)) and value != after_value]
+        keys.extend(key for key in after.keys() - before.keys() if after[key] is not None)
+        if isinstance(unknown, dict):
+            changed_keys = set(keys)
+            keys.extend(key for key, marker in unknown.items()
+                        if marker and key not in changed_keys and _contains_true(marker))
+        children = [(before.get(key), after.get(key), _child_marker(unknown, key),
+                     _child_marker(before_sensitive, key), _child_marker(after_sensitive, key),
+                     f"{path}.{key}" if path else key)
+                    for key in keys]
+    elif isinstance(before, list) and isinstance(after, list):
+        if max(len(before), len(after)) > PROPERTY_DIFF_MAX_PATHS:
+            property_paths.add(path)
+            return
+        indexes = [index for index, (before_item, after_item) in enumerate(zip(before, after))
+                   if before_item is not after_item and before_item != after_item]
+        indexes.extend(range(min(len(before), len(after)), max(len(before), len(after))))
+        if isinstance(unknown, list):
+            changed_indexes = set(indexes)
+            indexes.extend(index for index, marker in enumerate(unknown)
+                           if marker and index not in changed_indexes and _contains_true(marker))
+        children = [(before[index] if index < len(before) else None, after[index] if index < len(after) else None,
+                     _child_marker(unknown, index), _child_marker(before_sensitive, index),
+                     _child_marker(after_sensitive, index), f"{path}[{index}]")
+                    for index in indexes]
+    else:
+        if before != after:
+            property_paths.add(path)
+        return
+
+    child_paths = set()
+    for child_before, child_after, child_unknown, child_before_sensitive, child_after_sensitive, child_path in children:
+        if not (isinstance(child_before, dict) and isinstance(child_after, dict) or
+                isinstance(child_before, list) and isinstance(child_after, list)):
+            # A changed, unknown or sensitive value with nothing to walk into
+            child_paths.add(child_path)
+            continue
+        _diff_property(before=child_before,
+                       after=child_after,
+                       unknown=child_unknown,
+                       before_sensitive=child_before_sensitive,
+                       after_sensitive=child_after_sensitive,
+                       path=child_path,
+                       property_paths=child_paths)
+    if path and len(child_paths) > PROPERTY_DIFF_MAX_PATHS:
+        property_paths.add(path)
+    else:
+        property_paths.update(child_paths)
+
+def _contains_true(marker):
+    if marker is True:
+        return True
+    if isinstance(marker, dict):
+        marker = marker.values()
+    elif not isinstance(marker, list):
+        return False
+    # Like the values they mirror, markers too large to diff item by item aren't searched
+    if len(marker) > PROPERTY_DIFF_MAX_PATHS:
+        return False
+    return any(map(_contains_true, filter(None, marker)))
+
+def _child_marker(marker, key):
+    if isinstance(marker, dict):
+        return marker.get(key)
+    if isinstance(marker, list) and isinstance(key, int) and key < len(marker):
+        return marker[key]
+    return None
+
+def _top_level_property(property_path):
+    return _PROPERTY_PATH_SEPARATOR.split(property_path, 1)[0]
+
+def _property_allowed(property_path, allowed_props):
+    # A pattern allows the path itself and everything nested under it, so 'tags' allows
+    # 'tags.Name'. '*' is a wildcard; brackets are literal, as in 'ingress[*].cidr_blocks'.
+    candidate_paths = [property_path[:match.start()]
+                       for match in _PROPERTY_PATH_SEPARATOR.finditer(property_path)]
+    candidate_paths.append(property_path)
+    for allowed_prop in allowed_props:
+        allowed_prop_regex = re.compile('.*'.join(map(re.escape, allowed_prop.split('*'))))
+        if any(allowed_prop_regex.fullmatch(candidate_path) for candidate_path in candidate_paths):
+            return True
+    return False
 
 def _validate_changes(no_creates,
                       no_deletes,
                       no_drift,
                       allowed_props,
-                      all_resource_change_counts,
-                      all_resource_drift_counts,
-                      all_resource_properties_changed):
+                      plan_counts):
     
     validation_failed = False
 
     if no_deletes:
         print("Checking for changes with deletes...")
-        for id, counts in all_resource_change_counts.items():
-            if counts['delete-create'] or \
-                counts['create-delete'] or \
-                counts['delete']:
-                print(f"Error: Validation - {id} resource changes include deletes.")
-                validation_failed = True
-        else:
+        failing_plans = plan_counts.nonzero([plan_counts.changes['delete-create'],
+                                             plan_counts.changes['create-delete'],
+                                             plan_counts.changes['delete']])
+        for index in failing_plans:
+            print(f"Error: Validation - {plan_counts.ids[index]} resource changes include deletes.")
+            validation_failed = True
+        if not failing_plans:
             print("No changes with deletes found!")
     
     if no_creates:
         print("Checking for changes with creates...")
-        for id, counts in all_resource_change_counts.items():
-            if counts['create'] or \
-                counts['delete-create'] or \
-                counts['create-delete']:
-                print(f"Error: Validation - {id} - resource changes include creates.")
-                validation_failed = True
-        else:
+        failing_plans = plan_counts.nonzero([plan_counts.changes['create'],
+                                             plan_counts.changes['delete-create'],
+                                             plan_counts.changes['create-delete']])
+        for index in failing_plans:
+            print(f"Error: Validation - {plan_counts.ids[index]} - resource changes include creates.")
+            validation_failed = True
+        if not failing_plans:
             print("No changes with creates found!")
     
     if no_drift:
         print("Checking for drift...")
-        fail_on_drift = False
-        for id, counts in all_resource_drift_counts.items():
-            for value in counts.values():
-                if value:
-                    print(f"Error: Validation - {id} - resources have drifted.")
-                    validation_failed = True
-                    fail_on_drift = True
-        if not fail_on_drift:
+        failing_plans = plan_counts.nonzero(plan_counts.drift.values())
+        for index in failing_plans:
+            print(f"Error: Validation - {plan_counts.ids[index]} - resources have drifted.")
+            validation_failed = True
+        if not failing_plans:
             print("No drift found!")
 
     if allowed_props:
         print(f"Checking if prop changes are in {allowed_props}...")
         fail_on_allowed_props = False
-        for id, changed_props in all_resource_properties_changed.items():
-            for changed_prop in changed_props:
-                if changed_prop not in allowed_props:
+        for id, changed_props in zip(plan_counts.ids, plan_counts.property_paths):
+            for changed_prop in sorted(changed_props):
+                if not _property_allowed(changed_prop, allowed_props):
                     print(f"Error: Validation - {id} - resource property {changed_prop} not in allowed_props {allowed_props}")
                     validation_failed = True
                     fail_on_allowed_props = True
@@ -406,33 +1984,571 @@ def _validate_changes(no_creates,
     else:
         return True
 
+@cli.command(help="Writes a small summary of a plan JSON file that parse-plans can read \
+             with --summaries-path instead of the full plan")
+@click.option('--plan-path', required=True, help="Path to plan JSON file named {account}+{region}+{uuid}+..., \
+              optionally compressed (.json.gz, .json.zst)")
+@click.option('--output-path', required=False, help=f"Path to write the summary to. Defaults to \
+              {{account}}+{{region}}+{{uuid}}{PLAN_SUMMARY_FILE_SUFFIX} next to the plan")
+@click.option('--plan-seconds', type=float, required=False, help="How long terraform plan took, recorded by \
+              parse-plans as the leaf's cost for matrix")
+def summarize_plan(plan_path, output_path, plan_seconds):
+    plan_summary = _summarize_plan(plan_path)
+    if not output_path:
+        output_path = os.path.join(os.path.dirname(plan_path),
+                                   f"{_plan_prefix(plan_summary)}{PLAN_SUMMARY_FILE_SUFFIX}")
+    with open(output_path, "w") as summary_file:
+        json.dump({'version': PLAN_SUMMARY_VERSION,
+                   'account': plan_summary['account'],
+                   'region': plan_summary['region'],
+                   'uuid': plan_summary['uuid'],
+                   **({'plan_seconds': plan_seconds} if plan_seconds is not None else {}),
+                   **_plan_counts_to_json(plan_summary)}, summary_file)
+    print(output_path)
+
 @cli.command()
-@click.option("--artifacts-path", required=True, help="Path to artifact directory to scan")
+@click.option("--artifacts-path", required=True, help="Path to artifact directory to scan. Plans in tar and zip \
+              bundles are listed by their file names")
 def print_plan_files(artifacts_path):
-    print([filename.path.split("/")[-1] for filename in os.scandir(artifacts_path)])
+    plan_files = []
+    for entry in os.scandir(artifacts_path):
+        if entry.name.endswith(PLAN_SUMMARY_FILE_SUFFIX):
+            continue
+        if _is_plan_bundle(entry.path):
+            plan_files.extend(os.path.basename(member_name) for member_name, _ in _iter_bundle_plans(entry.path))
+        else:
+            plan_files.append(entry.name)
+    print(plan_files)
+
+@cli.command(help="Summarizes the terraform apply -json logs in --artifacts-path, named {account}+{region}+{uuid}+..., \
+             per leaf: resources applied by action, resources that failed to apply, duration and errors. Fails if any \
+             leaf errored or its log ended before the apply finished")
+@click.option('--artifacts-path', required=True, help="Directory of apply logs, optionally compressed (.gz, .zst)")
+@click.option('--jobs', type=int, default=1, help="Number of processes used to read logs in parallel")
+@click.option('--follow', is_flag=True, help="Reads logs as they are written, including logs created meanwhile. \
+              Each log is summarized once its apply has finished or it stops growing for --idle-timeout seconds, \
+              and the command returns once no log has appeared or grown for --idle-timeout seconds")
+@click.option('--idle-timeout', type=float, default=300, show_default=True,
+              help="With --follow, seconds a log may go without growing before it is summarized as it is, and \
+              seconds without any new or growing log before the command returns")
+@output_option
+def parse_applies(artifacts_path, jobs, follow, idle_timeout, output):
+    if output == 'text':
+        print("Apply Results")
+    apply_summaries = []
+    with RowWriter(output, APPLY_ROW_HEADERS) as writer:
+        for apply_summary in (_follow_apply_logs(artifacts_path, idle_timeout) if follow
+                              else _iter_apply_summaries(artifacts_path, jobs)):
+            apply_summaries.append(apply_summary)
+            if output != 'text':
+                writer.write(_apply_row(apply_summary))
+        if output == 'text':
+            # Errors get their own table below
+            for apply_summary in sorted(apply_summaries, key=_plan_prefix):
+                writer.write({**_apply_row(apply_summary), 'uuid': f"{apply_summary['uuid'][:6]}...",
+                              'errors': len(apply_summary['errors'])})
+
+    with redirect_stdout(sys.stderr) if output != 'text' else nullcontext():
+        error_table = [[_plan_id(apply_summary), error] for apply_summary in sorted(apply_summaries, key=_plan_prefix)
+                       for error in apply_summary['errors']]
+        if error_table:
+            print("\n")
+            print("Apply Errors")
+            print(_tabulate(error_table, headers=["plan", "error"], disable_numparse=True))
+        failed = [apply_summary for apply_summary in apply_summaries if _apply_result(apply_summary) != 'applied']
+        if failed:
+            print(f"\nFailed: {len(failed)} of {len(apply_summaries)} leaves errored or did not finish applying")
+            sys.exit(1)
+
+def _iter_apply_summaries(artifacts_path, jobs=1):
+    log_paths = sorted(entry.path for entry in os.scandir(artifacts_path) if entry.is_file())
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield from executor.map(_summarize_apply_log, log_paths)
+    else:
+        yield from map(_summarize_apply_log, log_paths)
+
+def _summarize_apply_log(log_path):
+    # Runs in worker processes. Logs are read a line at a time, so memory doesn't grow with them.
+    apply_summary = _new_apply_summary(log_path)
+    with _phase('summarize apply log', log=_plan_prefix(apply_summary), bytes=os.path.getsize(log_path)), \
+            _open_artifact(log_path) as log_file:
+        for line in log_file:
+            _add_apply_message(apply_summary, line)
+    return apply_summary
+
+def _follow_apply_logs(artifacts_path, idle_timeout):
+    # Yields each leaf's summary once its apply has finished, or its log has not grown
+    # for idle_timeout seconds. Logs are polled, so this works for any writer, including
+    # logs on network filesystems and downloaded artifacts. Polling goes on until no log
+    # has appeared or grown for idle_timeout seconds, so leaves that start late are picked
+    # up. Logs are read as bytes and only complete lines are decoded, since a write can
+    # end partway through a multibyte character.
+    followed = {}
+    summarized_paths = set()
+    last_activity = time.monotonic()
+    # Logs still open when the generator is closed or abandoned are closed too
+    try:
+        while True:
+            for entry in os.scandir(artifacts_path):
+                if not entry.is_file() or entry.path in followed or entry.path in summarized_paths:
+                    continue
+                last_activity = time.monotonic()
+                if entry.path.endswith(('.gz', '.zst')):
+                    # Compressed logs are only written once they are complete
+                    summarized_paths.add(entry.path)
+                    yield _summarize_apply_log(entry.path)
+                else:
+                    # [log file, summary, incomplete last line, time the log last grew]
+                    followed[entry.path] = [open(entry.path, 'rb'), _new_apply_summary(entry.path), b'', last_activity]
+            for log_path, follow_state in list(followed.items()):
+                log_file, apply_summary, partial_line, last_growth = follow_state
+                data = log_file.read()
+                if data:
+                    lines = (partial_line + data).split(b'\n')
+                    for line in lines[:-1]:
+                        _add_apply_message(apply_summary, line.decode(errors='replace'))
+                    last_activity = time.monotonic()
+                    follow_state[2:] = [lines[-1], last_activity]
+                if apply_summary['complete'] or time.monotonic() - follow_state[3] > idle_timeout:
+                    _add_apply_message(apply_summary, follow_state[2].decode(errors='replace'))
+                    log_file.close()
+                    del followed[log_path]
+                    summarized_paths.add(log_path)
+                    yield apply_summary
+            if not followed and time.monotonic() - last_activity > idle_timeout:
+                return
+            time.sleep(APPLY_FOLLOW_POLL_SECONDS)
+    finally:
+        for log_file, *_ in followed.values():
+            log_file.close()
+
+def _new_apply_summary(log_path):
+    return {**_parse_plan_file_name(log_path),
+            'applied': dict.fromkeys(APPLY_ACTIONS, 0),
+            'failed': 0,
+            'errors': [],
+            'started': None,
+            'finished': None,
+            'complete': False}
+
+def _add_apply_message(apply_summary, line):
+    # Messages are documented in terraform's machine-readable UI docs. Lines that aren't
+    # JSON objects (crash output, wrapper scripts) are skipped.
+    if not line.strip():
+        return
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return
+    if not isinstance(message, dict):
+        return
+    if message.get('@timestamp'):
+        apply_summary['started'] = apply_summary['started'] or message['@timestamp']
+        apply_summary['finished'] = message['@timestamp']
+    message_type = message.get('type')
+    if message_type == 'apply_complete':
+        action = (message.get('hook') or {}).get('action')
+        if action in apply_summary['applied']:
+            apply_summary['applied'][action] += 1
+    elif message_type == 'apply_errored':
+        apply_summary['failed'] += 1
+    elif message_type == 'diagnostic' and message.get('@level') == 'error':
+        diagnostic = message.get('diagnostic') or {}
+        error = diagnostic.get('summary') or message.get('@message', '')
+        apply_summary['errors'].append(f"{diagnostic['address']}: {error}" if diagnostic.get('address') else error)
+    elif message_type == 'change_summary' and (message.get('changes') or {}).get('operation') == 'apply':
+        apply_summary['complete'] = True
+
+def _apply_result(apply_summary):
+    if apply_summary['errors'] or apply_summary['failed']:
+        return 'errored'
+    return 'applied' if apply_summary['complete'] else 'incomplete'
+
+def _apply_row(apply_summary):
+    seconds = None
+    if apply_summary['started']:
+        # fromisoformat only accepts a Z suffix from Python 3.11
+        started, finished = (datetime.fromisoformat(apply_summary[key].replace('Z', '+00:00'))
+                             for key in ('started', 'finished'))
+        seconds = round((finished - started).total_seconds(), 1)
+    return {'account': apply_summary['account'],
+            'region': apply_summary['region'],
+            'uuid': apply_summary['uuid'],
+            'result': _apply_result(apply_summary),
+            **apply_summary['applied'],
+            'failed': apply_summary['failed'],
+            'seconds': seconds,
+            'errors': apply_summary['errors']}
+
+@cli.command(cls=FiltersCommand, help="Runs terraform plan or apply for every selected tfvars file concurrently. \
+             Each leaf runs in its own copy of the terraform config. Plans are written as \
+             {output-dir}/terraform-plan-out-json/{account}+{region}+{uuid}+terraform-plan-out.json for parse-plans, \
+             and apply applies the saved plans in {output-dir}/terraform-plan-out, logging terraform apply -json to \
+             {output-dir}/terraform-apply-json/{account}+{region}+{uuid}+terraform-apply.json for parse-applies")
+@click.argument('operation', type=click.Choice(['plan', 'apply']))
+@click.option("--exclude-accounts", required=False, default=None, help="Comma-delimited list of accounts to exclude")
+@click.option('--tf-code-dir', required=True, type=click.Path(exists=True, file_okay=False),
+              help="Terraform config directory, copied for each leaf")
+@click.option('--output-dir', default='artifacts', show_default=True, help="Directory for plans and logs")
+@click.option('--terraform', envvar='PARATERRA_TERRAFORM', default='terraform', show_default=True,
+              help="Terraform executable. Can also be set with PARATERRA_TERRAFORM")
+@click.option('--jobs', type=click.IntRange(1), default=4, show_default=True,
+              help="Number of leaves run concurrently")
+@click.option('--timeout', type=float, default=3600, show_default=True,
+              help="Seconds each terraform command may run before it is killed")
+@click.option('--retries', type=click.IntRange(0), default=2, show_default=True,
+              help="Times a terraform command is retried, with exponential backoff, after a transient error \
+              such as a held state lock or API throttling")
+@click.option('--backend-template', required=False, type=click.Path(exists=True, dir_okay=False),
+              help=f"Terraform file rendered into each leaf workspace as {WORKSPACE_BACKEND_FILE_NAME}, with \
+              $account, $region, $uuid and $tfvars_path replaced by the leaf's values")
+@click.option('--provider-mirror', required=False, type=click.Path(exists=True, file_okay=False),
+              help="Local provider directory to install providers from instead of the registry")
+def run(operation, filters, exclude_accounts, tf_code_dir, output_dir, terraform, jobs, timeout, retries,
+        backend_template, provider_mirror):
+    exclude_accounts = exclude_accounts.split(",") if exclude_accounts else None
+    selection = _resolve_selection(filters, exclude_accounts=exclude_accounts)
+    run_options = RunOptions(terraform=terraform,
+                             tf_code_dir=tf_code_dir,
+                             output_dir=output_dir,
+                             timeout=timeout,
+                             retries=retries,
+                             backend_template=backend_template,
+                             provider_mirror=provider_mirror)
+    if not _run_leaves(operation, selection, run_options, jobs):
+        sys.exit(1)
+
+def _run_leaves(operation, selection, run_options, jobs=4):
+    import asyncio
+    for artifact_dir in (RUN_PLAN_JSON_DIR, RUN_PLAN_OUT_DIR, RUN_PLAN_TXT_DIR, RUN_APPLY_JSON_DIR):
+        os.makedirs(os.path.join(run_options.output_dir, artifact_dir), exist_ok=True)
+
+    async def run_all():
+        template_dir, output = await _prepare_workspace_template(run_options)
+        if not template_dir:
+            print(output)
+            return None
+        semaphore = asyncio.Semaphore(jobs)
+        return await asyncio.gather(*(_run_leaf(operation, leaf, run_options, template_dir, semaphore)
+                                      for leaf in selection))
+    results = asyncio.run(run_all())
+    if results is None:
+        print("Error: terraform init of the workspace template failed")
+        return False
+
+    print(_tabulate(results, headers=["account", "region", "uuid", "result", "attempts", "seconds"],
+                            disable_numparse=True))
+    return all(result[3] in ('planned', 'applied') for result in results)
+
+async def _run_leaf(operation, leaf, run_options, template_dir, semaphore):
+    import asyncio
+    import shutil
+    prefix = _plan_prefix(leaf._asdict())
+    plan_out_path = os.path.abspath(os.path.join(run_options.output_dir, RUN_PLAN_OUT_DIR,
+                                                 f"{prefix}+terraform-plan.out"))
+    # Steps are (name, terraform arguments, path stdout is written to instead of the log).
+    # Providers and modules are already linked in from the template, so init only
+    # configures the leaf's backend.
+    init_args = ['init', '-input=false', '-no-color', *_provider_mirror_args(run_options)]
+    if operation == 'plan':
+        commands = [('init', init_args, None),
+                    ('plan', ['plan', '-input=false', '-no-color',
+                              f"-var-file={os.path.abspath(os.path.join(leaf.path, TFVARS_FILE_NAME))}",
+                              f"-out={plan_out_path}"], None),
+                    ('show', ['show', '-json', plan_out_path],
+                     os.path.join(run_options.output_dir, RUN_PLAN_JSON_DIR, f"{prefix}+terraform-plan-out.json"))]
+        log_path = os.path.join(run_options.output_dir, RUN_PLAN_TXT_DIR, f"{prefix}+terraform-plan.txt")
+    else:
+        # Logged as terraform's machine-readable messages for parse-applies, which skips the init output
+        commands = [('init', init_args, None),
+                    ('apply', ['apply', '-input=false', '-json', '-auto-approve', plan_out_path], None)]
+        log_path = os.path.join(run_options.output_dir, RUN_APPLY_JSON_DIR, f"{prefix}+terraform-apply.json")
+    # Credentials are left to the environment, but the leaf's identity is passed on so
+    # wrappers and provider configs can assume a role per account
+    env = {**_terraform_env(),
+           'AWS_DEFAULT_REGION': leaf.region,
+           'PARATERRA_ACCOUNT': leaf.account,
+           'PARATERRA_REGION': leaf.region,
+           'PARATERRA_UUID': leaf.uuid,
+           'PARATERRA_TFVARS_PATH': leaf.path}
+
+    async with semaphore:
+        started = time.monotonic()
+        attempts = 0
+        if operation == 'apply' and not os.path.exists(plan_out_path):
+            result = 'failed: no saved plan'
+        else:
+            # Copying and removing workspaces is file I/O, kept off the event loop so other
+            # leaves' terraform output is still read meanwhile
+            work_dir = await asyncio.to_thread(_materialize_leaf_workspace, template_dir, leaf,
+                                               run_options.backend_template)
+            with open(log_path, 'w') as log_file:
+                for step, args, stdout_path in commands:
+                    returncode, output, step_attempts = await _run_terraform_with_retries(run_options, args, work_dir,
+                                                                                          env, stdout_path)
+                    attempts = max(attempts, step_attempts)
+                    log_file.write(output)
+                    if returncode is None:
+                        result = f"timed out: {step}"
+                        break
+                    if returncode != 0:
+                        result = f"failed: {step}"
+                        break
+                else:
+                    result = 'planned' if operation == 'plan' else 'applied'
+            await asyncio.to_thread(shutil.rmtree, work_dir, ignore_errors=True)
+    return [leaf.account, leaf.region, leaf.uuid, result, attempts, f"{time.monotonic() - started:.1f}"]
+
+def _terraform_env():
+    # Every init shares one plugin cache, so a provider version is downloaded once per machine
+    plugin_cache_dir = os.environ.get('TF_PLUGIN_CACHE_DIR') or os.path.abspath(os.path.join(_cache_dir(), 'plugin-cache'))
+    os.makedirs(plugin_cache_dir, exist_ok=True)
+    return {**os.environ, 'TF_IN_AUTOMATION': '1', 'TF_PLUGIN_CACHE_DIR': plugin_cache_dir}
+
+def _provider_mirror_args(run_options):
+    return [f"-plugin-dir={os.path.abspath(run_options.provider_mirror)}"] if run_options.provider_mirror else []
+
+def _workspace_template_dir():
+    return os.path.join(_cache_dir(), 'workspace-template')
+
+def _workspace_fingerprint(run_options):
+    # Config files are small, so hashing them all is cheap next to an init
+    sha256 = hashlib.sha256(json.dumps([run_options.terraform, run_options.provider_mirror]).encode())
+    for dir_path, dir_names, file_names in os.walk(run_options.tf_code_dir):
+        dir_names[:] = sorted(dir_name for dir_name in dir_names if dir_name != '.terraform')
+        for file_name in sorted(file_names):
+            file_path = os.path.join(dir_path, file_name)
+            sha256.update(os.path.relpath(file_path, run_options.tf_code_dir).encode() + b'\0')
+            with open(file_path, 'rb') as config_file:
+                sha256.update(config_file.read())
+    return sha256.hexdigest()
+
+async def _prepare_workspace_template(run_options):
+    # Initializes a copy of the config without a backend, once per config version.
+    # Returns the template directory and init output, or None and the output if init failed.
+    import shutil
+    template_dir = _workspace_template_dir()
+    fingerprint_path = os.path.join(template_dir, WORKSPACE_FINGERPRINT_FILE)
+    fingerprint = _workspace_fingerprint(run_options)
+    if os.path.exists(fingerprint_path):
+        with open(fingerprint_path) as fingerprint_file:
+            if fingerprint_file.read() == fingerprint:
+                return template_dir, ''
+
+    shutil.rmtree(template_dir, ignore_errors=True)
+    shutil.copytree(run_options.tf_code_dir, template_dir, ignore=shutil.ignore_patterns('.terraform', '*.tfstate*'))
+    returncode, output, _ = await _run_terraform_with_retries(
+        run_options, ['init', '-backend=false', '-input=false', '-no-color', *_provider_mirror_args(run_options)],
+        template_dir, _terraform_env())
+    if returncode != 0:
+        return None, output
+    with open(fingerprint_path, 'w') as fingerprint_file:
+        fingerprint_file.write(fingerprint)
+    return template_dir, output
+
+def _materialize_leaf_workspace(template_dir, leaf, backend_template=None):
+    # Config files are copied, so nothing a leaf's terraform writes reaches the template
+    # or other leaves, while providers and modules are symlinked or hardlinked from the
+    # template's .terraform instead of being installed per leaf
+    import shutil
+    work_dir = os.path.join(_cache_dir(), 'workspaces', _plan_prefix(leaf._asdict()))
+    shutil.rmtree(work_dir, ignore_errors=True)
+    shutil.copytree(template_dir, work_dir, symlinks=True,
+                    ignore=shutil.ignore_patterns('.terraform', '*.tfstate*', WORKSPACE_FINGERPRINT_FILE))
+    for shared_dir in WORKSPACE_SHARED_DIRS:
+        template_shared_dir = os.path.join(template_dir, '.terraform', shared_dir)
+        if os.path.isdir(template_shared_dir):
+            shutil.copytree(template_shared_dir, os.path.join(work_dir, '.terraform', shared_dir),
+                            symlinks=True, copy_function=_link_or_copy)
+    if backend_template:
+        with open(backend_template) as template_file:
+            backend = string.Template(template_file.read()).safe_substitute(account=leaf.account,
+                                                                            region=leaf.region,
+                                                                            uuid=leaf.uuid,
+                                                                            tfvars_path=leaf.path)
+        with open(os.path.join(work_dir, WORKSPACE_BACKEND_FILE_NAME), 'w') as backend_file:
+            backend_file.write(backend)
+    return work_dir
+
+def _link_or_copy(source_path, destination_path):
+    import shutil
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        # Across filesystems
+        shutil.copy2(source_path, destination_path)
+
+async def _run_terraform_with_retries(run_options, args, work_dir, env, stdout_path=None):
+    # Returns the last attempt's return code (None if it timed out), output and the
+    # number of attempts made
+    import asyncio
+    for attempt in range(run_options.retries + 1):
+        if attempt:
+            await asyncio.sleep(RUN_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+        returncode, output = await _run_terraform(run_options, args, work_dir, env, stdout_path)
+        if returncode in (0, None) or not TERRAFORM_TRANSIENT_ERRORS.search(output):
+            break
+    return returncode, output, attempt + 1
+
+async def _run_terraform(run_options, args, work_dir, env, stdout_path=None):
+    # With stdout_path, stdout (e.g. a plan's JSON) streams to a temp file that replaces
+    # stdout_path on success, and only stderr is returned as output
+    import asyncio
+    temp_path = stdout_path and os.path.join(os.path.dirname(stdout_path),
+                                             f".{os.path.basename(stdout_path)}.{os.getpid()}.tmp")
+    with open(temp_path, 'wb') if temp_path else nullcontext() as stdout_file:
+        process = await asyncio.create_subprocess_exec(run_options.terraform, *args, cwd=work_dir, env=env,
+                                                       stdout=stdout_file or asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE if stdout_file
+                                                       else asyncio.subprocess.STDOUT)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), run_options.timeout)
+            returncode = process.returncode
+        except asyncio.TimeoutError:
+            process.kill()
+            stdout, stderr = await process.communicate()
+            returncode = None
+    if temp_path:
+        if returncode == 0:
+            os.replace(temp_path, stdout_path)
+        else:
+            os.remove(temp_path)
+    return returncode, (stderr if stdout_file else stdout).decode(errors='replace')
 
 @cli.command(cls=FiltersCommand,help='Prints table of tfvars files with passed fields')
-@click.option('--to-csv',is_flag=True,help='prints table in csv format')
-def table(filters,to_csv):
-    accounts_to_paths = _filter_and_map_accounts_to_full_paths(filters)
-    table = []
-    filters_dict = _split_filters(filters) if filters else {}
-    filters_keys = list(filters_dict.keys())
-
-    for account, path in accounts_to_paths.items():
-        with open(path) as tfvars_file:
-            tfvars_dict = json.load(tfvars_file)
-            tfvars_values = [tfvars_dict[each_filter_key] 
-                             for each_filter_key in filters_keys]
-            row = [account] + tfvars_values
-            table.append(row)
-    
-    headers = ["account"] + filters_keys
+@click.option('--to-csv',is_flag=True,help='Same as --output csv')
+@output_option
+def table(filters,to_csv,output):
     if to_csv:
-        headers = ','.join(headers)
-        print(headers)
-        for row in table:
-            row = ','.join(row)
-            print(row)
-    else:        
-        print(tabulate.tabulate(table, headers=headers, disable_numparse=True))
+        output = 'csv'
+    selection = _resolve_selection(filters)
+    # Fields are known once the filters were evaluated against the index
+    filters_keys = _compile_filters(filters).fields if filters else []
+    filters_field_paths = [_compile_field_path(each_filter_key) for each_filter_key in filters_keys]
+    headers = ["account"] + filters_keys
+
+    with _phase('render table', rows=len(selection)), RowWriter(output, headers) as writer:
+        for leaf in selection:
+            # Missing fields are None, so json tells them apart from empty strings
+            writer.write(dict(zip(headers, [leaf.account] +
+                                  [field_path.get(leaf.tfvars) if field_path.exists(leaf.tfvars) else None
+                                   for field_path in filters_field_paths])))
+
+
+@cli.group(help="Manages the initialized terraform workspaces that run uses")
+def workspace():
+    pass
+
+@workspace.command(name='init', help="Runs terraform init once into a template workspace, sharing a plugin cache. \
+                   Does nothing if the config hasn't changed since the last init")
+@click.option('--tf-code-dir', required=True, type=click.Path(exists=True, file_okay=False),
+              help="Terraform config directory")
+@click.option('--terraform', envvar='PARATERRA_TERRAFORM', default='terraform', show_default=True,
+              help="Terraform executable. Can also be set with PARATERRA_TERRAFORM")
+@click.option('--provider-mirror', required=False, type=click.Path(exists=True, file_okay=False),
+              help="Local provider directory to install providers from instead of the registry")
+@click.option('--timeout', type=float, default=3600, show_default=True,
+              help="Seconds terraform init may run before it is killed")
+def workspace_init(tf_code_dir, terraform, provider_mirror, timeout):
+    run_options = RunOptions(terraform=terraform, tf_code_dir=tf_code_dir, output_dir=None, timeout=timeout,
+                             retries=2, provider_mirror=provider_mirror)
+    import asyncio
+    template_dir, output = asyncio.run(_prepare_workspace_template(run_options))
+    print(output)
+    if not template_dir:
+        sys.exit(1)
+    print(template_dir)
+
+@workspace.command(cls=FiltersCommand, help="Creates a workspace for each selected tfvars file from the template \
+                   made by workspace init, and prints their paths. terraform init in a workspace only needs to \
+                   configure its backend")
+@click.option("--exclude-accounts", required=False, default=None, help="Comma-delimited list of accounts to exclude")
+@click.option('--backend-template', required=False, type=click.Path(exists=True, dir_okay=False),
+              help=f"Terraform file rendered into each workspace as {WORKSPACE_BACKEND_FILE_NAME}, with \
+              $account, $region, $uuid and $tfvars_path replaced by the leaf's values")
+def materialize(filters, exclude_accounts, backend_template):
+    template_dir = _workspace_template_dir()
+    if not os.path.exists(os.path.join(template_dir, WORKSPACE_FINGERPRINT_FILE)):
+        print("Error: no workspace template, run paraterra workspace init first")
+        sys.exit(1)
+    exclude_accounts = exclude_accounts.split(",") if exclude_accounts else None
+    for leaf in _resolve_selection(filters, exclude_accounts=exclude_accounts):
+        print(_materialize_leaf_workspace(template_dir, leaf, backend_template))
+
+@cli.group(help="Manages the cached index of tfvars files")
+def index():
+    pass
+
+@index.command(help="Drops and rebuilds the tfvars index")
+def rebuild():
+    with closing(_open_index()) as tfvars_index:
+        tfvars_index.execute("DELETE FROM leaves")
+        tfvars_index.execute("DELETE FROM tfvars")
+        counts = _refresh_index(tfvars_index)
+    if _BATCH:
+        _BATCH.invalidate_leaves()
+    print(f"Indexed {counts['parsed']} of {counts['leaves']} tfvars files into {_index_path()}")
+
+@index.command(help="Prints how many tfvars files are indexed and how many are stale")
+def status():
+    with closing(_open_index()) as tfvars_index:
+        indexed_count = tfvars_index.execute("SELECT COUNT(*) FROM leaves").fetchone()[0]
+        leaf_count, changed_leaves, removed_paths = _index_changes(tfvars_index)
+    print(f"Index: {_index_path()}")
+    print(f"Indexed tfvars files: {indexed_count}")
+    print(f"tfvars files on disk: {leaf_count}")
+    print(f"New or modified since last refresh: {len(changed_leaves)}")
+    print(f"Removed since last refresh: {len(removed_paths)}")
+
+@cli.command(help="Runs paraterra commands, one per line of COMMANDS_FILE (stdin by default), in one process. \
+             The commands share the tfvars index, which is refreshed once, and plans parsed by an earlier \
+             command. Blank lines and '#' comments are skipped. Fails if any command failed")
+@click.argument('commands_file', type=click.File(), default='-')
+@click.option('--fail-fast', is_flag=True, help="Stops at the first command that fails")
+def batch(commands_file, fail_fast):
+    global _BATCH
+    if _BATCH:
+        raise click.UsageError("batch can't be run from a batch")
+    _BATCH = _BatchState()
+    results = []
+    try:
+        for line in commands_file:
+            args = shlex.split(line, comments=True)
+            if not args:
+                continue
+            print(f"$ paraterra {shlex.join(args)}", file=sys.stderr)
+            started = time.perf_counter()
+            exit_code = _run_batch_command(args)
+            results.append([shlex.join(args), 'failed' if exit_code else 'passed', exit_code,
+                            f"{time.perf_counter() - started:.3f}"])
+            if exit_code and fail_fast:
+                break
+    finally:
+        _BATCH.close()
+        _BATCH = None
+    print(_tabulate(results, headers=['command', 'result', 'exit code', 'seconds'], disable_numparse=True),
+          file=sys.stderr)
+    if any(result[1] == 'failed' for result in results):
+        sys.exit(1)
+
+def _run_batch_command(args):
+    # Returns the exit code paraterra would have exited with
+    sys.stdout.flush()
+    try:
+        exit_code = cli.main(args, prog_name='paraterra', standalone_mode=False)
+    except click.ClickException as error:
+        error.show()
+        return error.exit_code
+    except click.Abort:
+        print("Aborted!", file=sys.stderr)
+        return 1
+    except SystemExit as error:
+        if error.code is None or isinstance(error.code, int):
+            return error.code or 0
+        print(error.code, file=sys.stderr)
+        return 1
+    finally:
+        sys.stdout.flush()
+    return exit_code if isinstance(exit_code, int) else 0
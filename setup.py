@@ -9,6 +9,10 @@ setup(
         'click-option-group',
         'tabulate'
     ],
+    extras_require={
+        # Reading .json.zst and .tar.zst plan artifacts
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             'paraterra = paraterra:cli',
@@ -1,4 +1,26 @@
-from paraterra import _parse_plans, _produce_counts
+import ast
+import builtins
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from collections import Counter
+from click.testing import CliRunner
+import paraterra
+from paraterra import _parse_plans, _produce_counts, _compile_paths, _get_accounts, \
+    _open_index, _refresh_index, _resolve_selection, _iter_plan_sections, _summarize_plan, PLAN_SECTIONS, \
+    _diff_resource_change, _property_allowed, PlanCounts, _print_plan_outliers, _percentile, ACTIONS, \
+    _compile_field_path, _compile_filters
 
 artifacts_path_1="ci-cd-test-data/terraform-plan-out-json"
 
@@ -91,6 +113,19 @@ def test_resource_drift_counts_are_accurate():
     assert all_resource_drift_counts.get("282837257756:us-east-1:53499e...").get("create-delete") == 0
     assert all_resource_drift_counts.get("282837257756:us-east-1:53499e...").get("delete") == 0
 
+def test_produce_counts_in_parallel_matches_serial(capsys):
+    serial_counts = _produce_counts(artifacts_path_1)
+    serial_output = capsys.readouterr().out
+
+    assert _produce_counts(artifacts_path_1, jobs=2) == serial_counts
+    assert capsys.readouterr().out == serial_output
+    assert not _parse_plans(no_deletes=True,
+                            no_creates=True,
+                            no_drift=True,
+                            allowed_props="vpc",
+                            artifacts_path=artifacts_path_1,
+                            jobs=2)
+
 def test_resource_properties_changed_counts_are_accurate():
     _, _, all_resource_properties_changed = _produce_counts(artifacts_path_1)
     print(all_resource_properties_changed)
@@ -99,4 +134,971 @@ def test_resource_properties_changed_counts_are_accurate():
     
     assert len(all_resource_properties_changed.get("282837257756:us-east-1:53499e...")) == 2
     assert "tags" in all_resource_properties_changed.get("282837257756:us-east-1:53499e...")
-    assert "tags_all" in all_resource_properties_changed.get("282837257756:us-east-1:53499e...")
\ No newline at end of file
+    assert "tags_all" in all_resource_properties_changed.get("282837257756:us-east-1:53499e...")
+
+def _write_tfvars(account, region, uuid, tfvars):
+    leaf_path = os.path.join("accounts", account, region, uuid)
+    os.makedirs(leaf_path, exist_ok=True)
+    with open(os.path.join(leaf_path, "terraform.tfvars.json"), "w") as tfvars_file:
+        json.dump(tfvars, tfvars_file)
+
+def _write_accounts_tree(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PARATERRA_CACHE_DIR", str(tmp_path / ".paraterra"))
+    _write_tfvars("111111111111", "us-east-1", "aaaa", {"environment": "dev", "network": {"cidr": "10.0.0.0/16"}})
+    _write_tfvars("222222222222", "us-east-1", "bbbb", {"environment": "prod", "network": {"cidr": "10.1.0.0/16"}})
+    _write_tfvars("333333333333", "us-west-2", "cccc", {"environment": "dev", "network": {"cidr": "10.2.0.0/16"}})
+
+def test_compile_paths_filters(tmp_path, monkeypatch):
+    _write_accounts_tree(tmp_path, monkeypatch)
+
+    assert _compile_paths(_resolve_selection("environment:dev"), shortened=True) == \
+        ["accounts/111111111111/us-east-1/aaaa", "accounts/333333333333/us-west-2/cccc"]
+    assert _compile_paths(_resolve_selection("environment:dev", exclude_accounts=["111111111111"]), shortened=False) == \
+        [os.path.join("accounts", "333333333333", "us-west-2", "cccc")]
+    assert _get_accounts(_resolve_selection("environment:prod")) == ["222222222222"]
+    assert _get_accounts(_resolve_selection("environment:staging")) == []
+
+def test_index_only_reparses_changed_tfvars(tmp_path, monkeypatch):
+    _write_accounts_tree(tmp_path, monkeypatch)
+    index = _open_index()
+
+    assert _refresh_index(index) == {"leaves": 3, "parsed": 3, "removed": 0}
+    assert _refresh_index(index) == {"leaves": 3, "parsed": 0, "removed": 0}
+
+    _write_tfvars("222222222222", "us-east-1", "bbbb", {"environment": "dev", "network": {"cidr": "10.1.0.0/16"}})
+    os.remove(os.path.join("accounts", "333333333333", "us-west-2", "cccc", "terraform.tfvars.json"))
+    os.rmdir(os.path.join("accounts", "333333333333", "us-west-2", "cccc"))
+
+    assert _refresh_index(index) == {"leaves": 2, "parsed": 1, "removed": 1}
+    index.close()
+    assert _get_accounts(_resolve_selection("environment:dev")) == ["111111111111", "222222222222"]
+
+def _count_tfvars_access(monkeypatch):
+    reads = Counter()
+    stats = Counter()
+    real_open = builtins.open
+    real_stat = os.stat
+
+    def counting_open(file, mode="r", *args, **kwargs):
+        if str(file).endswith("terraform.tfvars.json") and "r" in mode:
+            reads[os.path.normpath(str(file))] += 1
+        return real_open(file, mode, *args, **kwargs)
+
+    def counting_stat(path, *args, **kwargs):
+        if str(path).endswith("terraform.tfvars.json"):
+            stats[os.path.normpath(str(path))] += 1
+        return real_stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", counting_open)
+    monkeypatch.setattr(os, "stat", counting_stat)
+    return reads, stats
+
+def test_commands_read_each_tfvars_file_at_most_once(tmp_path, monkeypatch):
+    _write_accounts_tree(tmp_path, monkeypatch)
+    monkeypatch.setattr(paraterra, "_create_generated_file_path",
+                        lambda account, file_name: str(tmp_path / f"{account}-{file_name}"))
+    reads, stats = _count_tfvars_access(monkeypatch)
+    runner = CliRunner()
+
+    result = runner.invoke(paraterra.cli, ["update-tfvars", "--filters", "environment:dev",
+                                           "--from-list", "owner=platform", "--replace"])
+    assert result.exit_code == 0, result.output
+    assert len(stats) == 3 and max(stats.values()) == 1
+    assert len(reads) == 3 and max(reads.values()) == 1
+
+    for command in (["table", "--filters", "environment:dev"], ["accounts"], ["paths", "--shortened"]):
+        reads.clear()
+        stats.clear()
+        result = runner.invoke(paraterra.cli, command)
+        assert result.exit_code == 0, result.output
+        assert max(stats.values()) == 1
+        # only the two files rewritten by update-tfvars are re-read
+        assert sum(reads.values()) == (2 if command[0] == "table" else 0)
+
+    with open(os.path.join("accounts", "111111111111", "us-east-1", "aaaa", "terraform.tfvars.json")) as tfvars_file:
+        assert json.load(tfvars_file)["owner"] == "platform"
+
+def test_iter_plan_sections_across_chunk_boundaries(monkeypatch):
+    plan = {"format_version": "1.2",
+            "prior_state": {"values": [1, -2.5e-3, True, None, "quote \\\" and ]}{[", {"nested": [[], {}]}]},
+            "resource_changes": [{"change": {"actions": ["update"], "before": {"a": "x"}, "after": {"a": "é"}}},
+                                 {"change": {"actions": ["no-op"], "before": None, "after": None}}],
+            "resource_drift": [],
+            "configuration": {"keys]": ["{", "}"]}}
+    plan_text = json.dumps(plan, indent=1, ensure_ascii=False)
+
+    for chunk_size in (1, 2, 3, 7, 64, 1 << 20):
+        monkeypatch.setattr(paraterra, "PLAN_READ_CHUNK_SIZE", chunk_size)
+        assert list(_iter_plan_sections(io.StringIO(plan_text), PLAN_SECTIONS)) == \
+            [("resource_changes", resource_change) for resource_change in plan["resource_changes"]]
+
+    # A value spanning many chunks is decoded again after reads that grow with it, not after every chunk
+    huge_change = {"change": {"actions": ["update"], "before": {"tags": {str(tag): "x" * 100 for tag in range(10000)}}}}
+    plan_file = io.StringIO(json.dumps({"resource_changes": [huge_change]}))
+    reads = []
+    plan_read = plan_file.read
+    plan_file.read = lambda size: reads.append(size) or plan_read(size)
+    monkeypatch.setattr(paraterra, "PLAN_READ_CHUNK_SIZE", 1024)
+    assert list(_iter_plan_sections(plan_file, PLAN_SECTIONS)) == [("resource_changes", huge_change)]
+    assert len(reads) < 20
+
+def test_summarize_plan_memory_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(paraterra, "PLAN_READ_CHUNK_SIZE", 16 * 1024)
+    os.makedirs("artifacts/plans")
+    plan_path = "artifacts/plans/123456789012+us-east-1+0f0f0f0f+terraform-plan-out.json"
+    resource = {"values": {"tags": {"Name": "resource"}, "ingress": [{"cidr_blocks": ["10.0.0.0/16"]}]}}
+    with open(plan_path, "w") as plan_file:
+        plan_file.write('{"prior_state": {"resources": [')
+        plan_file.write(",".join([json.dumps(resource)] * 40000))
+        plan_file.write(']}, "resource_changes": [{"change": {"actions": ["update"], "before": {"a": 1}, "after": {"a": 2}}}]}')
+    plan_size = os.path.getsize(plan_path)
+
+    tracemalloc.start()
+    summary = _summarize_plan(plan_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert summary["resource_change_counts"]["update"] == 1
+    assert summary["resource_properties_changed"] == {"a"}
+    assert plan_size > 3 * 1024 * 1024
+    assert peak < plan_size / 8
+
+def test_plan_summaries_are_cached_by_content(tmp_path, monkeypatch):
+    monkeypatch.setenv("PARATERRA_CACHE_DIR", str(tmp_path / ".paraterra"))
+    uncached_counts = _produce_counts(artifacts_path_1)
+    assert _produce_counts(artifacts_path_1, use_cache=True) == uncached_counts
+    assert len(os.listdir(tmp_path / ".paraterra" / "plan-summaries")) == 2
+
+    def fail_to_parse(plan_path):
+        raise AssertionError(f"{plan_path} should have been read from the cache")
+
+    monkeypatch.setattr(paraterra, "_count_plan_changes", fail_to_parse)
+    assert _produce_counts(artifacts_path_1, use_cache=True) == uncached_counts
+
+def test_compressed_and_bundled_plans(tmp_path, monkeypatch):
+    plans_path = os.path.abspath(artifacts_path_1)
+    monkeypatch.setenv("PARATERRA_CACHE_DIR", str(tmp_path / ".paraterra"))
+    plan_names = sorted(os.listdir(plans_path))
+    for kind in ("gz", "tar", "zip"):
+        (tmp_path / kind).mkdir()
+    with open(os.path.join(plans_path, plan_names[0]), "rb") as plan_file, \
+            gzip.open(tmp_path / "gz" / f"{plan_names[0]}.gz", "wb") as compressed_file:
+        compressed_file.write(plan_file.read())
+    os.link(os.path.join(plans_path, plan_names[1]), tmp_path / "gz" / plan_names[1])
+    # Members are named by their basename wherever they are in the bundle
+    with tarfile.open(tmp_path / "tar" / "shard-1.tar.gz", "w:gz") as bundle:
+        for plan_name in plan_names:
+            bundle.add(os.path.join(plans_path, plan_name), arcname=f"artifacts/shard-1/{plan_name}")
+    with zipfile.ZipFile(tmp_path / "zip" / "shard-1.zip", "w", zipfile.ZIP_DEFLATED) as bundle:
+        for plan_name in plan_names:
+            bundle.write(os.path.join(plans_path, plan_name), arcname=plan_name)
+    runner = CliRunner()
+
+    def plan_rows(artifacts_path, *args):
+        result = runner.invoke(paraterra.cli, ["parse-plans", "--output", "ndjson", "--artifacts-path",
+                                               str(artifacts_path), *args])
+        return [json.loads(line) for line in result.stdout.splitlines()]
+
+    expected_rows = plan_rows(plans_path, "--no-cache")
+    assert len(expected_rows) == 2
+    for kind in ("gz", "tar", "zip"):
+        assert plan_rows(tmp_path / kind, "--no-cache") == expected_rows
+        assert plan_rows(tmp_path / kind, "--jobs", "2") == expected_rows
+    # Bundles are cached as one entry
+    monkeypatch.setattr(paraterra, "_count_plan_file_changes", lambda plan_file: 1 / 0)
+    assert plan_rows(tmp_path / "tar") == expected_rows
+
+    result = runner.invoke(paraterra.cli, ["print-plan-files", "--artifacts-path", str(tmp_path / "tar")])
+    assert result.stdout.strip() == str(plan_names)
+
+    (tmp_path / "zst").mkdir()
+    (tmp_path / "zst" / f"{plan_names[0]}.zst").write_bytes(b"")
+    try:
+        import zstandard
+    except ImportError:
+        result = runner.invoke(paraterra.cli, ["parse-plans", "--artifacts-path", str(tmp_path / "zst"), "--no-cache"])
+        assert result.exit_code == 1 and "pip install paraterra[zstd]" in result.stderr
+    else:
+        (tmp_path / "zst" / f"{plan_names[0]}.zst").write_bytes(
+            zstandard.ZstdCompressor().compress((tmp_path / "gz" / plan_names[1]).read_bytes()))
+        assert plan_rows(tmp_path / "zst", "--no-cache") == expected_rows[1:]
+
+def test_plan_summary_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setenv("PARATERRA_CACHE_DIR", str(tmp_path / ".paraterra"))
+    plan_summaries_dir = tmp_path / ".paraterra" / "plan-summaries"
+    plan_summaries_dir.mkdir(parents=True)
+    for age, name in enumerate(["newest", "middle", "oldest"]):
+        (plan_summaries_dir / f"{name}-v1.json").write_text("x" * 100)
+        os.utime(plan_summaries_dir / f"{name}-v1.json", (1000 - age, 1000 - age))
+    monkeypatch.setattr(paraterra, "PLAN_CACHE_MAX_BYTES", 250)
+
+    paraterra._evict_plan_summaries()
+
+    assert sorted(os.listdir(plan_summaries_dir)) == ["middle-v1.json", "newest-v1.json"]
+
+def test_parse_plans_reads_summaries_and_falls_back_to_plans(tmp_path):
+    plan_paths = sorted(os.path.join(artifacts_path_1, plan_file) for plan_file in os.listdir(artifacts_path_1))
+    summaries_path = tmp_path / "summaries"
+    summaries_path.mkdir()
+    result = CliRunner().invoke(paraterra.cli, ["summarize-plan", "--plan-path", plan_paths[0],
+                                                "--output-path", str(summaries_path / f"first{paraterra.PLAN_SUMMARY_FILE_SUFFIX}")])
+    assert result.exit_code == 0, result.output
+    with open(summaries_path / f"first{paraterra.PLAN_SUMMARY_FILE_SUFFIX}") as summary_file:
+        summary = json.load(summary_file)
+    assert summary["version"] == paraterra.PLAN_SUMMARY_VERSION
+    assert summary["account"] == "282837257756"
+
+    raw_counts = _produce_counts(artifacts_path_1)
+    assert _produce_counts(artifacts_path_1, summaries_path=str(summaries_path)) == raw_counts
+
+    result = CliRunner().invoke(paraterra.cli, ["summarize-plan", "--plan-path", plan_paths[1],
+                                                "--output-path", str(summaries_path / f"second{paraterra.PLAN_SUMMARY_FILE_SUFFIX}")])
+    assert result.exit_code == 0, result.output
+    assert _produce_counts(None, summaries_path=str(summaries_path)) == raw_counts
+    assert not _parse_plans(no_deletes=None,
+                            no_creates=None,
+                            no_drift=True,
+                            allowed_props=None,
+                            artifacts_path=None,
+                            summaries_path=str(summaries_path))
+
+def test_parse_plans_skips_summaries_next_to_plans(tmp_path):
+    # summarize-plan writes next to the plan by default, so a directory holds both
+    shutil.copytree(artifacts_path_1, tmp_path, dirs_exist_ok=True)
+    plan_paths = sorted(str(tmp_path / plan_file) for plan_file in os.listdir(artifacts_path_1))
+    result = CliRunner().invoke(paraterra.cli, ["summarize-plan", "--plan-path", plan_paths[0]])
+    assert result.exit_code == 0, result.output
+
+    raw_counts = _produce_counts(artifacts_path_1)
+    assert _produce_counts(str(tmp_path)) == raw_counts
+    assert _produce_counts(str(tmp_path), summaries_path=str(tmp_path)) == raw_counts
+    result = CliRunner().invoke(paraterra.cli, ["print-plan-files", "--artifacts-path", str(tmp_path)])
+    assert sorted(ast.literal_eval(result.stdout)) == sorted(os.listdir(artifacts_path_1))
+
+def test_parse_plans_warns_about_stale_summaries_on_stderr(tmp_path):
+    (tmp_path / f"stale{paraterra.PLAN_SUMMARY_FILE_SUFFIX}").write_text(json.dumps({"version": 0}))
+    result = CliRunner().invoke(paraterra.cli, ["parse-plans", "--summaries-path", str(tmp_path),
+                                                "--artifacts-path", artifacts_path_1, "--output", "json", "--no-cache"])
+    assert result.exit_code == 0, result.output
+    assert len(json.loads(result.stdout)) == len(os.listdir(artifacts_path_1))
+    assert "summary version 0 does not match" in result.stderr
+    # Costs are only recorded when asked for
+    assert not os.path.exists(os.path.join(".paraterra", paraterra.LEAF_COSTS_FILE_NAME))
+
+def test_diff_resource_change_reports_nested_paths():
+    before = {"id": "sg-1", "tags": {"Name": "a", "CostCenter": "1"}, "removed": "x",
+              "ingress": [{"cidr_blocks": ["10.0.0.0/16"]}, {"cidr_blocks": ["10.1.0.0/16"]}, {"cidr_blocks": ["10.2.0.0/16"]}]}
+    after = {"id": "sg-1", "tags": {"Name": "a", "CostCenter": "2"}, "added": "y",
+             "ingress": [{"cidr_blocks": ["10.0.0.0/16"]}, {"cidr_blocks": ["10.1.0.0/16"]}, {"cidr_blocks": ["0.0.0.0/0"]}]}
+    resource_change = {"change": {"actions": ["update"], "before": before, "after": after}}
+
+    assert _diff_resource_change(resource_change) == \
+        {"tags.CostCenter", "ingress[2].cidr_blocks[0]", "removed", "added"}
+
+def test_diff_resource_change_honours_unknown_and_sensitive_markers():
+    before = {"arn": "arn:1", "password": {"value": "old", "salt": "s"}, "tags": {"Name": "a"}}
+    after = {"password": {"value": "new", "salt": "s"}, "tags": {"Name": "a"}}
+    resource_change = {"change": {"actions": ["update"], "before": before, "after": after,
+                                  "after_unknown": {"arn": True, "tags": {}},
+                                  "before_sensitive": {"password": True},
+                                  "after_sensitive": {}}}
+
+    assert _diff_resource_change(resource_change) == {"arn", "password"}
+
+    # Terraform mirrors the shape of every value in the sensitive markers, and in after_unknown
+    # once anything is unknown; an unknown value that was null before is still a change
+    before = {"id": "sg-1", "arn": None, "tags": {"Name": "a", "Team": "x"},
+              "ingress": [{"cidr_blocks": ["10.0.0.0/16"]}, {"cidr_blocks": ["10.1.0.0/16"]}]}
+    after = {"id": "sg-1", "arn": None, "tags": {"Name": "a", "Team": "y"},
+             "ingress": [{"cidr_blocks": ["10.0.0.0/16"]}, {"cidr_blocks": ["10.1.0.0/16"]}]}
+    markers = {"tags": {}, "ingress": [{"cidr_blocks": [False]}, {"cidr_blocks": [False]}]}
+    resource_change = {"change": {"actions": ["update"], "before": before, "after": after,
+                                  "after_unknown": {**markers, "arn": True},
+                                  "before_sensitive": markers, "after_sensitive": markers}}
+
+    assert _diff_resource_change(resource_change) == {"arn", "tags.Team"}
+    resource_change["change"]["after_unknown"] = {}
+    assert _diff_resource_change(resource_change) == {"tags.Team"}
+
+def test_diff_resource_change_reports_large_collections_as_a_whole(monkeypatch):
+    monkeypatch.setattr(paraterra, "PROPERTY_DIFF_MAX_PATHS", 4)
+    before = {"tags": {f"Tag{index}": "a" for index in range(5)},
+              "labels": {"a": "1"},
+              "ingress": [{"from_port": 80, "to_port": 80}, {"from_port": 81, "to_port": 81}, {"from_port": 82, "to_port": 82}]}
+    after = {"tags": {**before["tags"], "Tag0": "b"},
+             "labels": {"a": "2"},
+             "ingress": [{"from_port": 8080, "to_port": 8080}, {"from_port": 8081, "to_port": 8081}, {"from_port": 8082, "to_port": 8082}]}
+    resource_change = {"change": {"actions": ["update"], "before": before, "after": after}}
+
+    # tags has more items than the limit, and ingress's changes would name more paths than it
+    assert _diff_resource_change(resource_change) == {"tags", "labels.a", "ingress"}
+
+def test_property_allowed_matches_path_globs():
+    assert _property_allowed("tags.CostCenter", ["tags"])
+    assert _property_allowed("tags.CostCenter", ["tags.Cost*"])
+    assert _property_allowed("ingress[2].cidr_blocks[0]", ["ingress[*].cidr_blocks"])
+    assert not _property_allowed("ingress[2].from_port", ["ingress[*].cidr_blocks"])
+    assert not _property_allowed("tags_all.Name", ["tags"])
+
+def _plan_summary(uuid, updates=0, deletes=0, drift=0, property_paths=(), unchanged=10):
+    resource_change_counts = dict.fromkeys(ACTIONS, 0)
+    resource_change_counts.update({"no-op": unchanged, "update": updates, "delete": deletes})
+    resource_drift_counts = dict.fromkeys(ACTIONS, 0)
+    resource_drift_counts["update"] = drift
+    return {"account": "111111111111", "region": "us-east-1", "uuid": uuid,
+            "resource_change_counts": resource_change_counts,
+            "resource_drift_counts": resource_drift_counts,
+            "property_paths_changed": set(property_paths)}
+
+def test_plan_counts_validation_and_outliers(capsys):
+    plan_counts = PlanCounts([_plan_summary("aaaaaaaa", updates=1, property_paths=["tags.Name"]),
+                              _plan_summary("bbbbbbbb", updates=1, property_paths=["tags.Name"]),
+                              _plan_summary("cccccccc", updates=1, deletes=1, property_paths=["tags.Name"]),
+                              _plan_summary("dddddddd", updates=1, property_paths=["tags.Name"], drift=2)])
+
+    assert plan_counts.nonzero([plan_counts.changes["delete"]]) == [2]
+    assert plan_counts.nonzero(plan_counts.drift.values()) == [3]
+
+    _print_plan_outliers(plan_counts)
+    outliers = capsys.readouterr().out.split("Outliers")[1]
+    assert "111111111111:us-east-1:cccccc..." in outliers
+    assert "111111111111:us-east-1:dddddd..." in outliers
+    assert "aaaaaa" not in outliers and "bbbbbb" not in outliers
+
+def test_change_profiles_ignore_unchanged_resources_and_list_positions(capsys):
+    # The same tag update in leaves of different sizes, and the same rule change at different positions
+    plan_counts = PlanCounts([_plan_summary(f"{number}aaaaaaa", updates=1, unchanged=number * 7,
+                                            property_paths=["tags.Name", f"ingress[{number}].cidr_blocks[0]"])
+                              for number in range(5)])
+
+    assert len(paraterra._change_profiles(plan_counts)) == 1
+    _print_plan_outliers(plan_counts)
+    output = capsys.readouterr().out
+    assert "No outliers" in output
+    assert "ingress[*].cidr_blocks[*],tags.Name" in output
+
+def test_percentile():
+    assert _percentile([], 50) == 0
+    assert _percentile([1, 2, 3, 4], 50) == 2
+    assert _percentile([1, 2, 3, 4], 90) == 4
+    assert _percentile(list(range(1, 101)), 90) == 90
+
+def _read_tfvars(account, region, uuid):
+    with open(os.path.join("accounts", account, region, uuid, "terraform.tfvars.json")) as tfvars_file:
+        return json.load(tfvars_file)
+
+def test_update_tfvars_applies_all_fields_and_skips_unchanged(tmp_path, monkeypatch):
+    _write_accounts_tree(tmp_path, monkeypatch)
+    monkeypatch.setattr(paraterra, "_create_generated_file_path",
+                        lambda account, file_name: str(tmp_path / f"{account}-{file_name}"))
+    unchanged_path = os.path.join("accounts", "333333333333", "us-west-2", "cccc", "terraform.tfvars.json")
+
+    result = CliRunner().invoke(paraterra.cli, ["update-tfvars", "--filters", "environment:dev", "--replace",
+                                                "--from-list", "owner=platform,tier=1,network:cidr=10.9.0.0/16"])
+
+    assert result.exit_code == 0, result.output
+    assert _read_tfvars("111111111111", "us-east-1", "aaaa") == \
+        {"environment": "dev", "owner": "platform", "tier": "1", "network": {"cidr": "10.9.0.0/16"}}
+    assert "replaced" in result.output
+    os.utime(unchanged_path, (1000, 1000))
+
+    result = CliRunner().invoke(paraterra.cli, ["update-tfvars", "--filters", "environment:dev", "--replace",
+                                                "--from-list", "owner=platform,tier=1"])
+    assert result.exit_code == 0, result.output
+    assert os.stat(unchanged_path).st_mtime == 1000
+    assert result.output.count("unchanged") == 2
+    assert not [name for name in os.listdir(os.path.dirname(unchanged_path)) if name.endswith(".tmp")]
+
+def test_update_tfvars_reports_failed_accounts(tmp_path, monkeypatch):
+    _write_accounts_tree(tmp_path, monkeypatch)
+    monkeypatch.setattr(paraterra, "_create_generated_file_path",
+                        lambda account, file_name: str(tmp_path / f"{account}-{file_name}"))
+    _write_tfvars("333333333333", "us-west-2", "cccc", {"environment": "dev"})
+
+    result = CliRunner().invoke(paraterra.cli, ["update-tfvars", "--filters", "environment:dev", "--replace",
+                                                "--delete-fields", "network:cidr,environment"])
+
+    assert result.exit_code == 1
+    assert _read_tfvars("111111111111", "us-east-1", "aaaa") == {"network": {}}
+    assert _read_tfvars("333333333333", "us-west-2", "cccc") == {"environment": "dev"}
+    assert "failed" in result.output
+
+def test_field_path_accessors():
+    tfvars = {"a": {"b": {"a": "inner"}}, "subnets": [{"cidr": "10.0.0.0/24"}, {"cidr": "10.0.1.0/24"}]}
+
+    assert _compile_field_path("a:b:a").get(tfvars) == "inner"
+    assert _compile_field_path("subnets:1:cidr").get(tfvars) == "10.0.1.0/24"
+    assert _compile_field_path("subnets:1:cidr") is _compile_field_path("subnets:1:cidr")
+    assert not _compile_field_path("subnets:2:cidr").exists(tfvars)
+    assert not _compile_field_path("a:missing").exists(tfvars)
+
+    _compile_field_path("a:b:a").set(tfvars, "updated")
+    _compile_field_path("subnets:0:cidr").set(tfvars, "10.9.0.0/24")
+    _compile_field_path("network:vpc:cidr").set(tfvars, "10.0.0.0/16")
+    _compile_field_path("subnets:1").delete(tfvars)
+
+    assert tfvars == {"a": {"b": {"a": "updated"}},
+                      "subnets": [{"cidr": "10.9.0.0/24"}],
+                      "network": {"vpc": {"cidr": "10.0.0.0/16"}}}
+
+def test_nested_filters_and_table_columns(tmp_path, monkeypatch):
+    _write_accounts_tree(tmp_path, monkeypatch)
+    runner = CliRunner()
+
+    result = runner.invoke(paraterra.cli, ["accounts", "--filters", "network:cidr:10.1.0.0/16"])
+    assert result.output.strip() == "['222222222222']"
+
+    result = runner.invoke(paraterra.cli, ["table", "--to-csv", "--filters", "environment:dev,network:cidr:10.2.0.0/16"])
+    assert result.output.splitlines() == ["account,environment,network:cidr", "333333333333,dev,10.2.0.0/16"]
+
+
+def test_filter_query_language(tmp_path, monkeypatch):
+    _write_accounts_tree(tmp_path, monkeypatch)
+    _write_tfvars("444444444444", "eu-west-1", "dddd", {"environment": "test", "enabled": True,
+                                                        "role_arn": "arn:aws:iam::444444444444:role/deploy"})
+
+    def accounts(filters):
+        return _get_accounts(_resolve_selection(filters))
+
+    assert accounts("environment in (dev,test) and not region:eu-*") == ["111111111111", "333333333333", "444444444444"]
+    assert accounts("environment in (dev, test) and not environment:dev") == ["444444444444"]
+    assert accounts("environment:prod or network:cidr:10.2.*") == ["222222222222", "333333333333"]
+    assert accounts("not (environment:dev or environment:prod)") == ["444444444444"]
+    assert accounts("network:cidr~'^10\\.[01]\\.'") == ["111111111111", "222222222222"]
+    assert accounts("enabled:true") == ["444444444444"]
+    # Leaves without the field never match a term on it, but do match its negation
+    assert accounts("network:cidr:*") == ["111111111111", "222222222222", "333333333333"]
+    assert accounts("not network:cidr:*") == ["444444444444"]
+    assert _compile_filters("environment:dev or network:cidr~10 or environment in (a)").fields == \
+        ["environment", "network:cidr"]
+    # Values may contain ':', the first one after a field some leaf has splits the term
+    assert accounts("role_arn:arn:aws:iam::444444444444:role/deploy") == ["444444444444"]
+    assert accounts("role_arn:arn:aws:iam::*:role/*") == ["444444444444"]
+    assert accounts("role_arn:\"arn:aws:iam::444444444444:role/deploy\"") == ["444444444444"]
+    assert accounts("owner:arn:aws:iam::444444444444:role/deploy") == []
+
+    result = CliRunner().invoke(paraterra.cli, ["table", "--to-csv", "--filters", "network:cidr:10.1.* or enabled:true"])
+    assert result.output.splitlines() == ["account,network:cidr,enabled",
+                                          "222222222222,10.1.0.0/16,", "444444444444,,True"]
+    result = CliRunner().invoke(paraterra.cli, ["table", "--to-csv", "--filters", "role_arn:arn:aws:iam::*"])
+    assert result.output.splitlines() == ["account,role_arn", "444444444444,arn:aws:iam::444444444444:role/deploy"]
+
+    for malformed in ("environment:dev and", "(environment:dev", "environment in dev", "name~'(", "a~'unterminated"):
+        result = CliRunner().invoke(paraterra.cli, ["accounts", "--filters", malformed])
+        assert result.exit_code == 2 and "Invalid value for '--filters'" in result.output
+
+def _git(*args):
+    subprocess.run(["git", "-c", "user.name=paraterra", "-c", "user.email=paraterra@example.com", *args],
+                   check=True, capture_output=True)
+
+def test_paths_changed_since(tmp_path, monkeypatch):
+    _write_accounts_tree(tmp_path, monkeypatch)
+    os.makedirs("modules/vpc")
+    (tmp_path / "modules" / "vpc" / "main.tf").write_text("")
+    (tmp_path / "README.md").write_text("")
+    (tmp_path / ".gitignore").write_text(".paraterra/\n")
+    _git("init", "-q")
+    _git("add", ".")
+    _git("commit", "-q", "-m", "fleet")
+    runner = CliRunner()
+
+    def changed_paths(*args):
+        result = runner.invoke(paraterra.cli, ["paths", "--shortened", "--output", "ndjson", "--changed-since", "HEAD",
+                                               *args])
+        assert result.exit_code == 0, result.output
+        return [json.loads(line) for line in result.stdout.splitlines()]
+
+    assert changed_paths() == []
+    _write_tfvars("222222222222", "us-east-1", "bbbb", {"environment": "prod", "network": {"cidr": "10.9.0.0/16"}})
+    assert changed_paths() == ["accounts/222222222222/us-east-1/bbbb"]
+    assert changed_paths("--filters", "environment:dev") == []
+    _git("commit", "-q", "-am", "prod cidr")
+    (tmp_path / "accounts" / "333333333333" / "us-west-2" / "cccc" / "backend.hcl").write_text("")
+    _git("add", ".")
+    _git("commit", "-q", "-m", "account settings")
+    assert changed_paths() == []
+    result = runner.invoke(paraterra.cli, ["paths", "--shortened", "--changed-since", "HEAD~2..HEAD"])
+    assert result.stdout.strip() == "['accounts/222222222222/us-east-1/bbbb', 'accounts/333333333333/us-west-2/cccc']"
+    assert "2 files changed since HEAD~2..HEAD, 2 of 3 leaves affected" in result.stderr
+
+    # Files outside accounts/ affect every leaf unless the config maps them
+    (tmp_path / "README.md").write_text("docs")
+    (tmp_path / "modules" / "vpc" / "main.tf").write_text("# vpc")
+    assert len(changed_paths()) == 3
+    (tmp_path / "paraterra-changes.json").write_text(json.dumps({"*.md": None, "paraterra-changes.json": None,
+                                                                 "modules/vpc/*": "network:cidr:10.9.*"}))
+    assert changed_paths() == ["accounts/222222222222/us-east-1/bbbb"]
+    assert changed_paths("--filters", "environment:dev") == []
+
+    result = runner.invoke(paraterra.cli, ["paths", "--changed-since", "no-such-ref"])
+    assert result.exit_code == 1 and "git diff no-such-ref failed" in result.stderr
+
+def test_matrix_balances_shards_by_recorded_costs(tmp_path, monkeypatch):
+    plan_paths = sorted(os.path.join(os.path.abspath(artifacts_path_1), plan_file)
+                        for plan_file in os.listdir(artifacts_path_1))
+    _write_accounts_tree(tmp_path, monkeypatch)
+    _write_tfvars("444444444444", "us-east-1", "dddd", {"environment": "dev"})
+
+    def matrix(*args):
+        result = CliRunner().invoke(paraterra.cli, ["matrix", *args])
+        assert result.exit_code == 0, result.output
+        return json.loads(result.stdout)
+
+    # Without recorded costs every leaf costs the same
+    assert matrix("--shards", "2") == [
+        {"shard": 1, "cost": 2, "tfvars_paths": "accounts/111111111111/us-east-1/aaaa accounts/333333333333/us-west-2/cccc"},
+        {"shard": 2, "cost": 2, "tfvars_paths": "accounts/222222222222/us-east-1/bbbb accounts/444444444444/us-east-1/dddd"}]
+    assert len(matrix("--shards", "10", "--filters", "environment:dev")) == 3
+
+    # parse-plans records each plan's duration and resource count for its leaf
+    summaries_path = tmp_path / "summaries"
+    summaries_path.mkdir()
+    for number, (plan_path, seconds) in enumerate(zip(plan_paths, (30, 90))):
+        CliRunner().invoke(paraterra.cli, ["summarize-plan", "--plan-path", plan_path, "--plan-seconds", str(seconds),
+                                           "--output-path", str(summaries_path / f"{number}{paraterra.PLAN_SUMMARY_FILE_SUFFIX}")])
+    result = CliRunner().invoke(paraterra.cli, ["parse-plans", "--summaries-path", str(summaries_path)])
+    assert result.exit_code == 0, result.output
+    with open(tmp_path / ".paraterra" / "leaf-costs.json") as costs_file:
+        leaf_costs = json.load(costs_file)
+    assert [cost["seconds"] for cost in leaf_costs.values()] == [30, 90]
+    # Plans summarized without a duration keep the one recorded before
+    for number, plan_path in enumerate(plan_paths):
+        CliRunner().invoke(paraterra.cli, ["summarize-plan", "--plan-path", plan_path,
+                                           "--output-path", str(summaries_path / f"{number}{paraterra.PLAN_SUMMARY_FILE_SUFFIX}")])
+    result = CliRunner().invoke(paraterra.cli, ["parse-plans", "--summaries-path", str(summaries_path)])
+    assert result.exit_code == 0, result.output
+    with open(tmp_path / ".paraterra" / "leaf-costs.json") as costs_file:
+        assert json.load(costs_file) == leaf_costs
+
+    costs_path = tmp_path / "costs.json"
+    costs_path.write_text(json.dumps({"accounts/111111111111/us-east-1/aaaa": {"seconds": 100, "resources": 1},
+                                      "accounts/222222222222/us-east-1/bbbb": {"seconds": 60, "resources": 1},
+                                      "accounts/333333333333/us-west-2/cccc": {"seconds": 40, "resources": 9}}))
+    # dddd has no recorded duration, so is given the mean of 200/3
+    assert [(entry["cost"], entry["tfvars_paths"]) for entry in matrix("--shards", "2", "--costs-path", str(costs_path))] == [
+        (140, "accounts/111111111111/us-east-1/aaaa accounts/333333333333/us-west-2/cccc"),
+        (126.67, "accounts/222222222222/us-east-1/bbbb accounts/444444444444/us-east-1/dddd")]
+    assert [entry["cost"] for entry in matrix("--shards", "2", "--costs-path", str(costs_path), "--cost-by", "resources")] == [9, 5.67]
+
+    result = CliRunner().invoke(paraterra.cli, ["matrix", "--shards", "257"])
+    assert result.exit_code == 2
+
+STUB_TERRAFORM = """#!{python}
+import json, os, sys, time
+command = sys.argv[1]
+options = dict(argument[1:].split("=", 1) for argument in sys.argv[2:] if "=" in argument)
+account = os.environ.get("PARATERRA_ACCOUNT", "template")
+provider_path = os.path.join(".terraform", "providers", "example.com", "stub", "terraform-provider-stub")
+
+def log_call(call):
+    with open(os.path.join(os.environ["STUB_STATE_DIR"], "calls.log"), "a") as calls:
+        calls.write(f"{{account}} {{call}} {{os.getcwd()}}\\n")
+
+log_call(command)
+if command == "init":
+    if not os.path.exists(provider_path):
+        if "plugin-dir" not in options:
+            sys.exit("Error: Failed to query available provider packages: offline")
+        log_call("install-provider")
+        os.makedirs(os.path.dirname(provider_path))
+        with open(os.path.join(options["plugin-dir"], "terraform-provider-stub")) as mirror_file, \\
+                open(provider_path, "w") as provider_file:
+            provider_file.write(mirror_file.read())
+    if options.get("backend") != "false" and os.path.exists("paraterra_backend.tf"):
+        with open("paraterra_backend.tf") as backend_file, open(".terraform/terraform.tfstate", "w") as state_file:
+            state_file.write(backend_file.read())
+    print("Terraform has been successfully initialized!")
+elif command == "plan":
+    with open(options["var-file"]) as tfvars_file:
+        tfvars = json.load(tfvars_file)
+    time.sleep(tfvars.get("stub_sleep", 0))
+    if tfvars.get("stub_fail"):
+        sys.exit("Error: Invalid value for variable")
+    lock_path = os.path.join(os.environ["STUB_STATE_DIR"], account + ".locked")
+    if tfvars.get("stub_locked_once") and not os.path.exists(lock_path):
+        open(lock_path, "w").close()
+        sys.exit("Error: Error acquiring the state lock")
+    with open(options["out"], "w") as plan_file:
+        json.dump(tfvars, plan_file)
+    print("Plan: 1 to add, 0 to change, 0 to destroy.")
+elif command == "show":
+    with open(sys.argv[3]) as plan_file:
+        environment = json.load(plan_file)["environment"]
+    print(json.dumps({{"resource_changes": [{{"address": "aws_vpc.this", "change": {{
+        "actions": ["update"], "before": {{"tags": {{"env": "old"}}}}, "after": {{"tags": {{"env": environment}}}}}}}}],
+        "resource_drift": []}}))
+elif command == "apply":
+    assert "-json" in sys.argv
+    for message_type, message in (("apply_start", "aws_vpc.this: Creating..."),
+                                  ("apply_complete", "aws_vpc.this: Creation complete after 1s"),
+                                  ("change_summary", "Apply complete! Resources: 1 added, 0 changed, 0 destroyed.")):
+        print(json.dumps({{"@level": "info", "@message": message, "@timestamp": "2024-05-01T10:00:00.000000Z",
+                          "type": message_type, "hook": {{"resource": {{"addr": "aws_vpc.this"}}, "action": "create"}},
+                          "changes": {{"add": 1, "change": 0, "remove": 0, "operation": "apply"}}}}))
+"""
+
+def _write_stub_terraform(tmp_path, monkeypatch):
+    terraform_path = tmp_path / "terraform"
+    terraform_path.write_text(STUB_TERRAFORM.format(python=sys.executable))
+    terraform_path.chmod(terraform_path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PARATERRA_TERRAFORM", str(terraform_path))
+    monkeypatch.setenv("STUB_STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(paraterra, "RUN_RETRY_BACKOFF_SECONDS", 0)
+    (tmp_path / "tf").mkdir()
+    (tmp_path / "tf" / "main.tf").write_text("")
+    (tmp_path / "mirror").mkdir()
+    (tmp_path / "mirror" / "terraform-provider-stub").write_text("provider")
+
+def test_run_plan_and_apply_with_stub_terraform(tmp_path, monkeypatch):
+    _write_accounts_tree(tmp_path, monkeypatch)
+    _write_stub_terraform(tmp_path, monkeypatch)
+    _write_tfvars("222222222222", "us-east-1", "bbbb", {"environment": "prod", "stub_locked_once": True})
+    runner = CliRunner()
+
+    result = runner.invoke(paraterra.cli, ["run", "plan", "--tf-code-dir", "tf", "--jobs", "2", "--provider-mirror", "mirror"])
+    assert result.exit_code == 0, result.output
+    rows = [line.split() for line in result.output.splitlines()[2:]]
+    assert [(row[0], row[3], row[4]) for row in rows] == [("111111111111", "planned", "1"),
+                                                          ("222222222222", "planned", "2"),
+                                                          ("333333333333", "planned", "1")]
+    # Every leaf ran in its own copy of the config
+    with open(tmp_path / "calls.log") as calls_log:
+        work_dirs = {tuple(line.split()[::2]) for line in calls_log if not line.startswith("template")}
+    assert len({work_dir for account, work_dir in work_dirs}) == 3
+
+    # parse-plans reads run's output directly
+    change_counts, _, properties_changed = _produce_counts(str(tmp_path / "artifacts" / "terraform-plan-out-json"))
+    assert [counts["update"] for counts in change_counts.values()] == [1, 1, 1]
+    assert list(properties_changed.values()) == [{"tags"}, {"tags"}, {"tags"}]
+
+    result = runner.invoke(paraterra.cli, ["run", "apply", "--tf-code-dir", "tf", "--filters", "environment:dev",
+                                           "--provider-mirror", "mirror"])
+    assert result.exit_code == 0, result.output
+    assert result.output.count("applied") == 2
+    assert "Apply complete!" in (tmp_path / "artifacts" / "terraform-apply-json" /
+                                 "111111111111+us-east-1+aaaa+terraform-apply.json").read_text()
+
+    # parse-applies reads run's apply logs directly
+    result = runner.invoke(paraterra.cli, ["parse-applies", "--artifacts-path", "artifacts/terraform-apply-json",
+                                           "--output", "json"])
+    assert result.exit_code == 0, result.output
+    assert [(row["account"], row["result"], row["create"]) for row in json.loads(result.stdout)] == \
+        [("111111111111", "applied", 1), ("333333333333", "applied", 1)]
+
+def test_run_reports_failures_and_timeouts(tmp_path, monkeypatch):
+    _write_accounts_tree(tmp_path, monkeypatch)
+    _write_stub_terraform(tmp_path, monkeypatch)
+    _write_tfvars("222222222222", "us-east-1", "bbbb", {"environment": "prod", "stub_fail": True})
+    _write_tfvars("333333333333", "us-west-2", "cccc", {"environment": "dev", "stub_sleep": 5})
+
+    result = CliRunner().invoke(paraterra.cli, ["run", "plan", "--tf-code-dir", "tf", "--timeout", "1",
+                                                "--provider-mirror", "mirror"])
+    assert result.exit_code == 1
+    rows = [line.split() for line in result.output.splitlines()[2:]]
+    assert [" ".join(row[3:-2]) for row in rows] == ["planned", "failed: plan", "timed out: plan"]
+    # Non-transient errors aren't retried
+    assert rows[1][-2] == "1"
+    assert "Invalid value" in (tmp_path / "artifacts" / "terraform-plan-txt" /
+                               "222222222222+us-east-1+bbbb+terraform-plan.txt").read_text()
+    assert os.listdir(tmp_path / "artifacts" / "terraform-plan-out-json") == ["111111111111+us-east-1+aaaa+terraform-plan-out.json"]
+
+    result = CliRunner().invoke(paraterra.cli, ["run", "apply", "--tf-code-dir", "tf", "--filters", "environment:prod",
+                                                "--provider-mirror", "mirror"])
+    assert result.exit_code == 1 and "failed: no saved plan" in result.output
+
+def test_workspaces_init_once_and_share_providers(tmp_path, monkeypatch):
+    _write_accounts_tree(tmp_path, monkeypatch)
+    _write_stub_terraform(tmp_path, monkeypatch)
+    (tmp_path / "backend.tf.template").write_text('terraform {\n  backend "s3" { key = "$account/$region/$uuid" }\n}\n')
+    runner = CliRunner()
+
+    def calls():
+        with open(tmp_path / "calls.log") as calls_log:
+            return Counter(" ".join(line.split()[:2]) for line in calls_log)
+
+    result = runner.invoke(paraterra.cli, ["workspace", "init", "--tf-code-dir", "tf", "--provider-mirror", "mirror"])
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(paraterra.cli, ["workspace", "materialize", "--backend-template", "backend.tf.template"])
+    assert result.exit_code == 0, result.output
+    work_dirs = result.output.split()
+    assert len(work_dirs) == 3
+
+    template_provider = tmp_path / ".paraterra" / "workspace-template" / ".terraform" / "providers" / "example.com" / \
+        "stub" / "terraform-provider-stub"
+    for work_dir in work_dirs:
+        assert os.path.samefile(os.path.join(work_dir, ".terraform", "providers", "example.com", "stub",
+                                             "terraform-provider-stub"), template_provider)
+    with open(os.path.join(work_dirs[1], "paraterra_backend.tf")) as backend_file:
+        assert 'key = "222222222222/us-east-1/bbbb"' in backend_file.read()
+
+    # run reuses the template, and leaf inits find the providers already installed
+    result = runner.invoke(paraterra.cli, ["run", "plan", "--tf-code-dir", "tf", "--provider-mirror", "mirror",
+                                           "--backend-template", "backend.tf.template"])
+    assert result.exit_code == 0, result.output
+    assert calls() == {"template init": 1, "template install-provider": 1, "111111111111 init": 1, "111111111111 plan": 1,
+                       "111111111111 show": 1, "222222222222 init": 1, "222222222222 plan": 1, "222222222222 show": 1,
+                       "333333333333 init": 1, "333333333333 plan": 1, "333333333333 show": 1}
+
+    # Changing the config initializes the template again
+    (tmp_path / "tf" / "main.tf").write_text("# changed")
+    result = runner.invoke(paraterra.cli, ["workspace", "init", "--tf-code-dir", "tf", "--provider-mirror", "mirror"])
+    assert result.exit_code == 0, result.output
+    assert calls()["template init"] == 2
+
+def test_profile_and_trace_out(tmp_path, monkeypatch):
+    plans_path = os.path.abspath(artifacts_path_1)
+    _write_accounts_tree(tmp_path, monkeypatch)
+    runner = CliRunner()
+
+    result = runner.invoke(paraterra.cli, ["--profile", "--trace-out", "trace.json", "paths", "--filters", "environment:dev"])
+    assert result.exit_code == 0, result.output
+    # The profile goes to stderr, so stdout is only the command's output
+    assert result.stdout.strip() == "['accounts/111111111111/us-east-1/aaaa', 'accounts/333333333333/us-west-2/cccc']"
+    phases = {line.split()[0] for line in result.stderr.splitlines()[2:]}
+    assert {"paraterra", "scan", "load", "read", "query", "compile"} <= phases
+    with open(tmp_path / "trace.json") as trace_file:
+        events = {event["name"]: event for event in json.load(trace_file)["traceEvents"]}
+    assert events["load tfvars"]["args"]["files"] == 3
+    assert events["query index"]["args"]["leaves"] == 2
+    assert events["read index"]["args"]["rows"] == 3
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events.values())
+    assert paraterra._PROFILER is None
+
+    result = runner.invoke(paraterra.cli, ["--trace-out", "plans.json", "parse-plans", "--artifacts-path", plans_path,
+                                           "--jobs", "2", "--no-cache"])
+    assert result.exit_code == 0, result.output
+    with open(tmp_path / "plans.json") as trace_file:
+        events = json.load(trace_file)["traceEvents"]
+    # Plans parsed in worker processes are traced too
+    plan_events = [event for event in events if event["name"] == "summarize plan"]
+    assert len(plan_events) == 2 and all(event["pid"] != os.getpid() for event in plan_events)
+    assert sum(event["args"]["resources"] for event in events if event["name"] == "decode plan") > 0
+
+def test_output_formats(tmp_path, monkeypatch):
+    plans_path = os.path.abspath(artifacts_path_1)
+    _write_accounts_tree(tmp_path, monkeypatch)
+    _write_tfvars("444444444444", "eu-west-1", "dddd", {"environment": "dev, but shared", "network": {"cidr": None}})
+    runner = CliRunner()
+
+    result = runner.invoke(paraterra.cli, ["paths", "--shortened", "--output", "json", "--filters", "environment:prod"])
+    assert json.loads(result.stdout) == ["accounts/222222222222/us-east-1/bbbb"]
+    result = runner.invoke(paraterra.cli, ["accounts", "--output", "ndjson", "--filters", "environment:dev*"])
+    assert result.stdout.splitlines() == ['"111111111111"', '"333333333333"', '"444444444444"']
+    result = runner.invoke(paraterra.cli, ["accounts", "--output", "json", "--filters", "environment:none"])
+    assert json.loads(result.stdout) == []
+
+    filters = "environment:dev* or enabled:true"
+    result = runner.invoke(paraterra.cli, ["table", "--output", "csv", "--filters", filters])
+    assert list(csv.reader(io.StringIO(result.stdout)))[-1] == ["444444444444", "dev, but shared", ""]
+    result = runner.invoke(paraterra.cli, ["table", "--output", "json", "--filters", filters + " or network:cidr:null"])
+    assert json.loads(result.stdout)[-1] == {"account": "444444444444", "environment": "dev, but shared",
+                                             "enabled": None, "network:cidr": None}
+
+    result = runner.invoke(paraterra.cli, ["parse-plans", "--artifacts-path", plans_path, "--output", "ndjson",
+                                           "--no-creates", "--no-cache"])
+    rows = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [row["uuid"][:8] for row in rows] == ["345c91aa", "53499ebb"]
+    assert set(rows[0]) == set(paraterra.PLAN_ROW_HEADERS)
+    assert isinstance(rows[0]["properties_changed"], list)
+    # Validation messages go to stderr, but still decide the exit code
+    assert result.exit_code == (0 if all(row["changes:create"] == 0 for row in rows) else 1)
+
+    result = runner.invoke(paraterra.cli, ["parse-plans", "--artifacts-path", plans_path, "--output", "csv", "--no-cache"])
+    assert [row["changes:no-op"] for row in csv.DictReader(io.StringIO(result.stdout))] == \
+        [str(row["changes:no-op"]) for row in rows]
+
+def test_import_is_lazy():
+    # -X importtime reports cumulative microseconds per module on stderr
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import paraterra"],
+                            cwd=os.path.dirname(os.path.abspath(paraterra.__file__)),
+                            capture_output=True, text=True, check=True)
+    imported = {line.split("|")[2].strip(): int(line.split("|")[1]) for line in result.stderr.splitlines()
+                if line.startswith("import time:") and line.split("|")[1].strip().isdigit()}
+    assert not {"tabulate", "asyncio", "concurrent.futures", "multiprocessing", "shutil", "tarfile"} & set(imported), \
+        f"paraterra imported in {imported['paraterra'] / 1000:.1f} ms"
+
+def test_batch_shares_index_and_plans(tmp_path, monkeypatch):
+    plans_path = os.path.abspath(artifacts_path_1)
+    _write_accounts_tree(tmp_path, monkeypatch)
+    monkeypatch.setattr(paraterra, "_create_generated_file_path",
+                        lambda account, file_name: str(tmp_path / f"{account}-{file_name}"))
+    reads, stats = _count_tfvars_access(monkeypatch)
+    summarized = Counter()
+    summarize_plan = paraterra._summarize_plan
+    monkeypatch.setattr(paraterra, "_summarize_plan",
+                        lambda plan_path, **kwargs: summarized.update([plan_path]) or summarize_plan(plan_path, **kwargs))
+    (tmp_path / "commands.txt").write_text(f"""
+# inventory
+paths --shortened --filters environment:dev
+accounts --filters 'environment:prod'
+update-tfvars --replace --filters environment:prod --from-list owner=platform
+table --filters owner:platform
+parse-plans --no-cache --artifacts-path {plans_path}
+parse-plans --no-cache --output ndjson --artifacts-path {plans_path}
+""")
+
+    result = CliRunner().invoke(paraterra.cli, ["batch", "commands.txt"])
+    assert result.exit_code == 0, result.output
+    assert "['accounts/111111111111/us-east-1/aaaa', 'accounts/333333333333/us-west-2/cccc']" in result.stdout
+    assert "222222222222  platform" in result.stdout
+    assert len(result.stdout.splitlines()[-2:]) == 2 and \
+        all(json.loads(line)["account"] for line in result.stdout.splitlines()[-2:])
+    assert "$ paraterra accounts --filters environment:prod" in result.stderr
+    # The index is refreshed before the first command and after update-tfvars replaced a file,
+    # and only the replaced file is read again
+    assert max(stats.values()) == 2 and sum(reads.values()) == 3 + 1
+    # Plans are parsed once for both parse-plans commands
+    assert len(summarized) == 2 and max(summarized.values()) == 1
+    assert paraterra._BATCH is None
+
+    result = CliRunner().invoke(paraterra.cli, ["batch", "--fail-fast"],
+                                input="accounts --filters 'environment:(dev'\npaths\n")
+    assert result.exit_code == 1
+    assert "$ paraterra paths" not in result.stderr and "failed" in result.stderr
+
+def test_parse_plans_html_report(tmp_path):
+    plans_path = os.path.abspath(artifacts_path_1)
+    html_path = tmp_path / "report.html"
+    result = CliRunner().invoke(paraterra.cli, ["parse-plans", "--artifacts-path", plans_path, "--no-cache",
+                                                "--html-out", str(html_path)])
+    assert result.exit_code == 0, result.output
+    html = html_path.read_text()
+    # Self-contained: nothing is loaded from elsewhere
+    assert "src=" not in html and "href=" not in html
+    data = json.loads(html.split('<script type="application/json" id="data">')[1].split("</script>")[0])
+
+    dictionaries = data["dictionaries"]
+    plans = data["plans"]
+    summaries = paraterra._collect_plan_summaries(plans_path)
+    assert [dictionaries["account"][account] for account in plans["account"]] == [s["account"] for s in summaries]
+    assert plans["uuid"] == [s["uuid"] for s in summaries]
+    update = data["actions"].index("update")
+    assert plans["changes"][update] == [s["resource_change_counts"]["update"] for s in summaries]
+    for plan, plan_summary in enumerate(summaries):
+        resources = dictionaries["resources"][plans["resources"][plan]]
+        assert {dictionaries["address"][resource[0]]: [dictionaries["property"][p] for p in resource[1:]]
+                for resource in resources} == plan_summary["properties_changed_by_address"]
+    assert sum(profile[0] for profile in data["profiles"]) == 2 and set(plans["profile"]) == {1, 2}
+    assert data["stats"]["changes"][0][0] == "total"
+
+def _apply_message(message_type, seconds, **fields):
+    return json.dumps({"@level": "error" if message_type == "diagnostic" else "info", "@module": "terraform.ui",
+                       "@timestamp": f"2024-05-01T10:00:{seconds:02d}.000000Z", "type": message_type, **fields}) + "\n"
+
+def _apply_hook(address, action):
+    return {"resource": {"addr": address}, "action": action}
+
+def _write_apply_logs(logs_path):
+    os.makedirs(logs_path)
+    with open(os.path.join(logs_path, "111111111111+us-east-1+aaaa+terraform-apply.json"), "w") as log_file:
+        log_file.write(_apply_message("version", 0, terraform="1.6.0", ui="1.2"))
+        log_file.write(_apply_message("apply_start", 1, hook=_apply_hook("aws_vpc.main", "update")))
+        log_file.write(_apply_message("apply_complete", 4, hook=_apply_hook("aws_vpc.main", "update")))
+        log_file.write(_apply_message("apply_complete", 5, hook=_apply_hook("aws_subnet.a", "create")))
+        log_file.write("not json, e.g. from a wrapper script\n")
+        log_file.write(_apply_message("change_summary", 6, changes={"add": 1, "change": 1, "remove": 0,
+                                                                   "operation": "apply"}))
+    with gzip.open(os.path.join(logs_path, "222222222222+us-east-1+bbbb+terraform-apply.json.gz"), "wt") as log_file:
+        log_file.write(_apply_message("apply_complete", 2, hook=_apply_hook("aws_subnet.b", "replace")))
+        log_file.write(_apply_message("apply_errored", 9, hook=_apply_hook("aws_instance.web", "create")))
+        log_file.write(_apply_message("diagnostic", 9, diagnostic={"severity": "error", "address": "aws_instance.web",
+                                                                   "summary": "creating EC2 Instance: UnauthorizedOperation"}))
+    # Cut off mid-apply
+    with open(os.path.join(logs_path, "333333333333+us-west-2+cccc+terraform-apply.json"), "w") as log_file:
+        log_file.write(_apply_message("apply_start", 0, hook=_apply_hook("aws_vpc.main", "delete")))
+
+def test_parse_applies(tmp_path):
+    logs_path = str(tmp_path / "apply-logs")
+    _write_apply_logs(logs_path)
+    runner = CliRunner()
+
+    result = runner.invoke(paraterra.cli, ["parse-applies", "--artifacts-path", logs_path, "--output", "ndjson"])
+    assert result.exit_code == 1
+    rows = {row["account"]: row for row in map(json.loads, result.stdout.splitlines())}
+    assert rows["111111111111"] == {"account": "111111111111", "region": "us-east-1", "uuid": "aaaa",
+                                    "result": "applied", "create": 1, "read": 0, "update": 1, "replace": 0, "delete": 0,
+                                    "failed": 0, "seconds": 6.0, "errors": []}
+    assert rows["222222222222"]["result"] == "errored" and rows["222222222222"]["replace"] == 1
+    assert rows["222222222222"]["errors"] == ["aws_instance.web: creating EC2 Instance: UnauthorizedOperation"]
+    assert rows["333333333333"]["result"] == "incomplete" and rows["333333333333"]["seconds"] == 0
+    assert "Failed: 2 of 3 leaves" in result.stderr
+
+    result = runner.invoke(paraterra.cli, ["parse-applies", "--artifacts-path", logs_path, "--output", "ndjson",
+                                           "--jobs", "2"])
+    assert {row["account"]: row for row in map(json.loads, result.stdout.splitlines())} == rows
+    result = runner.invoke(paraterra.cli, ["parse-applies", "--artifacts-path", logs_path])
+    assert "Apply Errors" in result.stdout and "UnauthorizedOperation" in result.stdout
+
+    os.remove(os.path.join(logs_path, "222222222222+us-east-1+bbbb+terraform-apply.json.gz"))
+    os.remove(os.path.join(logs_path, "333333333333+us-west-2+cccc+terraform-apply.json"))
+    result = runner.invoke(paraterra.cli, ["parse-applies", "--artifacts-path", logs_path])
+    assert result.exit_code == 0, result.output
+
+def test_parse_applies_follows_logs_being_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(paraterra, "APPLY_FOLLOW_POLL_SECONDS", 0.05)
+    log_path = tmp_path / "111111111111+us-east-1+aaaa+terraform-apply.json"
+    log_path.write_text(_apply_message("apply_start", 0, hook=_apply_hook("aws_vpc.main", "create")) + '{"@level": ')
+
+    def finish_apply():
+        time.sleep(0.3)
+        with open(log_path, "a") as log_file:
+            # Completes the line that was cut off mid-write
+            log_file.write('"info", "type": "apply_complete", "hook": {"action": "create"}}\n')
+            log_file.write(_apply_message("change_summary", 3, changes={"operation": "apply"}))
+
+    writer = threading.Thread(target=finish_apply)
+    writer.start()
+    started = time.monotonic()
+    result = CliRunner().invoke(paraterra.cli, ["parse-applies", "--artifacts-path", str(tmp_path), "--follow",
+                                                "--idle-timeout", "1", "--output", "json"])
+    writer.join()
+    assert result.exit_code == 0, result.output
+    assert [(row["result"], row["create"]) for row in json.loads(result.stdout)] == [("applied", 1)]
+    assert time.monotonic() - started < 10
+
+    # A log that stops growing is summarized as it is once --idle-timeout passes
+    log_path.write_text(_apply_message("apply_start", 0, hook=_apply_hook("aws_vpc.main", "create")))
+    result = CliRunner().invoke(paraterra.cli, ["parse-applies", "--artifacts-path", str(tmp_path), "--follow",
+                                                "--idle-timeout", "0.2", "--output", "ndjson"])
+    assert result.exit_code == 1 and json.loads(result.stdout)["result"] == "incomplete"
+
+    # Logs still being followed are closed when the generator is closed early
+    opened = []
+    monkeypatch.setattr(paraterra, "open", lambda *args: opened.append(open(*args)) or opened[-1], raising=False)
+    log_path.write_text(_apply_message("apply_start", 0, hook=_apply_hook("aws_vpc.main", "create")) +
+                        _apply_message("change_summary", 3, changes={"operation": "apply"}))
+    (tmp_path / "222222222222+us-east-1+bbbb+terraform-apply.json").write_text(
+        _apply_message("apply_start", 0, hook=_apply_hook("aws_vpc.main", "create")))
+    followed_logs = paraterra._follow_apply_logs(str(tmp_path), idle_timeout=60)
+    assert next(followed_logs)["account"] == "111111111111"
+    followed_logs.close()
+    assert len(opened) == 2 and all(log_file.closed for log_file in opened)
+
+def test_parse_applies_follows_logs_created_later(tmp_path, monkeypatch):
+    monkeypatch.setattr(paraterra, "APPLY_FOLLOW_POLL_SECONDS", 0.05)
+    log_path = tmp_path / "111111111111+us-east-1+aaaa+terraform-apply.json"
+    # terraform writes non-ASCII characters as UTF-8 rather than escaping them
+    error = json.dumps({"@level": "error", "@timestamp": "2024-05-01T10:00:01.000000Z", "type": "diagnostic",
+                        "diagnostic": {"severity": "error", "summary": "réseau introuvable"}},
+                       ensure_ascii=False).encode() + b"\n"
+    split = error.index("é".encode()) + 1
+
+    def apply():
+        # No log exists when parse-applies starts, and the first write ends inside a two-byte character
+        time.sleep(0.3)
+        log_path.write_bytes(_apply_message("apply_start", 0, hook=_apply_hook("aws_vpc.main", "create")).encode() +
+                             error[:split])
+        time.sleep(0.3)
+        with open(log_path, "ab") as log_file:
+            log_file.write(error[split:] + _apply_message("change_summary", 2, changes={"operation": "apply"}).encode())
+
+    writer = threading.Thread(target=apply)
+    writer.start()
+    result = CliRunner().invoke(paraterra.cli, ["parse-applies", "--artifacts-path", str(tmp_path), "--follow",
+                                                "--idle-timeout", "1", "--output", "ndjson"])
+    writer.join()
+    assert result.exit_code == 1, result.output
+    row = json.loads(result.stdout)
+    assert (row["result"], row["errors"]) == ("errored", ["réseau introuvable"])